@@ -0,0 +1,109 @@
+# encoding: utf-8
+from ckan import model
+from ckan.lib.plugins import lookup_group_plugin
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.cioos_harvest import blobstore, normalize
+
+import logging
+log = logging.getLogger(__name__)
+
+
+@toolkit.side_effect_free
+def harvest_document_show(context, data_dict):
+    '''
+    Return the harvested xml document of a dataset
+
+    :param id: the id or name of the dataset
+    :type id: string
+
+    :rtype: string
+    '''
+    package_dict = toolkit.get_action('package_show')(context, {'id': toolkit.get_or_bust(data_dict, 'id')})
+
+    reference = None
+    for extra in package_dict.get('extras', []):
+        if extra['key'] == 'harvest_document_ref':
+            reference = extra['value']
+    if reference:
+        document = blobstore.get_document_store().get(reference)
+        if document is None:
+            raise toolkit.ObjectNotFound('Harvest document %s not found' % reference)
+        return document
+
+    # documents stored inline in the dataset
+    content = package_dict.get('harvest_document_content') or ''
+    if content.startswith('<'):
+        return content
+    raise toolkit.ObjectNotFound('Dataset has no harvest document')
+
+
+@toolkit.chained_action
+def harvest_source_reindex(up_func, context, data_dict):
+    '''
+    Index the datasets of finished jobs of the source that deferred their
+    indexing. ckanext-harvest reindexes the harvest source when a job is
+    marked as finished.
+    '''
+    from ckanext.cioos_harvest import indexing
+
+    result = up_func(context, data_dict)
+    source = model.Package.get(data_dict.get('id'))
+    if source:
+        try:
+            indexing.index_pending_jobs(source.id)
+        except Exception as e:
+            log.exception(e)
+    return result
+
+
+TRANSLATED_TITLE_LANGUAGES = ['en', 'fr']
+
+
+def translated_title_missing(value):
+    return not (normalize.from_json(value) if value else value)
+
+
+def translated_title(data_dict):
+    title = data_dict.get('title') or data_dict.get('name') or ''
+    return dict((lang, title) for lang in TRANSLATED_TITLE_LANGUAGES)
+
+
+def has_translated_title(group_type, context=None):
+    '''
+    Whether the schema used to create groups or organizations of `group_type`
+    has a title_translated field, like the fluent schemas of ckanext-scheming
+    '''
+    context = context or {}
+    schema = context.get('schema')
+    if schema is None:
+        group_plugin = lookup_group_plugin(group_type)
+        try:
+            schema = group_plugin.form_to_db_schema_options({
+                'type': 'create', 'api': 'api_version' in context, 'context': context})
+        except AttributeError:
+            schema = group_plugin.form_to_db_schema()
+    return 'title_translated' in schema
+
+
+def _with_translated_title(context, data_dict, group_type):
+    if (translated_title_missing(data_dict.get('title_translated'))
+            and has_translated_title(data_dict.get('type') or group_type, context)):
+        data_dict = dict(data_dict, title_translated=translated_title(data_dict))
+    return data_dict
+
+
+@toolkit.chained_action
+def organization_create(up_func, context, data_dict):
+    '''
+    Fill title_translated from the title before the organization is created
+    '''
+    return up_func(context, _with_translated_title(context, data_dict, 'organization'))
+
+
+@toolkit.chained_action
+def group_create(up_func, context, data_dict):
+    '''
+    Fill title_translated from the title before the group is created
+    '''
+    return up_func(context, _with_translated_title(context, data_dict, 'group'))
@@ -0,0 +1,130 @@
+# encoding: utf-8
+'''
+Content addressed, compressed file storage for harvested XML documents.
+
+Documents are stored once per sha256 hash of their content, so a document
+shared by several datasets, or unchanged between harvests, is only written
+once. zstandard is used for compression when it is installed, gzip otherwise.
+'''
+import gzip
+import hashlib
+import io
+import os
+import tempfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import logging
+log = logging.getLogger(__name__)
+
+REFERENCE_PREFIX = 'sha256:'
+EXTENSIONS = {
+    'zstd': '.xml.zst',
+    'gzip': '.xml.gz',
+}
+
+
+def get_storage_dir(*parts):
+    '''
+    Directory for files managed by this plugin. Uses
+    ckan.cioos_harvest_storage_path or a cioos_harvest directory in
+    ckan.storage_path
+    '''
+    # imported here so the store can be used without a ckan config
+    import ckan.plugins.toolkit as toolkit
+    base = toolkit.config.get('ckan.cioos_harvest_storage_path')
+    if not base:
+        storage_path = toolkit.config.get('ckan.storage_path')
+        if not storage_path:
+            raise RuntimeError('ckan.cioos_harvest_storage_path or ckan.storage_path must be set')
+        base = os.path.join(storage_path, 'cioos_harvest')
+    return os.path.join(base, *parts)
+
+
+def _compress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def _decompress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    with gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb') as f:
+        return f.read()
+
+
+class BlobStore(object):
+
+    def __init__(self, path, compression=None):
+        if compression == 'zstd' and zstandard is None:
+            log.warning('zstandard is not installed, harvest documents will be gzip compressed')
+            compression = 'gzip'
+        self.path = path
+        self.compression = compression or ('zstd' if zstandard else 'gzip')
+
+    def _blob_path(self, digest, compression):
+        return os.path.join(self.path, digest[:2], digest + EXTENSIONS[compression])
+
+    def _find(self, digest):
+        # blobs written with a different compression setting are still found
+        for compression in EXTENSIONS:
+            path = self._blob_path(digest, compression)
+            if os.path.exists(path):
+                return path, compression
+        return None, None
+
+    def put(self, data):
+        '''
+        Store `data` and return the reference used to retrieve it
+        '''
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path, compression = self._find(digest)
+        if path is None:
+            path = self._blob_path(digest, self.compression)
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # created by another worker in the mean time
+                    if not os.path.isdir(directory):
+                        raise
+            # write to a temporary file first so readers never see a partial blob
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(_compress(data, self.compression))
+                os.rename(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        return REFERENCE_PREFIX + digest
+
+    def get(self, reference):
+        '''
+        Return the text stored under `reference` or None if it is not found
+        '''
+        if not reference or not reference.startswith(REFERENCE_PREFIX):
+            return None
+        digest = reference[len(REFERENCE_PREFIX):]
+        path, compression = self._find(digest)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return _decompress(f.read(), compression).decode('utf-8')
+
+
+def get_document_store():
+    import ckan.plugins.toolkit as toolkit
+    return BlobStore(
+        get_storage_dir('documents'),
+        toolkit.config.get('ckan.harvest_document_compression'))
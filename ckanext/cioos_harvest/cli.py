@@ -0,0 +1,472 @@
+# encoding: utf-8
+import json
+import os
+import pstats
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from ckan import model
+import ckan.plugins.toolkit as toolkit
+
+# the commands are loaded by every ckan command, the harvesters and the
+# modules only some commands use are imported by those commands
+from ckanext.cioos_harvest import blobstore, fetch
+from ckanext.cioos_harvest.blobstore import get_storage_dir
+
+import logging
+log = logging.getLogger(__name__)
+
+REFRESH_STATE_FILE = 'refresh_documents.json'
+
+
+@click.group(name='cioos_harvest', short_help='CIOOS harvest commands')
+def cioos_harvest():
+    pass
+
+
+def get_commands():
+    return [cioos_harvest]
+
+
+@cioos_harvest.command('initdb', short_help='Create the tables of the plugin')
+def initdb():
+    '''
+    Create the table of the record identifiers imported by each harvest
+    source, used to deduplicate sources
+    '''
+    from ckanext.cioos_harvest import identifiers
+
+    identifiers.init_db()
+    click.echo('Created the %s table' % identifiers.identifier_table.name)
+
+
+def _load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_state(path, state):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp_path, path)
+
+
+def _xml_location_query():
+    return (model.Session.query(model.Package.id, model.PackageExtra.value)
+            .join(model.PackageExtra, model.PackageExtra.package_id == model.Package.id)
+            .filter(model.PackageExtra.key == 'xml_location_url')
+            .filter(model.PackageExtra.value != '')
+            .filter(model.Package.state == 'active'))
+
+
+def _iter_xml_location_batches(after_id, batch_size):
+    '''
+    Yield (package id, xml_location_url) rows in batches ordered by package id
+    '''
+    while True:
+        query = _xml_location_query().order_by(model.Package.id)
+        if after_id:
+            query = query.filter(model.Package.id > after_id)
+        rows = query.limit(batch_size).all()
+        if not rows:
+            return
+        yield rows
+        after_id = rows[-1][0]
+
+
+def _get_source_config(package_id, source_configs):
+    from ckanext.harvest.model import HarvestObject
+
+    harvest_object = (model.Session.query(HarvestObject)
+                      .filter(HarvestObject.package_id == package_id)
+                      .filter(HarvestObject.current == True)  # noqa: E712
+                      .first())
+    if harvest_object is None:
+        return {}
+    source_id = harvest_object.harvest_source_id
+    if source_id not in source_configs:
+        source_configs[source_id] = json.loads(harvest_object.source.config or '{}')
+    return source_configs[source_id]
+
+
+def _update_document(package_id, value, source_config, context):
+    '''
+    Patch the dataset if the refetched document differs from the stored one.
+    Returns True if the dataset was updated
+
+    Refetched documents are minified, documents stored by the harvest may not
+    be, so both are minified before they are compared.
+    '''
+    from ckanext.cioos_harvest import harvesters
+
+    package_dict = toolkit.get_action('package_show')(context.copy(), {'id': package_id})
+    extras = {x['key']: x['value'] for x in package_dict.get('extras', [])}
+    reference = extras.get('harvest_document_ref')
+    if reference and fetch.same_document(value, blobstore.get_document_store().get(reference)):
+        return False
+    new_extras = dict(extras)
+    content = harvesters._prepare_harvest_document(value, source_config, new_extras)
+
+    patch = {}
+    if not fetch.same_document(content, package_dict.get('harvest_document_content')):
+        patch['harvest_document_content'] = content
+    if new_extras != extras:
+        patch['extras'] = [{'key': k, 'value': v} for k, v in new_extras.items()]
+    if not patch:
+        return False
+    patch['id'] = package_id
+    toolkit.get_action('package_patch')(context.copy(), patch)
+    return True
+
+
+@cioos_harvest.command('refresh-documents', short_help='Refetch the xml documents of harvested datasets')
+@click.option('-w', '--workers', default=8, show_default=True,
+              help='Number of documents fetched at the same time')
+@click.option('-b', '--batch-size', default=100, show_default=True,
+              help='Number of datasets processed between progress checkpoints')
+@click.option('--resume', is_flag=True,
+              help='Continue after the last dataset processed by an interrupted run')
+def refresh_documents(workers, batch_size, resume):
+    '''
+    Refetch the documents at xml_location_url for all datasets that have one
+    and update harvest_document_content of the datasets whose document changed.
+    '''
+    from ckanext.cioos_harvest import harvesters
+
+    state_path = get_storage_dir(REFRESH_STATE_FILE)
+    state = _load_state(state_path) if resume else {}
+    processed = state.get('processed', 0)
+    updated = state.get('updated', 0)
+    failed = state.get('failed', 0)
+    if state.get('last_id'):
+        click.echo('Resuming after dataset %s' % state['last_id'])
+
+    total = _xml_location_query().count()
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    context = {'model': model, 'session': model.Session, 'user': site_user['name'],
+               'ignore_auth': True, 'use_cache': False}
+    # one fetch guard for the whole run so failing hosts and missing
+    # documents are only requested until the guard gives up on them
+    fetch_guard = harvesters._get_fetch_guard('refresh-documents', {})
+    source_configs = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for rows in _iter_xml_location_batches(state.get('last_id'), batch_size):
+            fetches = []
+            for package_id, xml_location_url in rows:
+                source_config = _get_source_config(package_id, source_configs)
+                fetches.append((package_id, source_config, executor.submit(
+                    harvesters._fetch_xml_location,
+                    harvesters.load_json(xml_location_url),
+                    harvesters._get_xml_url_timeout(source_config),
+                    None,
+                    fetch_guard)))
+
+            # database updates stay in this thread, the session is not thread safe
+            for package_id, source_config, future in fetches:
+                processed += 1
+                value = future.result()
+                if not value:
+                    failed += 1
+                    continue
+                try:
+                    if _update_document(package_id, value, source_config, context):
+                        updated += 1
+                except (toolkit.ValidationError, toolkit.ObjectNotFound) as e:
+                    failed += 1
+                    log.error('Unable to update dataset %s: %s', package_id, e)
+
+            _save_state(state_path, {
+                'last_id': rows[-1][0],
+                'processed': processed,
+                'updated': updated,
+                'failed': failed,
+            })
+            click.echo('%s/%s datasets processed, %s updated, %s failed' % (processed, total, updated, failed))
+
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    click.secho('Done. %s datasets processed, %s updated, %s failed' % (processed, updated, failed), fg='green')
+
+
+def _load_replay_outputs(path):
+    outputs = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                outputs[result['id']] = result
+    return outputs
+
+
+@cioos_harvest.command('replay', short_help='Run the harvest hooks over a captured corpus')
+@click.argument('corpus_path', required=False)
+@click.option('--hook', help='Only replay calls to this hook, get_package_dict, modify_package_dict or modify_search')
+@click.option('--limit', type=int, help='Maximum number of records to replay')
+@click.option('-o', '--output', type=click.Path(), help='Write the replay outputs to this NDJSON file')
+@click.option('--compare', type=click.Path(exists=True),
+              help='Compare with the outputs of an earlier replay rather then the captured outputs')
+@click.option('--show-diffs', default=10, show_default=True,
+              help='Number of changed records to list')
+def replay_corpus(corpus_path, hook, limit, output, compare, show_diffs):
+    '''
+    Run the harvest hooks over the records captured in CORPUS_PATH, by
+    default the capture directory, and report throughput and the records
+    whose output changed.
+    '''
+    from ckanext.cioos_harvest import replay
+
+    if hook and hook not in replay.HOOKS:
+        raise click.BadParameter('must be one of %s' % ', '.join(replay.HOOKS), param_hint='--hook')
+    corpus = replay.Corpus(corpus_path or replay.get_capture_dir())
+    baseline = _load_replay_outputs(compare) if compare else None
+    stats = {}
+    changed = []
+    output_file = open(output, 'w') if output else None
+    try:
+        for record, result in replay.replay(corpus, hook, limit):
+            hook_stats = stats.setdefault(result['hook'], {'records': 0, 'errors': 0, 'changed': 0, 'seconds': 0.0})
+            hook_stats['records'] += 1
+            hook_stats['seconds'] += result['seconds']
+            if 'error' in result:
+                hook_stats['errors'] += 1
+            expected = baseline.get(result['id'], {}) if baseline is not None else record
+            differences = list(replay.diff(
+                {'output': expected.get('output'), 'error': expected.get('error')},
+                {'output': result.get('output'), 'error': result.get('error')}))
+            if differences:
+                hook_stats['changed'] += 1
+                if len(changed) < show_diffs:
+                    changed.append((result, differences))
+            if output_file:
+                output_file.write(json.dumps(result) + '\n')
+    finally:
+        if output_file:
+            output_file.close()
+
+    for hook_name, hook_stats in sorted(stats.items()):
+        rate = hook_stats['records'] / hook_stats['seconds'] if hook_stats['seconds'] else 0
+        click.echo('%s: %s records in %.2fs (%.1f records/s), %s errors, %s changed' % (
+            hook_name, hook_stats['records'], hook_stats['seconds'], rate,
+            hook_stats['errors'], hook_stats['changed']))
+    for result, differences in changed:
+        click.echo('%s %s' % (result['hook'], result['id']))
+        for path in differences[:10]:
+            click.echo('    %s' % path)
+        if len(differences) > 10:
+            click.echo('    ... %s more' % (len(differences) - 10))
+        if result.get('error'):
+            click.echo('    error: %s' % result['error'])
+
+
+@cioos_harvest.command('loadtest', short_help='Harvest a local fake portal and report throughput')
+@click.option('--harvester', 'source_type', default='ckan_cioos', show_default=True,
+              type=click.Choice(['ckan_cioos', 'ckan_spatial', 'waf']),
+              help='Harvester type of the harvest source')
+@click.option('--datasets', default=1000, show_default=True, help='Number of datasets in the fake portal')
+@click.option('--page-size', default=100, show_default=True, help='Maximum rows per search page')
+@click.option('--latency', default=0.0, show_default=True, help='Seconds added to each request')
+@click.option('--error-rate', default=0.0, show_default=True, help='Fraction of requests that fail with a 500 error')
+@click.option('--resources', default=2, show_default=True, help='Resources per dataset')
+@click.option('--spatial-fraction', default=0.5, show_default=True,
+              help='Fraction of datasets returned by the spatial search')
+@click.option('--cycles', default=1, show_default=True, help='Number of harvest jobs to run')
+@click.option('--config', 'source_config', default='{}', help='Harvest source config as JSON')
+@click.option('--organization', help='Owner organization of the harvest source')
+@click.option('--port', default=0, help='Port of the fake portal, a free port by default')
+@click.option('--keep', is_flag=True, help='Keep the harvest source and its datasets')
+@click.option('--serve-only', is_flag=True,
+              help='Only run the fake portal, for harvesting it with the regular workers')
+def loadtest_command(source_type, datasets, page_size, latency, error_rate, resources,
+                     spatial_fraction, cycles, source_config, organization, port, keep, serve_only):
+    '''
+    Run harvest jobs against a local fake CKAN portal and WAF server and report
+    the end to end throughput of each job.
+    '''
+    from ckanext.cioos_harvest import loadtest
+
+    source_config = json.loads(source_config)
+    if source_type == 'ckan_spatial':
+        source_config.setdefault('spatial_filter', 'BOX(-180,-90,180,90)')
+    portal = loadtest.FakePortal(
+        datasets=datasets, page_size=page_size, latency=latency, error_rate=error_rate,
+        resources=resources, spatial_fraction=spatial_fraction, port=port)
+    with portal:
+        click.echo('Fake portal serving on %s' % portal.url)
+        if serve_only:
+            click.echo('CKAN search at %s, WAF at %s/waf/. Press Ctrl-C to stop.' % (portal.url, portal.url))
+            try:
+                while True:
+                    time.sleep(60)
+            except KeyboardInterrupt:
+                return
+
+        for stats in loadtest.run_load_test(portal, source_type, cycles, source_config, organization, keep):
+            rate = stats['objects'] / stats['total_seconds'] if stats['total_seconds'] else 0
+            click.echo('Cycle %s: %s objects in %.1fs (%.1f objects/s)' % (
+                stats['cycle'], stats['objects'], stats['total_seconds'], rate))
+            click.echo('    gather %.1fs, fetch and import %.1fs, finish %.1fs' % (
+                stats['gather_seconds'], stats['import_seconds'], stats['finish_seconds']))
+            click.echo('    %s requests to the fake portal, %s injected errors' % (
+                stats['requests'], stats['request_errors']))
+            click.echo('    ' + ', '.join('%s: %s' % item for item in sorted(stats['report_status'].items())))
+
+
+@cioos_harvest.command('fetch-stats', short_help='Show the response times of external XML hosts')
+@click.option('--json', 'as_json', is_flag=True, help='Print the stats as JSON')
+def fetch_stats(as_json):
+    '''
+    Show the response times recorded by the harvest workers for each host
+    serving external XML documents, and the timeout currently used for it.
+    '''
+    from ckanext.cioos_harvest import harvesters
+
+    policy = harvesters._get_xml_url_timeout({})
+    if policy.tracker is None:
+        click.echo('Adaptive external XML timeouts are disabled')
+        return
+    stats = policy.tracker.stats()
+    for host, host_stats in stats.items():
+        host_stats['timeout'] = policy.timeout(host)
+    if as_json:
+        click.echo(json.dumps(stats, indent=2, sort_keys=True))
+        return
+    if not stats:
+        click.echo('No external XML fetches recorded')
+        return
+    click.echo('%-40s %8s %8s %8s %8s %8s %8s' % ('host', 'samples', 'p50', 'p95', 'max', 'timeouts', 'timeout'))
+    for host, host_stats in sorted(stats.items()):
+        click.echo('%-40s %8s %8.2f %8.2f %8.2f %8s %8.2f' % (
+            host, host_stats['samples'], host_stats['p50'], host_stats['p95'], host_stats['max'],
+            host_stats['timeouts'], host_stats['timeout']))
+
+
+@cioos_harvest.command('profile-summary', short_help='Summarize the harvest hook profiles')
+@click.argument('profile_dir', required=False)
+@click.option('--limit', default=25, show_default=True, help='Number of functions to list')
+@click.option('--sort', default='cumulative', show_default=True,
+              type=click.Choice(['cumulative', 'tottime', 'ncalls']),
+              help='Sort order of the cProfile report')
+def profile_summary(profile_dir, limit, sort):
+    '''
+    Merge the harvest hook profiles in PROFILE_DIR, by default the profiles
+    directory, into a report of the functions that took the most time.
+    '''
+    from ckanext.cioos_harvest import profiling
+
+    profile_dir = profile_dir or profiling.get_profile_dir()
+    prof_files = profiling.profile_files(profile_dir, 'prof')
+    stack_files = profiling.profile_files(profile_dir, 'stacks')
+    if not prof_files and not stack_files:
+        click.echo('No profiles found in %s' % profile_dir)
+        return
+
+    if prof_files:
+        click.echo('cProfile of %s sampled hook calls:' % len(prof_files))
+        stats = pstats.Stats(prof_files[0], stream=click.get_text_stream('stdout'))
+        for path in prof_files[1:]:
+            stats.add(path)
+        stats.sort_stats(sort).print_stats(limit)
+
+    if stack_files:
+        own, total = profiling.merge_stacks(stack_files)
+        samples = sum(own.values())
+        click.echo('Stack samples of %s slow hook calls, %s samples:' % (len(stack_files), samples))
+        click.echo('%8s %8s  %s' % ('own %', 'total %', 'function'))
+        for frame, count in total.most_common(limit):
+            click.echo('%8.1f %8.1f  %s' % (100.0 * own[frame] / samples, 100.0 * count / samples, frame))
+
+
+def _iter_group_batches(batch_size):
+    '''
+    Yield batches of active organizations and groups ordered by id
+    '''
+    last_id = ''
+    while True:
+        groups = (model.Session.query(model.Group)
+                  .filter(model.Group.state == 'active')
+                  .filter(model.Group.id > last_id)
+                  .order_by(model.Group.id)
+                  .limit(batch_size).all())
+        if not groups:
+            return
+        yield groups
+        last_id = groups[-1].id
+
+
+@cioos_harvest.command('fetch-consumer', short_help='Start the fetch queue consumer, recycling it when its memory grows')
+def fetch_consumer():
+    '''
+    Same as `ckan harvester fetch-consumer`. With ckan.harvest_memory_recycle_mb
+    set, the worker exits between two harvest objects once its memory grew
+    past the limit, for the process supervisor to start a new one.
+    '''
+    from ckanext.harvest.queue import fetch_callback, get_fetch_consumer, get_fetch_queue_name
+    from ckanext.cioos_harvest import memory
+
+    logging.getLogger('amqplib').setLevel(logging.INFO)
+    consumer = get_fetch_consumer()
+    memory.recycle_if_requested()
+    for method, header, body in consumer.consume(queue=get_fetch_queue_name()):
+        fetch_callback(consumer, method, header, body)
+        # the object has been acknowledged and the next one is not taken
+        # from the queue until the loop continues
+        memory.recycle_if_requested()
+
+
+@cioos_harvest.command('backfill-translations', short_help='Fill title_translated of existing organizations and groups')
+@click.option('--batch-size', default=500, show_default=True, help='Organizations and groups updated per transaction')
+@click.option('--dry-run', is_flag=True, help='Only count the organizations and groups that need updating')
+def backfill_translations(batch_size, dry_run):
+    '''
+    Set title_translated of organizations and groups that have none from
+    their title, as organization_create and group_create do for new ones.
+    Only types whose schema has a title_translated field are updated. Each
+    batch is written in one transaction, without creating activities.
+    '''
+    from ckanext.cioos_harvest import actions
+
+    translated_types = {}
+    updated = 0
+    for groups in _iter_group_batches(batch_size):
+        for group in groups:
+            if group.type not in translated_types:
+                translated_types[group.type] = actions.has_translated_title(group.type)
+        groups = [group for group in groups if translated_types[group.type]]
+        if not groups:
+            continue
+        extras = dict(
+            (extra.group_id, extra) for extra in model.Session.query(model.GroupExtra)
+            .filter(model.GroupExtra.group_id.in_([group.id for group in groups]))
+            .filter(model.GroupExtra.key == 'title_translated'))
+        missing = 0
+        for group in groups:
+            extra = extras.get(group.id)
+            if extra is not None and extra.state == 'active' and not actions.translated_title_missing(extra.value):
+                continue
+            missing += 1
+            if dry_run:
+                continue
+            value = json.dumps(actions.translated_title({'title': group.title, 'name': group.name}))
+            if extra is None:
+                model.Session.add(model.GroupExtra(group_id=group.id, key='title_translated', value=value, state='active'))
+            else:
+                extra.value = value
+                extra.state = 'active'
+        if not dry_run:
+            model.Session.commit()
+        else:
+            model.Session.rollback()
+        updated += missing
+        if missing:
+            click.echo('%s %s organizations and groups, up to %s' % (
+                'Found' if dry_run else 'Updated', missing, groups[-1].name))
+    click.secho('Done. %s organizations and groups %s' % (updated, 'need updating' if dry_run else 'updated'), fg='green')
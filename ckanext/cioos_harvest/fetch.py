@@ -0,0 +1,428 @@
+# encoding: utf-8
+'''
+Job scoped bookkeeping for external XML fetches.
+
+A harvest job whose records reference XML documents on an unreachable host
+would otherwise wait the full read timeout for every record. The guards kept
+here short-circuit fetches to a host after repeated failures and remember
+urls that returned a 404 for the rest of the job.
+
+The response time of each host is also tracked, per worker process, so the
+timeout of a fetch can follow what is normal for the host: a slow but
+healthy WAF server gets a longer timeout, a host that normally answers
+quickly gets a short one. Each worker saves the response times it recorded
+in the plugin storage directory, so new workers start from them and they can
+be inspected with `ckan cioos_harvest fetch-stats`. The stats of a worker
+that exited are taken over by the next one that starts on the same host.
+
+The fetched documents are minified, and bundled in a single `<docs>`
+document when a record references several, by the helpers at the end.
+'''
+import atexit
+import errno
+import glob
+import json
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+
+from six.moves.urllib.parse import urlparse
+
+import logging
+log = logging.getLogger(__name__)
+
+# number of jobs a worker keeps fetch state for. Import workers can process
+# objects from several jobs at the same time so we can not keep just one.
+MAX_TRACKED_JOBS = 10
+
+# response times kept per host
+LATENCY_WINDOW = 200
+# samples needed before the timeout of a host is derived from its latency
+MIN_LATENCY_SAMPLES = 5
+# seconds between saves of the latency stats
+SAVE_INTERVAL = 60
+# saved stats of workers that have not updated them for this many seconds
+# are ignored and removed
+STALE_STATS_AGE = 7 * 24 * 3600
+
+XML_BUNDLE_HEADER = '<?xml version="1.0" encoding="utf-8"?>'
+_XML_DECLARATION = re.compile(r'^\s*<\?xml\s.*?\?>', re.S)
+_DOCTYPE = re.compile(r'<!DOCTYPE[^\[>]*(\[.*?\]\s*)?>', re.S)
+_ELEMENT_START = re.compile(r'<[^!?]')
+
+_fetch_guards = OrderedDict()
+_latency_tracker = []
+
+
+def url_host(url):
+    return urlparse(url).netloc.lower()
+
+
+class HostCircuitBreaker(object):
+    '''
+    Counts consecutive failures per host. Once a host reaches
+    `failure_threshold` failures the breaker opens and fetches to that host
+    are refused for `cooldown` seconds. After the cool-down one request is let
+    through, if it fails the breaker opens again straight away.
+
+    Safe to share between threads.
+    '''
+
+    def __init__(self, failure_threshold=3, cooldown=300):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = {}
+        self._open_until = {}
+        self._lock = threading.Lock()
+        self.skipped = {}
+
+    def allow(self, host, now=None):
+        with self._lock:
+            open_until = self._open_until.get(host)
+            if open_until is None:
+                return True
+            now = time.time() if now is None else now
+            if now >= open_until:
+                del self._open_until[host]
+                self._failures[host] = self.failure_threshold - 1
+                return True
+            self.skipped[host] = self.skipped.get(host, 0) + 1
+            return False
+
+    def record_success(self, host):
+        with self._lock:
+            self._failures.pop(host, None)
+
+    def record_failure(self, host, now=None):
+        '''
+        Record a failed fetch. Returns True if this failure opened the breaker
+        '''
+        with self._lock:
+            count = self._failures.get(host, 0) + 1
+            if count < self.failure_threshold:
+                self._failures[host] = count
+                return False
+            self._failures.pop(host, None)
+            now = time.time() if now is None else now
+            self._open_until[host] = now + self.cooldown
+            return True
+
+    def is_open(self, host):
+        return host in self._open_until
+
+
+class XmlFetchGuard(object):
+    '''
+    Circuit breaker and negative cache shared by all records of a harvest job
+    '''
+
+    def __init__(self, failure_threshold=3, cooldown=300):
+        self.breaker = HostCircuitBreaker(failure_threshold, cooldown)
+        self.missing_urls = set()
+
+    def is_missing(self, url):
+        return url in self.missing_urls
+
+    def record_missing(self, url):
+        self.missing_urls.add(url)
+
+
+def get_fetch_guard(job_id, failure_threshold=3, cooldown=300):
+    guard = _fetch_guards.get(job_id)
+    if guard is None:
+        guard = XmlFetchGuard(failure_threshold, cooldown)
+        _fetch_guards[job_id] = guard
+        while len(_fetch_guards) > MAX_TRACKED_JOBS:
+            _fetch_guards.popitem(last=False)
+    return guard
+
+
+def percentile(values, pct):
+    '''
+    Nearest rank percentile of a list of numbers
+    '''
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+class LatencyTracker(object):
+    '''
+    Recent response times per host. A request that timed out counts as a
+    response that took as long as the timeout. Safe to share between
+    threads.
+
+    The samples recorded by this process are kept apart from those loaded
+    from the files of the other workers, only the former are saved, so a
+    sample is in one file only however often the workers restart.
+    '''
+
+    def __init__(self, path=None, window=LATENCY_WINDOW):
+        self.path = path
+        self.window = window
+        # recorded by this process, or taken over from a worker that exited
+        self._own_samples = {}
+        self._own_timeouts = {}
+        # own samples and those of the other workers, used for the timeouts
+        self._samples = {}
+        self._timeouts = {}
+        self._lock = threading.Lock()
+        self._saved = time.time()
+
+    def _host_samples(self, samples_by_host, host):
+        samples = samples_by_host.get(host)
+        if samples is None:
+            samples = samples_by_host[host] = deque(maxlen=self.window)
+        return samples
+
+    def _add(self, samples_by_host, timeouts_by_host, samples, timeouts):
+        for host, host_samples in samples.items():
+            self._host_samples(samples_by_host, host).extend(host_samples)
+        for host, count in timeouts.items():
+            timeouts_by_host[host] = timeouts_by_host.get(host, 0) + count
+
+    def record(self, host, seconds):
+        with self._lock:
+            self._host_samples(self._own_samples, host).append(seconds)
+            self._host_samples(self._samples, host).append(seconds)
+        self._save_if_due()
+
+    def record_timeout(self, host, timeout):
+        with self._lock:
+            self._host_samples(self._own_samples, host).append(timeout)
+            self._host_samples(self._samples, host).append(timeout)
+            for timeouts in (self._own_timeouts, self._timeouts):
+                timeouts[host] = timeouts.get(host, 0) + 1
+        self._save_if_due()
+
+    def samples(self, host):
+        with self._lock:
+            return list(self._samples.get(host, ()))
+
+    def stats(self):
+        '''
+        Latency summary per host, in seconds
+        '''
+        with self._lock:
+            hosts = dict((host, list(samples)) for host, samples in self._samples.items() if samples)
+            timeouts = dict(self._timeouts)
+        return dict((host, {
+            'samples': len(samples),
+            'p50': percentile(samples, 50),
+            'p95': percentile(samples, 95),
+            'max': max(samples) if samples else None,
+            'timeouts': timeouts.get(host, 0),
+        }) for host, samples in hosts.items())
+
+    def _file_path(self):
+        return os.path.join(self.path, '%s.%s.json' % (socket.gethostname(), os.getpid()))
+
+    def _save_if_due(self):
+        if self.path and time.time() - self._saved > SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        '''
+        Write the samples of this process to its file in `path`
+        '''
+        if not self.path:
+            return
+        with self._lock:
+            self._saved = time.time()
+            data = {
+                'samples': dict((host, list(samples)) for host, samples in self._own_samples.items()),
+                'timeouts': dict(self._own_timeouts),
+            }
+        if not data['samples'] and not data['timeouts']:
+            return
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp_path, self._file_path())
+        except (IOError, OSError) as e:
+            log.warning('Unable to save external XML latency stats: %s', e)
+
+    def _read(self, path, take_over):
+        '''
+        The stats saved in `path`. With `take_over` the file is first moved
+        out of the way, so only one worker takes over the samples of a
+        worker that exited, and removed once read.
+        '''
+        if take_over:
+            claimed_path = '%s.%s' % (path, os.getpid())
+            os.rename(path, claimed_path)
+            try:
+                with open(claimed_path) as f:
+                    return json.load(f)
+            finally:
+                os.remove(claimed_path)
+        with open(path) as f:
+            return json.load(f)
+
+    def load(self):
+        '''
+        Replace the stats of the other workers in this tracker by those they
+        last saved. The samples of workers that exited are taken over, their
+        files removed.
+        '''
+        if not self.path:
+            return
+        now = time.time()
+        own_path = self._file_path()
+        saved = []
+        for path in glob.glob(os.path.join(self.path, '*.json')):
+            if path == own_path:
+                # left by an earlier process with the same pid, unless this
+                # one already saved its samples there
+                with self._lock:
+                    take_over = not self._own_samples and not self._own_timeouts
+                if not take_over:
+                    continue
+            else:
+                take_over = not _worker_running(os.path.basename(path)[:-len('.json')])
+            try:
+                if now - os.path.getmtime(path) > STALE_STATS_AGE:
+                    os.remove(path)
+                    continue
+                data = self._read(path, take_over)
+            except (IOError, OSError, ValueError) as e:
+                log.debug('Unable to read external XML latency stats %s: %s', path, e)
+                continue
+            saved.append((take_over, data.get('samples', {}), data.get('timeouts', {})))
+
+        with self._lock:
+            samples, timeouts = {}, {}
+            for take_over, worker_samples, worker_timeouts in saved:
+                if take_over:
+                    self._add(self._own_samples, self._own_timeouts, worker_samples, worker_timeouts)
+                else:
+                    self._add(samples, timeouts, worker_samples, worker_timeouts)
+            self._add(samples, timeouts, self._own_samples, self._own_timeouts)
+            self._samples, self._timeouts = samples, timeouts
+
+
+def _worker_running(name):
+    '''
+    False if the `<hostname>.<pid>` worker that saved stats under `name`
+    ran on this host and exited. Workers on other hosts are assumed to be
+    running, their files are removed once stale.
+    '''
+    hostname, _, pid = name.rpartition('.')
+    if hostname != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ValueError:
+        return True
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def get_latency_tracker(path=None):
+    '''
+    The latency tracker of this process, loaded from the stats saved in
+    `path` the first time it is requested
+    '''
+    if not _latency_tracker:
+        tracker = LatencyTracker(path)
+        tracker.load()
+        atexit.register(tracker.save)
+        _latency_tracker.append(tracker)
+    return _latency_tracker[0]
+
+
+class TimeoutPolicy(object):
+    '''
+    Timeouts for the external XML fetches of a harvest source. With
+    `adaptive` set the timeout for a host is `multiplier` times the
+    `pct` percentile of its response times, bounded by `minimum` and
+    `maximum`. Hosts with too few samples get the `default` timeout. All
+    values are in seconds. `budget` caps the total time spent fetching the
+    documents of one record.
+    '''
+
+    def __init__(self, default, minimum=None, maximum=None, pct=95, multiplier=2.0,
+                 budget=None, adaptive=True, tracker=None):
+        self.default = default
+        self.minimum = minimum if minimum is not None else default
+        self.maximum = maximum if maximum is not None else default
+        self.pct = pct
+        self.multiplier = multiplier
+        self.budget = budget
+        self.adaptive = adaptive
+        self.tracker = tracker
+
+    def _clamp(self, timeout):
+        return max(self.minimum, min(self.maximum, timeout))
+
+    def timeout(self, host):
+        if not self.adaptive or self.tracker is None:
+            return self.default
+        samples = self.tracker.samples(host)
+        if len(samples) < MIN_LATENCY_SAMPLES:
+            return self._clamp(self.default)
+        return self._clamp(percentile(samples, self.pct) * self.multiplier)
+
+    def deadline(self):
+        '''
+        Time by which the documents of a record must be fetched, or None
+        '''
+        return time.time() + self.budget if self.budget else None
+
+    def record(self, host, seconds):
+        if self.tracker is not None:
+            self.tracker.record(host, seconds)
+
+    def record_timeout(self, host, timeout):
+        if self.tracker is not None:
+            self.tracker.record_timeout(host, timeout)
+
+
+def strip_prolog(document):
+    '''
+    `document` without its xml declaration and doctype, which are only
+    allowed at the start of a document
+    '''
+    document = _XML_DECLARATION.sub('', document.lstrip(u'\ufeff'), count=1)
+    doctype = _DOCTYPE.search(document)
+    if doctype and not _ELEMENT_START.search(document, 0, doctype.start()):
+        document = document[:doctype.start()] + document[doctype.end():]
+    return document.strip()
+
+
+def bundle_documents(documents):
+    '''
+    One xml document with each of `documents` in a `<doc>` element of a
+    `<docs>` root element
+    '''
+    return XML_BUNDLE_HEADER + '<docs>' + ''.join(
+        '<doc>' + strip_prolog(document) + '</doc>' for document in documents) + '</docs>'
+
+
+def minify_xml(value):
+    '''
+    Remove extra white space from an xml document
+    '''
+    value = re.sub(r'\s+', ' ', value)
+    value = re.sub('> <', '><', value)
+    value = re.sub('> ', '>', value)
+    value = re.sub(' <', '<', value)
+    return value
+
+
+def same_document(document, other):
+    '''
+    True if two documents, xml or their search text, are the same once
+    minified
+    '''
+    return minify_xml(document or '') == minify_xml(other or '')
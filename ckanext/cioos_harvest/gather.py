@@ -0,0 +1,388 @@
+# encoding: utf-8
+'''
+Page by page gather stage for the CKAN harvesters.
+
+ckanext-harvest's CKANHarvester collects every remote package dict before any
+harvest objects are created, which keeps the whole remote catalogue in memory
+during the gather. Here each page of search results is filtered and turned
+into harvest objects before the next page is requested.
+
+After each page the searches left and the offset of the next page are saved
+in a checkpoint file for the harvest source. If the gather worker dies part
+way through a large remote catalogue the message queue delivers the job
+again, and the gather resumes from the checkpoint instead of paging from the
+start. Harvest objects already created for the job are kept and no second
+object is created for their datasets. When paging stops on an error the
+checkpoint is kept too, and the next job of the source gathers the pages
+that were left, then the datasets changed since the interrupted gather
+started.
+'''
+import datetime
+import itertools
+import json
+import os
+import time
+
+from six.moves.urllib.parse import urlencode
+
+from ckan import model
+import ckan.plugins.toolkit as toolkit
+from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.harvesters.ckanharvester import ContentFetchError, SearchError
+
+from ckanext.cioos_harvest import scheduling
+from ckanext.cioos_harvest.blobstore import get_storage_dir
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 100
+# checkpoints of jobs that were never resumed are removed after this many seconds
+STALE_CHECKPOINT_AGE = 7 * 24 * 3600
+
+
+def checkpoint_enabled(source_config):
+    return toolkit.asbool(source_config.get('gather_checkpoint', toolkit.config.get('ckan.harvest_gather_checkpoint', True)))
+
+
+def _modified_since(started):
+    # Going back a little earlier, just in case the local and remote
+    # clocks are not in sync.
+    return 'metadata_modified:[{since}Z TO *]'.format(since=(started - datetime.timedelta(hours=1)).isoformat())
+
+
+class GatherCheckpoint(object):
+    '''
+    Progress of the gather of a harvest source, kept in the `gather`
+    directory of the plugin storage directory. The state is the job that
+    saved it, the searches left as [fq terms, start] pairs, and when the
+    first of the gathers it continues started.
+    '''
+
+    def __init__(self, source_id, job_id, directory):
+        self.source_id = source_id
+        self.job_id = job_id
+        self.directory = directory
+        self.path = os.path.join(directory, '%s.json' % source_id)
+
+    @classmethod
+    def for_job(cls, harvest_job, source_config):
+        '''
+        The checkpoint of the source of a job, or None if checkpoints are
+        disabled or there is no storage directory
+        '''
+        if not checkpoint_enabled(source_config):
+            return None
+        try:
+            directory = get_storage_dir('gather')
+        except RuntimeError as e:
+            log.debug('Gather checkpoints disabled: %s', e)
+            return None
+        return cls(harvest_job.source.id, harvest_job.id, directory)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            log.warning('Unable to read gather checkpoint %s: %s', self.path, e)
+            return None
+        if state.get('source_id') != self.source_id or not state.get('searches'):
+            return None
+        if time.time() - state.get('saved', 0) > STALE_CHECKPOINT_AGE:
+            return None
+        return state
+
+    def save(self, searches, started):
+        state = {'source_id': self.source_id, 'job_id': self.job_id, 'searches': searches,
+                 'started': started, 'saved': time.time()}
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            log.warning('Unable to save gather checkpoint %s: %s', self.path, e)
+
+    def remove(self):
+        now = time.time()
+        for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            path = os.path.join(self.directory, name)
+            try:
+                if path == self.path or now - os.path.getmtime(path) > STALE_CHECKPOINT_AGE:
+                    os.remove(path)
+            except (IOError, OSError) as e:
+                log.debug('Unable to remove gather checkpoint %s: %s', path, e)
+
+
+def _existing_harvest_objects(harvest_job):
+    '''
+    guid and id of the harvest objects a previous run of the gather of this
+    job created that have not been picked up by a fetch worker
+    '''
+    return dict(model.Session.query(HarvestObject.guid, HarvestObject.id)
+                .filter(HarvestObject.harvest_job_id == harvest_job.id)
+                .filter(HarvestObject.state == 'WAITING'))
+
+
+class StreamingGatherMixin(object):
+    '''
+    Gather stage for CKANHarvester subclasses that works one page of remote
+    search results at a time. `modify_search`, if the harvester has one, is
+    called with each page rather then with the full result list.
+    '''
+
+    def _get_gather_fq_terms(self):
+        # Filter in/out datasets from particular organizations or groups
+        fq_terms = []
+        org_filter_include = self.config.get('organizations_filter_include', [])
+        org_filter_exclude = self.config.get('organizations_filter_exclude', [])
+        if org_filter_include:
+            fq_terms.append(' OR '.join(
+                'organization:%s' % org_name for org_name in org_filter_include))
+        elif org_filter_exclude:
+            fq_terms.extend(
+                '-organization:%s' % org_name for org_name in org_filter_exclude)
+
+        groups_filter_include = self.config.get('groups_filter_include', [])
+        groups_filter_exclude = self.config.get('groups_filter_exclude', [])
+        if groups_filter_include:
+            fq_terms.append(' OR '.join(
+                'groups:%s' % group_name for group_name in groups_filter_include))
+        elif groups_filter_exclude:
+            fq_terms.extend(
+                '-groups:%s' % group_name for group_name in groups_filter_exclude)
+        return fq_terms
+
+    def _iter_search_pages(self, remote_ckan_base_url, searches, cursor, seen):
+        '''
+        Pages of each of the [fq terms, start] `searches` in turn. `cursor`
+        holds the searches left, the first one at the offset of its next
+        page.
+        '''
+        for index, (fq_terms, start) in enumerate(searches):
+            cursor['searches'] = searches[index + 1:]
+            cursor['fq_terms'] = fq_terms
+            cursor['start'] = start
+            for page in self._search_for_dataset_pages(remote_ckan_base_url, fq_terms, cursor, seen):
+                yield page
+
+    def _peek_dataset_pages(self, remote_ckan_base_url, searches, cursor, seen):
+        '''
+        Start paging through the remote searches. The first page is requested
+        straight away so search errors are raised here and not half way
+        through creating harvest objects. Returns the pages and whether there
+        were any results, the first page can be empty when all its datasets
+        were already seen.
+        '''
+        pages = self._iter_search_pages(remote_ckan_base_url, searches, cursor, seen)
+        first_page = next(pages, None)
+        if first_page is None:
+            return iter([]), False
+        return itertools.chain([first_page], pages), True
+
+    def gather_stage(self, harvest_job):
+        log.debug('In %s gather_stage (%s)',
+                  self.__class__.__name__, harvest_job.source.url)
+        toolkit.requires_ckan_version(min_version='2.0')
+        self._set_config(harvest_job.source.config)
+
+        remote_ckan_base_url = harvest_job.source.url.rstrip('/')
+        fq_terms = self._get_gather_fq_terms()
+        pages = None
+        cursor = {}
+        started = harvest_job.gather_started.isoformat() if harvest_job.gather_started else None
+
+        checkpoint = GatherCheckpoint.for_job(harvest_job, self.config)
+        existing = {}
+        state = checkpoint.load() if checkpoint else None
+        if state:
+            searches = state['searches']
+            if state['job_id'] == harvest_job.id:
+                existing = _existing_harvest_objects(harvest_job)
+                log.info('Resuming the gather of job %s at offset %s, %s harvest objects were already created',
+                         harvest_job.id, searches[0][1], len(existing))
+            else:
+                # the datasets on the pages the interrupted gather did get
+                # may have changed since
+                log.info('Continuing the gather of job %s at offset %s', state['job_id'], searches[0][1])
+                if state['started']:
+                    searches = searches + [[fq_terms + [_modified_since(
+                        datetime.datetime.strptime(state['started'][:19], '%Y-%m-%dT%H:%M:%S'))], 0]]
+            try:
+                pages, has_results = self._peek_dataset_pages(
+                    remote_ckan_base_url, searches, cursor, set(existing))
+            except SearchError as e:
+                log.info('Resuming the gather gave an error, starting over: %s', e)
+                pages = None
+            else:
+                started = state['started']
+                if not has_results:
+                    checkpoint.remove()
+                    return list(existing.values())
+
+        # Ideally we can request from the remote CKAN only those datasets
+        # modified since the last completely successful harvest.
+        last_error_free_job = self.last_error_free_job(harvest_job)
+        log.debug('Last error-free job: %r', last_error_free_job)
+        if pages is None and last_error_free_job and not self.config.get('force_all', False):
+            last_time = last_error_free_job.gather_started
+            search_fq_terms = fq_terms + [_modified_since(last_time)]
+            log.info('Searching for datasets modified since: %s UTC', last_time - datetime.timedelta(hours=1))
+
+            try:
+                pages, has_results = self._peek_dataset_pages(
+                    remote_ckan_base_url, [[search_fq_terms, 0]], cursor, set(existing))
+            except SearchError as e:
+                log.info('Searching for datasets changed since last time '
+                         'gave an error: %s', e)
+                pages = None
+            else:
+                if not has_results and not existing:
+                    log.info('No datasets have been updated on the remote '
+                             'CKAN instance since the last harvest job %s',
+                             last_time)
+                    if checkpoint:
+                        checkpoint.remove()
+                    return []
+
+        # Fall-back option - request all the datasets from the remote CKAN
+        if pages is None:
+            try:
+                pages, has_results = self._peek_dataset_pages(
+                    remote_ckan_base_url, [[fq_terms, 0]], cursor, set(existing))
+            except SearchError as e:
+                log.info('Searching for all datasets gave an error: %s', e)
+                self._save_gather_error(
+                    'Unable to search remote CKAN for datasets:%s url:%s'
+                    'terms:%s' % (e, remote_ckan_base_url, fq_terms),
+                    harvest_job)
+                return None
+            if not has_results and not existing:
+                self._save_gather_error(
+                    'No datasets found at CKAN: %s' % remote_ckan_base_url,
+                    harvest_job)
+                if checkpoint:
+                    checkpoint.remove()
+                return []
+
+        modify_search = getattr(self, 'modify_search', None)
+        scheduler = None
+        if scheduling.schedule_mode(self.config) == 'cost':
+            scheduler = scheduling.Scheduler(harvest_job.source.id, self.config)
+        object_ids = []
+        completed = False
+        try:
+            for page in pages:
+                if page and modify_search:
+                    page = modify_search(page, remote_ckan_base_url, cursor['fq_terms'])
+                page_object_ids = self._create_page_harvest_objects(page, harvest_job)
+                if scheduler:
+                    scheduler.add_page(page, page_object_ids)
+                object_ids.extend(page_object_ids)
+                # release the package dicts before the next page is requested
+                del page
+                if checkpoint:
+                    checkpoint.save([[cursor['fq_terms'], cursor['start']]] + cursor['searches'], started)
+            completed = True
+        except SearchError as e:
+            self._save_gather_error(
+                'Unable to search remote CKAN for datasets:%s url:%s'
+                'terms:%s' % (e, remote_ckan_base_url, cursor.get('fq_terms')),
+                harvest_job)
+        except Exception as e:
+            log.exception(e)
+            self._save_gather_error('%r' % e, harvest_job)
+
+        # objects from pages processed before an error are already saved so
+        # they are returned either way, the checkpoint is kept for the pages
+        # that are left
+        log.info('Created %s harvest objects for %s', len(object_ids), remote_ckan_base_url)
+        if checkpoint and completed:
+            checkpoint.remove()
+        if scheduler:
+            # the objects are queued in the order they are returned
+            object_ids = scheduler.order(object_ids)
+        # objects created by an earlier run of this gather
+        return object_ids + list(existing.values())
+
+    def _search_for_dataset_pages(self, remote_ckan_base_url, fq_terms=None, cursor=None, seen=None):
+        '''
+        Generator over the pages of a dataset search on a remote CKAN. Datasets
+        already seen on previous pages, or in `seen`, are removed, they show up
+        if datasets are added to the remote while we are paging through it.
+        A page can be empty once they are, paging ends when the remote
+        returns no results. `seen` is updated with the ids of each page.
+        Paging starts at `cursor['start']`, which is moved to the offset of the
+        next page as each page is returned.
+        '''
+        if cursor is None:
+            cursor = {'start': 0}
+        base_search_url = remote_ckan_base_url + self._get_search_api_offset()
+        rows = int(self.config.get('page_size') or DEFAULT_PAGE_SIZE)
+        params = {'rows': str(rows), 'start': str(cursor['start']), 'sort': 'id asc'}
+        if fq_terms:
+            params['fq'] = ' '.join(fq_terms)
+
+        pkg_ids = seen if seen is not None else set()
+        previous_content = None
+        while True:
+            url = base_search_url + '?' + urlencode(params)
+            log.debug('Searching for CKAN datasets: %s', url)
+            try:
+                content = self._get_content(url)
+            except ContentFetchError as e:
+                raise SearchError(
+                    'Error sending request to search remote '
+                    'CKAN instance %s using URL %r. Error: %s' %
+                    (remote_ckan_base_url, url, e))
+
+            if previous_content and content == previous_content:
+                raise SearchError('The paging doesn\'t seem to work. URL: %s' % url)
+            previous_content = content
+
+            try:
+                response_dict = json.loads(content)
+            except ValueError:
+                raise SearchError('Response from remote CKAN was not JSON: %r' % content)
+            pkg_dicts_page = response_dict.get('result', {}).get('results', [])
+            if not pkg_dicts_page:
+                return
+
+            ids_in_page = set(p['id'] for p in pkg_dicts_page)
+            if ids_in_page & pkg_ids:
+                log.info('Discarding %s duplicate datasets - probably due to '
+                         'datasets being changed at the same time as when the '
+                         'harvester was paging through', len(ids_in_page & pkg_ids))
+                pkg_dicts_page = [p for p in pkg_dicts_page if p['id'] not in pkg_ids]
+            pkg_ids.update(ids_in_page)
+
+            params['start'] = str(int(params['start']) + rows)
+            cursor['start'] = int(params['start'])
+            yield pkg_dicts_page
+
+    def _create_page_harvest_objects(self, pkg_dicts, harvest_job):
+        '''
+        Create the harvest objects for one page of package dicts in a single
+        commit and return their ids
+        '''
+        objs = []
+        for pkg_dict in pkg_dicts:
+            log.debug('Creating HarvestObject for %s %s', pkg_dict['name'], pkg_dict['id'])
+            # set the job id rather then the job so the objects are not
+            # collected on harvest_job.objects for the rest of the gather
+            objs.append(HarvestObject(guid=pkg_dict['id'],
+                                      harvest_job_id=harvest_job.id,
+                                      content=json.dumps(pkg_dict)))
+        if not objs:
+            return []
+        model.Session.add_all(objs)
+        model.Session.commit()
+        object_ids = [obj.id for obj in objs]
+        for obj in objs:
+            model.Session.expunge(obj)
+        return object_ids
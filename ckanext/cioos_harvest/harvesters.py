@@ -0,0 +1,1401 @@
+# encoding: utf-8
+'''
+The CKAN harvesters of this extension and the ISpatialHarvester hooks used by
+the ckanext-spatial harvesters.
+
+Kept apart from the plugin module so that processes that only load the
+cioos_harvest plugin, the web workers for example, do not import the
+harvester dependencies.
+'''
+import json
+import time
+import xml.etree.ElementTree as ET
+from numbers import Number
+
+import requests
+from requests.exceptions import HTTPError, RequestException
+from six import string_types, text_type
+from sqlalchemy.orm.exc import StaleDataError
+
+import ckan.plugins as plugins
+from ckan import model
+import ckan.plugins.toolkit as toolkit
+import ckan.lib.munge as munge
+from ckan.logic.schema import default_create_package_schema
+from ckanext.spatial.harvesters import CSWHarvester, WAFHarvester
+from ckanext.spatial.validation.validation import BaseValidator
+from ckanext.harvest.model import HarvestObject, HarvestObjectError
+from ckanext.harvest.harvesters.ckanharvester import CKANHarvester, ContentFetchError, SearchError
+from ckanext.cioos_harvest import blobstore, fetch, identifiers, indexing, memory, normalize, package_diff, profiling, replay, search_text, spatial_filter
+from ckanext.cioos_harvest.gather import StreamingGatherMixin
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def load_json(j):
+    return normalize.from_json(j)
+
+
+def _save_xml_fetch_error(msg, harvest_object):
+    log.warn(msg)
+    if harvest_object is None:
+        return
+    try:
+        err = HarvestObjectError(message=msg, object=harvest_object, stage='Import')
+        err.save()
+    except StaleDataError as e:
+        log.warn('Harvest object %s is stail. Error object not created. %s' % (harvest_object.id, str(e)))
+
+
+def _get_xml_url_content(xml_url, urlopen_timeout, harvest_object, fetch_guard=None, deadline=None):
+    '''
+    `urlopen_timeout` is the timeout in seconds or a fetch.TimeoutPolicy
+    giving the timeout for the host of `xml_url`. No request is made after
+    `deadline`, and the timeout never runs past it.
+    '''
+    host = fetch.url_host(xml_url)
+    policy = urlopen_timeout if isinstance(urlopen_timeout, fetch.TimeoutPolicy) else None
+    timeout = policy.timeout(host) if policy else urlopen_timeout
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            _save_xml_fetch_error('External XML fetch budget used up. Skipping external XML content at %s' % xml_url,
+                                  harvest_object)
+            return ''
+        timeout = min(timeout, remaining)
+    if fetch_guard:
+        if fetch_guard.is_missing(xml_url):
+            log.debug('Skipping %s, it returned a 404 earlier in this job', xml_url)
+            return ''
+        if not fetch_guard.breaker.allow(host):
+            log.debug('Skipping %s, too many failed requests to %s', xml_url, host)
+            return ''
+
+    # failures that say something about the host rather then the document
+    host_failure = False
+    started = time.time()
+    try:
+        r = requests.get(xml_url, timeout=timeout)
+        if policy:
+            policy.record(host, time.time() - started)
+        if r.status_code == 404:
+            if fetch_guard:
+                fetch_guard.record_missing(xml_url)
+                fetch_guard.breaker.record_success(host)
+            _save_xml_fetch_error('HTTP 404: External XML content not found at %s' % xml_url, harvest_object)
+            return ''
+        r.raise_for_status()
+        ET.XML(r.content)  # test for valid xml
+    except ET.ParseError as e:
+        msg = '%s: %s. From external XML content at %s' % (type(e).__name__, str(e), xml_url)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        host_failure = True
+        if policy and isinstance(e, requests.exceptions.Timeout):
+            policy.record_timeout(host, timeout)
+        msg = '%s: %s. From external XML content at %s' % (type(e).__name__, str(e), xml_url)
+    except requests.exceptions.TooManyRedirects as e:
+        msg = 'HTTP too many redirects: %s. From external XML content at %s' % (str(e), xml_url)
+    except requests.exceptions.HTTPError as e:
+        host_failure = e.response is not None and e.response.status_code >= 500
+        msg = 'HTTP error: %s. From external XML content at %s' % (str(e), xml_url)
+    except requests.exceptions.RequestException as e:
+        msg = 'HTTP request exception: %s. From external XML content at %s' % (str(e), xml_url)
+    except Exception as e:
+        msg = '%s: %s. From external XML content at %s' % (type(e).__name__, str(e), xml_url)
+    else:
+        if fetch_guard:
+            fetch_guard.breaker.record_success(host)
+        return r.text
+
+    _save_xml_fetch_error(msg, harvest_object)
+    if fetch_guard and host_failure and fetch_guard.breaker.record_failure(host):
+        # one summarized error instead of a timeout and an error per record
+        _save_xml_fetch_error(
+            'External XML host %s failed %s consecutive times. Skipping requests '
+            'to this host for %s seconds.' % (
+                host, fetch_guard.breaker.failure_threshold, fetch_guard.breaker.cooldown),
+            harvest_object)
+    return ''
+
+
+class HookCalls(object):
+    '''
+    The CKAN actions and external requests made by the harvest hooks. The
+    hooks make them through the instance given as their `calls` argument,
+    replay.capture passes one that records them and the replay one that
+    answers them from a corpus.
+    '''
+
+    def __init__(self, harvester=None):
+        self.harvester = harvester
+
+    def get_action(self, name):
+        return toolkit.get_action(name)
+
+    def get_xml_url_content(self, xml_url, *args, **kwargs):
+        return _get_xml_url_content(xml_url, *args, **kwargs)
+
+    def post_content(self, url, params={}):
+        return self.harvester._post_content(url, params)
+
+
+def _get_extra(key, package_dict):
+    for extra in package_dict.get('extras', []):
+        if extra['key'] == key:
+            return extra
+
+def _get_search_text_xpaths(source_config):
+    xpaths = source_config.get('search_text_xpaths') or toolkit.config.get('ckan.harvest_document_search_xpaths')
+    if isinstance(xpaths, string_types):
+        xpaths = toolkit.aslist(xpaths)
+    return xpaths or None
+
+
+def _store_harvest_document(value, extras):
+    '''
+    Save the xml document in the document store and record the reference in
+    extras
+    '''
+    extras['harvest_document_ref'] = blobstore.get_document_store().put(value)
+
+
+def _get_xml_url_timeout(source_config):
+    '''
+    The fetch.TimeoutPolicy of the external xml fetches of a source
+    '''
+    def seconds(source_key, config_key, default):
+        # get value in millieseconds but urllib assumes it is in seconds
+        return float(source_config.get(source_key) or toolkit.config.get(config_key) or default) / 1000.0
+
+    default = seconds('url_read_timeout', 'ckan.index_xml_url_read_timeout', '500')
+    adaptive = toolkit.asbool(source_config.get('xml_fetch_adaptive_timeout', toolkit.config.get('ckan.xml_fetch_adaptive_timeout', True)))
+    tracker = None
+    if adaptive:
+        try:
+            tracker = fetch.get_latency_tracker(blobstore.get_storage_dir('fetch_stats'))
+        except RuntimeError:
+            # no storage directory, the stats are only kept in memory
+            tracker = fetch.get_latency_tracker()
+    return fetch.TimeoutPolicy(
+        default,
+        minimum=min(default, seconds('xml_fetch_min_timeout', 'ckan.xml_fetch_min_timeout', '200')),
+        maximum=max(default, seconds('xml_fetch_max_timeout', 'ckan.xml_fetch_max_timeout', '10000')),
+        pct=float(source_config.get('xml_fetch_timeout_percentile') or toolkit.config.get('ckan.xml_fetch_timeout_percentile') or '95'),
+        budget=seconds('xml_fetch_budget', 'ckan.xml_fetch_budget', '30000'),
+        adaptive=adaptive,
+        tracker=tracker)
+
+
+def _get_fetch_guard(key, source_config):
+    return fetch.get_fetch_guard(
+        key,
+        failure_threshold=int(source_config.get('xml_fetch_failure_threshold') or toolkit.config.get('ckan.xml_fetch_failure_threshold') or '3'),
+        cooldown=float(source_config.get('xml_fetch_cooldown') or toolkit.config.get('ckan.xml_fetch_cooldown') or '300'))
+
+
+def _fetch_xml_location(xml_url, urlopen_timeout, harvest_object, fetch_guard, calls=None):
+    '''
+    Fetch the xml document, or documents, at xml_location_url and return them
+    with extra white space removed
+    '''
+    get_xml_url_content = calls.get_xml_url_content if calls else _get_xml_url_content
+    value = ''
+    deadline = urlopen_timeout.deadline() if isinstance(urlopen_timeout, fetch.TimeoutPolicy) else None
+    # single file
+    if xml_url and isinstance(xml_url, string_types):
+        value = get_xml_url_content(xml_url, urlopen_timeout, harvest_object, fetch_guard, deadline=deadline)
+
+    # list of files
+    if xml_url and isinstance(xml_url, list):
+        value = fetch.bundle_documents(
+            get_xml_url_content(xml_file, urlopen_timeout, harvest_object, fetch_guard, deadline=deadline)
+            for xml_file in xml_url)
+
+    return fetch.minify_xml(value)
+
+
+def _prepare_harvest_document(value, source_config, extras):
+    '''
+    Return the value to save in harvest_document_content for the xml document
+    `value`, storing the document in the document store if configured
+    '''
+    storage = source_config.get('harvest_document_storage') or toolkit.config.get('ckan.harvest_document_storage') or 'inline'
+    index = source_config.get('harvest_document_index') or toolkit.config.get('ckan.harvest_document_index') or 'xml'
+    if storage == 'blob' and extras is not None:
+        _store_harvest_document(value, extras)
+        # the document is no longer kept in the dataset, only its text
+        index = 'text'
+    if index == 'text':
+        value = search_text.extract_search_text(value, _get_search_text_xpaths(source_config))
+    return value
+
+
+@memory.monitor_stage('extract_xml', lambda package_dict, harvest_object, extras=None, calls=None: harvest_object)
+def _extract_xml_from_harvest_object(package_dict, harvest_object, extras=None, calls=None):
+    content = harvest_object.content
+    source_config = json.loads(harvest_object.source.config)
+    key = 'harvest_document_content'
+    value = ''
+    if extras is not None:
+        # references copied from a remote catalogue point into its own store
+        extras.pop('harvest_document_ref', None)
+    package_content = package_dict.get(key,'')
+
+    if package_content.startswith('<'):
+        value = package_content
+    elif content.startswith('<'):
+        value = harvest_object.content
+    else:
+        log.warn('Unable to find harvest object "%s" '
+                 'referenced by dataset "%s". Trying xml url',
+                 harvest_object.id, package_dict['id'])
+
+        # try reading from xml url
+        xml_url = load_json(package_dict.get('xml_location_url'))
+        if not xml_url:
+            log.warn('Empty or Missing URL in xml_location_url field. External xml metadata will not be retreaved.')
+        else:
+            value = _fetch_xml_location(
+                xml_url,
+                _get_xml_url_timeout(source_config),
+                harvest_object,
+                _get_fetch_guard(harvest_object.harvest_job_id, source_config),
+                calls)
+    if value:
+        log.info('Success. External xml retrieved.')
+        package_dict[key] = _prepare_harvest_document(value, source_config, extras)
+    return package_dict
+
+def handle_groups(context, harvest_object, group_mapping, group_type, cats = [], additional_contacts = [], calls=None):
+        source_config = json.loads(harvest_object.source.config)
+        get_action = calls.get_action if calls else toolkit.get_action
+        validated_groups = []
+
+        harvest_responsible_organizations = (source_config.get('harvest_responsible_organizations') or toolkit.config.get('ckan.harvest_responsible_organizations') or 'true').lower()
+        if harvest_responsible_organizations == "true":
+            # Handle org mapping using metadata cited-responsible-party
+            log.info(':::::::::::::-Handle Groups-::::::::::::: %r ', cats)
+        else:
+            log.debug(':::::::::::::-Skipping Handle Groups-::::::::::::: %r ', cats)
+            return validated_groups
+
+        resp_org_roles = load_json(
+            source_config.get('responsible_organization_roles')
+            or toolkit.config.get('ckan.responsible_organization_roles')
+            or '["owner", "originator", "custodian", "author", "principalInvestigator"]'
+        )
+
+        # Additional roles that can be associated with responsible_organization even if not in citation
+        additional_resp_org_roles = load_json(
+            source_config.get('additional_responsible_organization_roles')
+            or toolkit.config.get('ckan.additional_responsible_organization_roles')
+            or '[]'
+        )
+
+        # Process both citation contacts and additional contacts
+        all_contacts = []
+
+        # Add citation contacts with their roles
+        for cat in cats:
+            role = load_json(cat.get('role'))
+            if not isinstance(role, list):
+                role = [role]
+            if not set(role).isdisjoint(set(resp_org_roles)):
+                all_contacts.append(cat)
+
+        # Add additional contacts (from metadata-point-of-contact, etc.) with their roles
+        for contact in additional_contacts:
+            role = load_json(contact.get('role'))
+            if not isinstance(role, list):
+                role = [role]
+            if not set(role).isdisjoint(set(additional_resp_org_roles)):
+                all_contacts.append(contact)
+                log.debug('Adding additional contact with role %s: %s' % (role, contact.get('organisation-name')))
+
+        # Process all collected contacts
+        for cat in all_contacts:
+            if not cat.get('organisation-name'):
+                continue
+
+            organisation_name = cat['organisation-name'].strip()
+            orgname = group_mapping.get(organisation_name, munge.munge_name(organisation_name).lower())
+            groupname = '_'.join([group_type, orgname])
+
+            printname = orgname if not None else "NONE"
+            log.debug("Group %s mapped into %s" % (organisation_name, printname))
+
+            if groupname:
+                org = None
+                group = None
+                try:
+                    data_dict = {'id': groupname}
+                    group = get_action('group_show')(context.copy(), data_dict=data_dict)
+                    log.info('Found Existing Group %s' % (groupname))
+                    validated_groups.append({'id': group['id'], 'name': group['name']})
+                except toolkit.ObjectNotFound as e1:
+                    log.debug('Group %s is not available' % (groupname))
+                    # check if group exists as an organization
+                    try:
+                        org = get_action('organization_show')(context.copy(), data_dict={
+                                                                        'id': orgname,
+                                                                        'include_datasets': False,
+                                                                        'include_dataset_count': False,
+                                                                        'include_extras': True,
+                                                                        'include_users': False,
+                                                                        'include_groups': False,
+                                                                        'include_tags': False,
+                                                                        'include_followers': False,
+                                                                    })
+                        org['name'] = groupname
+                        for key in ['id', 'packages', 'created', 'users', 'groups', 'tags', 'is_organization','num_followers','package_count','approval_status']:
+                            org.pop(key, None)
+                        org['type'] = group_type or 'group'
+                        if org.get('organization-uri'):
+                            org['group-uri'] = org['organization-uri'].copy()
+                        created_group = get_action('group_create')(context.copy(), data_dict=org)
+                        log.info('Group %s created from org %s', groupname, orgname)
+                        validated_groups.append({'id': created_group['id'], 'name': created_group['name']})
+                    except toolkit.ValidationError as e:
+                            HarvestObjectError.create('Validation Error while creating group %s: %s' % (org['name'], e.error_dict), harvest_object, 'Import')
+                            continue
+                    except toolkit.ObjectNotFound as e2:
+                        # no organization match so generate new group
+                        log.debug('Organization %s not found, can not generate group %s from organization' % (orgname, groupname))
+                        group = {
+                            'name': groupname,
+                            'display_name': organisation_name,
+                            'title': organisation_name,
+                            'type': group_type or 'group',
+                            'title_translated': {
+                                        'en' : organisation_name,
+                                        'fr' : organisation_name,
+                                    },
+                            'organisation-uri':  {
+                                        'authority': cat.get('organisation-uri_authority',''),
+                                        'code': cat.get('organisation-uri_code',''),
+                                        'code-space': cat.get('organisation-uri_code-space',''),
+                                        'version': cat.get('organisation-uri_version',''),
+                                    }
+                        }
+                        try:
+                            created_group = get_action('group_create')(context.copy(), data_dict=group)
+                        except toolkit.ValidationError as e:
+                            HarvestObjectError.create('Validation Error while creating group %s: %s' % (group['name'], e.error_dict), harvest_object, 'Import')
+                            continue
+
+                        log.info('Group %s created', groupname)
+                        validated_groups.append({'id': created_group['id'], 'name': created_group['name']})
+        return validated_groups
+    
+
+def _source_data_catalogue(harvest_object, source_config):
+    return {
+        "name": source_config.get('source_title') or harvest_object.job.source.title,
+        "description": source_config.get('source_description'),
+        "url": harvest_object.job.source.url.strip('/')
+    }
+
+
+def _patch_updates_enabled(source_config):
+    return toolkit.asbool(source_config.get('patch_updates', toolkit.config.get('ckan.harvest_patch_updates', False)))
+
+
+class PackagePatchMixin(object):
+    '''
+    Update existing packages with package_patch, sending only the fields that
+    changed, and skip the update entirely when nothing changed. Enabled with
+    patch_updates.
+    '''
+
+    def _package_update_context(self, package_id):
+        '''
+        The context the base harvester updates packages with, its schema and
+        the api_version of the source
+        '''
+        schema = default_create_package_schema()
+        schema['id'] = [toolkit.get_validator('ignore_missing'), text_type]
+        schema['__junk'] = [toolkit.get_validator('ignore')]
+        try:
+            api_version = int((self.config or {}).get('api_version', 2))
+        except ValueError:
+            raise ValueError('api_version must be an integer')
+        return {
+            'model': model,
+            'session': model.Session,
+            'user': self._get_user_name(),
+            'api_version': api_version,
+            'schema': schema,
+            'ignore_auth': True,
+            'id': package_id,
+        }
+
+    def _create_or_update_package(self, package_dict, harvest_object,
+                                  package_dict_form='rest'):
+        if package_dict_form != 'package_show' or not _patch_updates_enabled(self.config or {}):
+            return super(PackagePatchMixin, self)._create_or_update_package(
+                package_dict, harvest_object, package_dict_form)
+        try:
+            existing_package_dict = self._find_existing_package(package_dict)
+        except toolkit.ObjectNotFound:
+            # new package
+            return super(PackagePatchMixin, self)._create_or_update_package(
+                package_dict, harvest_object, package_dict_form)
+
+        try:
+            if self.config and self.config.get('clean_tags', False):
+                package_dict['tags'] = self._clean_tags(package_dict.get('tags', []))
+
+            # same check as the base harvester, do not overwrite a newer
+            # local copy with an older remote one
+            modified = package_dict.get('metadata_modified')
+            existing_modified = existing_package_dict.get('metadata_modified')
+            if modified and existing_modified and modified <= existing_modified:
+                log.info('No changes to package with GUID %s, skipping...', harvest_object.guid)
+                return 'unchanged'
+
+            not_overwrite_fields = toolkit.aslist(toolkit.config.get('ckan.harvest.not_overwrite_fields'))
+            patch = package_diff.diff_package(existing_package_dict, package_dict, not_overwrite_fields)
+            if not patch:
+                log.info('No changes to package with GUID %s, skipping...', harvest_object.guid)
+                # NB harvest_object.current/package_id are not set, same as
+                # the base harvester does for unchanged packages
+                return 'unchanged'
+
+            log.info('Package with GUID %s exists, updating %s', harvest_object.guid, ', '.join(sorted(patch)))
+            patch['id'] = existing_package_dict['id']
+            context = self._package_update_context(patch['id'])
+            new_package = toolkit.get_action('package_patch')(context, patch)
+
+            # Flag the other objects linking to this package as not current anymore
+            model.Session.query(HarvestObject).filter(
+                HarvestObject.package_id == new_package['id']).update({'current': False})
+
+            # Flag this as the current harvest object
+            harvest_object.package_id = new_package['id']
+            harvest_object.current = True
+            harvest_object.save()
+            return True
+
+        except toolkit.ValidationError as e:
+            log.exception(e)
+            self._save_object_error('Invalid package with GUID %s: %r' % (harvest_object.guid, e.error_dict),
+                                    harvest_object, 'Import')
+        except Exception as e:
+            log.exception(e)
+            self._save_object_error('%r' % e, harvest_object, 'Import')
+        return None
+
+
+class DeferredIndexingMixin(object):
+    '''
+    Leave indexing of the imported datasets to the end of the harvest job when
+    defer_indexing is enabled for the source
+    '''
+
+    def import_stage(self, harvest_object):
+        source_config = json.loads((harvest_object and harvest_object.source.config) or '{}')
+        if not indexing.defer_indexing_enabled(source_config):
+            return super(DeferredIndexingMixin, self).import_stage(harvest_object)
+        indexing.mark_job_pending(harvest_object)
+        with indexing.automatic_indexing_disabled():
+            return super(DeferredIndexingMixin, self).import_stage(harvest_object)
+
+
+class DeduplicateSourcesMixin(object):
+    '''
+    Skip records that another harvest source has already imported and that
+    source wins on precedence, see ckanext.cioos_harvest.identifiers
+    '''
+
+    def import_stage(self, harvest_object):
+        source_config = json.loads((harvest_object and harvest_object.source.config) or '{}')
+        if not identifiers.deduplicate_enabled(source_config) or not harvest_object.content:
+            return super(DeduplicateSourcesMixin, self).import_stage(harvest_object)
+
+        package_dict = json.loads(harvest_object.content)
+        extras = dict((x['key'], x['value']) for x in package_dict.get('extras', []))
+        record_identifiers = identifiers.record_identifiers(
+            harvest_object.guid, package_dict.get('unique-resource-identifier-full'), [extras.get('guid')])
+        preferred = identifiers.preferred_copy(record_identifiers, harvest_object.source.id)
+        if preferred:
+            source_id, package_id = preferred
+            log.info('Record with GUID %s was imported from harvest source %s as %s, skipping',
+                     harvest_object.guid, source_id, package_id)
+            catalogues = load_json(package_dict.get('included_in_data_catalogue')) or []
+            if isinstance(catalogues, dict):
+                catalogues = [catalogues]
+            catalogues = catalogues + [_source_data_catalogue(harvest_object, source_config)]
+            try:
+                identifiers.merge_data_catalogues(package_id, catalogues, self._get_user_name())
+            except (toolkit.ValidationError, toolkit.ObjectNotFound) as e:
+                log.warning('Unable to add data catalogues to %s: %s', package_id, e)
+            return 'unchanged'
+
+        result = super(DeduplicateSourcesMixin, self).import_stage(harvest_object)
+        if result and harvest_object.package_id:
+            # the local id, the remote name may have been changed to avoid
+            # a clash
+            identifiers.record(record_identifiers, harvest_object.source.id, harvest_object.package_id)
+            model.Session.commit()
+        return result
+
+
+class SpatialDeduplicateSourcesMixin(object):
+    '''
+    Skip records of a ckanext-spatial harvester that another harvest source
+    has already imported, see ckanext.cioos_harvest.identifiers. The record
+    is looked up by the get_package_dict hook, which has the ISO values, and
+    returns no package dict when it is skipped. The import stage then reports
+    the record as not modified instead of failed.
+    '''
+
+    def import_stage(self, harvest_object):
+        # the spatial import stage flags the current object of the record as
+        # not current before the hooks run
+        previous_object = model.Session.query(HarvestObject) \
+            .filter(HarvestObject.guid == harvest_object.guid) \
+            .filter(HarvestObject.current == True) \
+            .first()  # noqa: E712
+        result = super(SpatialDeduplicateSourcesMixin, self).import_stage(harvest_object)
+        if getattr(harvest_object, 'cioos_duplicate_of', None):
+            if previous_object is not None and previous_object is not harvest_object:
+                previous_object.current = True
+                previous_object.add()
+            return 'unchanged'
+        record_identifiers = getattr(harvest_object, 'cioos_identifiers', None)
+        if result and record_identifiers and harvest_object.package_id:
+            # the package is written after the hooks returned, its id is
+            # only known now for new records
+            identifiers.record(record_identifiers, harvest_object.source.id, harvest_object.package_id)
+            model.Session.commit()
+        return result
+
+
+class MemoryMonitorMixin(object):
+    '''
+    Memory accounting per harvest object and worker recycling, see
+    ckanext.cioos_harvest.memory
+    '''
+
+    def fetch_stage(self, harvest_object):
+        with memory.monitored(harvest_object, 'fetch'):
+            return super(MemoryMonitorMixin, self).fetch_stage(harvest_object)
+
+    def import_stage(self, harvest_object):
+        try:
+            with memory.monitored(harvest_object, 'import'):
+                return super(MemoryMonitorMixin, self).import_stage(harvest_object)
+        finally:
+            memory.object_finished(harvest_object)
+
+
+class CIOOSCKANHarvester(MemoryMonitorMixin, DeduplicateSourcesMixin, DeferredIndexingMixin, PackagePatchMixin, StreamingGatherMixin, CKANHarvester):
+
+    def info(self):
+        return {
+            'name': 'ckan_cioos',
+            'title': 'CKAN CIOOS',
+            'description': 'Harvests remote CKAN instances with improved handling/indexing of external xml files and organization matching',
+            'form_config_interface': 'Text'
+        }
+
+    def modify_remote_organization(self, remote_org_id, pkg_dict, context):
+        try:
+            package_org = pkg_dict.get('organization')
+            if package_org and package_org.get('id') == remote_org_id:
+                remote_org_id = package_org.get('name', remote_org_id)
+
+            # if there is a organization uri then try to match on that
+            # get first item from organization-uri list if it exists
+            uri = next(iter(package_org.get('organization-uri', [])), {})
+            # we assume uri code is unique
+            code = uri.get('code')
+            if code:
+                data_dict = {
+                    'fq': 'organization-uri:%s' % code.replace(':', '_')
+                }
+                org = toolkit.get_action('organization_list')(context.copy(), data_dict=data_dict)
+                if org:
+                    remote_org_id = org[0]
+        except Exception as e:
+            log.exception(e)
+            raise
+        return remote_org_id
+
+    @replay.capture('modify_package_dict')
+    @memory.monitor_stage('modify_package_dict', lambda self, package_dict, harvest_object, calls=None: harvest_object)
+    @profiling.profile_stage('modify_package_dict', lambda self, package_dict, harvest_object, calls=None: harvest_object)
+    def modify_package_dict(self, package_dict, harvest_object, calls=None):
+        calls = calls or HookCalls(self)
+        base_context = {'model': model, 'session': model.Session,
+                        'user': self._get_user_name()}
+        try:
+            # convert extras key:value list to dictinary
+            extras = {x['key']: x['value'] for x in package_dict.get('extras', [])}
+            package_dict = _extract_xml_from_harvest_object(package_dict, harvest_object, extras, calls)
+
+            if not extras.get('metadata_created_source'):
+                extras['metadata_created_source'] = package_dict.get('metadata_created')
+            if not extras.get('metadata_modified_source'):
+                extras['metadata_modified_source'] = package_dict.get('metadata_modified')
+
+            # populate harvest source organization
+            harvest_source = calls.get_action("harvest_source_show")(
+                data_dict = {
+                "id": harvest_object.source.id
+            })
+            extras['harvest_source_organization'] = harvest_source.get('organization')
+
+            # convert extras back to a list of key/value dictionaries
+            extras_as_list = []
+            for key, value in extras.items():
+                if package_dict.get(key, ''):
+                    log.error('extras %s found in package dict: key:%s value:%s', key, key, value)
+                if isinstance(value, (list, dict)):
+                    extras_as_list.append({'key': key, 'value': json.dumps(value)})
+                else:
+                    extras_as_list.append({'key': key, 'value': value})
+
+            package_dict['extras'] = extras_as_list
+
+
+            # provide default values if harvesting from a ckan catalogue that does not have these in their schema
+            if not package_dict.get('projects'): 
+                package_dict['projects'] = []
+            if not package_dict.get('datacentre'): 
+                package_dict['datacentre'] = []
+
+            # add uri for dcat if it dosn't exist
+            package_uri = toolkit.config.get('ckan.site_url') + '/dataset/' + package_dict.get('name')
+            existing_extra = _get_extra('uri', package_dict)
+            if not existing_extra:
+                extras.append({'key': 'uri', 'value': package_uri})
+
+            # populate publishing data catalogue list
+            dc = {
+                "name": load_json(toolkit.config.get('ckan.site_title')),
+                "description": load_json(toolkit.config.get('ckan.site_description')),
+                "url": toolkit.config.get('ckan.site_url')
+            }
+            
+            source_dc = _source_data_catalogue(harvest_object, self.config)
+
+            if not package_dict.get('included_in_data_catalogue'):
+                package_dict['included_in_data_catalogue'] = [source_dc, dc]
+            else:
+                package_dict['included_in_data_catalogue'].append(dc)
+                # remove duplicities
+                package_dict['included_in_data_catalogue'] = list({item.get('url',''):item for item in package_dict['included_in_data_catalogue'][::-1]}.values())
+
+            # fix common schema fields errors
+            schema = plugins.toolkit.h.scheming_get_dataset_schema('dataset')
+            for field in schema['dataset_fields']:
+                if 'repeating_subfields' in field or 'simple_subfields' in field:
+                    field_name = field['field_name']
+                    value = package_dict.get(field_name)
+                    if value == '':
+                        value = []
+                        package_dict[field_name] = value
+                    elif value:
+                        value = load_json(value)
+                        if isinstance(value, dict):
+                            value = [value]
+                        package_dict[field_name] = value
+
+            # condense uri into uri.code to make downstream templating easier
+            # DOI
+            URIF = toolkit.h.cioos_get_fully_qualified_package_uri(
+                package_dict,
+                uri_field='unique-resource-identifier-full',
+                default_code_space='doi.org')
+            if URIF:
+                if isinstance(package_dict['unique-resource-identifier-full'], list):
+                    for index, item in enumerate(package_dict['unique-resource-identifier-full']):
+                        package_dict['unique-resource-identifier-full'][index]['code'] = URIF[index]
+                else:
+                    package_dict['unique-resource-identifier-full']['code'] = URIF[0]
+
+            # Organization URI
+            organization = package_dict.get('organization')
+            if organization:
+                if isinstance(organization, list):
+                    organization = organization[0]
+                code = toolkit.h.cioos_get_fully_qualified_package_uri(
+                    organization,
+                    uri_field='organization-uri')
+                organization['code'] = next(iter(code or []), '')
+                package_dict['organization'] = organization
+
+            # metadata-point-of-contact Individual and Organisation URI
+            mpocs = package_dict.get('metadata-point-of-contact',[])
+            for mpoc in mpocs:
+                code = toolkit.h.cioos_get_fully_qualified_package_uri(
+                    mpoc,
+                    uri_field='individual-uri_')
+                mpoc['individual-uri_code'] = next(iter(code or []), '')
+
+                code = toolkit.h.cioos_get_fully_qualified_package_uri(
+                    mpoc,
+                    uri_field='organisation-uri_')
+                mpoc['organisation-uri_code'] = next(iter(code or []), '')
+            package_dict['metadata-point-of-contact'] = mpocs
+
+            # cited-responsible-party Individual and Organisation URI
+            crps = package_dict.get('cited-responsible-party',[])
+            for crp in crps:
+                code = toolkit.h.cioos_get_fully_qualified_package_uri(
+                    crp,
+                    uri_field='individual-uri_')
+                mpoc['individual-uri_code'] = next(iter(code or []), '')
+
+                code = toolkit.h.cioos_get_fully_qualified_package_uri(
+                    crp,
+                    uri_field='organisation-uri_')
+                mpoc['organisation-uri_code'] = next(iter(code or []), '')
+            package_dict['cited-responsible-party'] = crps
+
+            if len(package_dict['tags']) > 0:
+                log.warning('Setting tags to an empty list. the following tags will be lost if not already added to keywords: %r', package_dict['tags'])
+            package_dict['tags'] = []
+
+            source_config = json.loads(harvest_object.source.config)
+            ## Configuring Responsible Organization group
+            group_mapping = source_config.get('organization_mapping', {})
+            group_type = 'resorg'
+            # filter out entries with no organisation
+            parties = [ x for x in package_dict.get("cited-responsible-party",[]) if x.get('organisation-name')]
+            # filter out entries with no organisation from metadata-point-of-contact
+            additional_parties = [ x for x in package_dict.get("metadata-point-of-contact",[]) if x.get('organisation-name')]
+            # generate groups if not already set
+            if package_dict.get('groups'):
+                log.debug('Groups Found. Skipping Responable Organization processing.')
+            else:
+                groups = handle_groups(base_context, harvest_object, group_mapping, group_type, parties, additional_parties, calls)
+                if groups:
+                    # remove duplicates by populating dictionary and then converting to list
+                    package_dict['groups'] = list({x['id']: x for x in (package_dict.get('groups',[]) + groups)}.values())
+
+            for resource in package_dict.get('resources', []):
+                # populate multilingual resource name if not set
+                if not resource.get('name_translated'):
+                    resource['name_translated'] = normalize.as_language_dict(resource.get('name'), ['en', 'fr'])
+
+                # populate multilingual resource description if not set
+                if not resource.get('description_translated'):
+                    resource['description_translated'] = normalize.as_language_dict(resource.get('description'), ['en', 'fr'])
+
+                if not resource.get('created_source'):
+                    resource['created_source'] = resource.get('created')
+
+                if not resource.get('metadata_modified_source'):
+                    resource['metadata_modified_source'] = resource.get('metadata_modified')
+
+        except Exception as e:
+            log.exception(e)
+            raise
+        return package_dict
+
+class CKANSpatialHarvester(MemoryMonitorMixin, DeduplicateSourcesMixin, DeferredIndexingMixin, PackagePatchMixin, StreamingGatherMixin, CKANHarvester):
+
+    # ids returned by the remote spatial search, requested once per gather
+    _spatial_id_set = None
+    # parsed spatial filter in local mode, once per gather
+    _spatial_filter = None
+
+    def _post_content(self, url, params={}):
+
+        headers = {}
+        api_key = self.config.get('api_key')
+        if api_key:
+            headers['Authorization'] = api_key
+
+        from urllib3.contrib import pyopenssl
+        pyopenssl.inject_into_urllib3()
+
+        try:
+            http_request = requests.post(url, headers=headers, json=params)
+        except HTTPError as e:
+            raise ContentFetchError('HTTP error: %s %s' % (e.response.status_code, e.request.url))
+        except RequestException as e:
+            raise ContentFetchError('Request error: %s' % e)
+        except Exception as e:
+            raise ContentFetchError('HTTP general exception: %s' % e)
+        return http_request.text
+
+    def info(self):
+        return {
+            'name': 'ckan_spatial',
+            'title': 'CKAN Spatial',
+            'description': 'Harvests remote CKAN instances filtering by spatial query',
+            'form_config_interface': 'Text'
+        }
+
+    @replay.capture('modify_package_dict')
+    @memory.monitor_stage('modify_package_dict', lambda self, package_dict, harvest_object, calls=None: harvest_object)
+    @profiling.profile_stage('modify_package_dict', lambda self, package_dict, harvest_object, calls=None: harvest_object)
+    def modify_package_dict(self, package_dict, harvest_object, calls=None):
+
+        # provide default values if harvesting from a ckan catalogue that does not have these in their schema
+        if not package_dict.get('projects'): 
+            package_dict['projects'] = []
+        if not package_dict.get('datacentre'): 
+            package_dict['datacentre'] = []
+
+        # populate publishing data catalogue list
+        dc = {
+            "name": load_json(toolkit.config.get('ckan.site_title')),
+            "description": load_json(toolkit.config.get('ckan.site_description')),
+            "url": toolkit.config.get('ckan.site_url')
+        }
+        if not package_dict.get('included_in_data_catalogue'):
+            package_dict['included_in_data_catalogue'] = [dc]
+        else:
+            package_dict['included_in_data_catalogue'].append(dc)
+            # remove duplicities
+            package_dict['included_in_data_catalogue'] = list({item.get('url',''):item for item in package_dict['included_in_data_catalogue'][::-1]}.values())
+
+        return package_dict
+
+    def gather_stage(self, harvest_job):
+        self._spatial_id_set = None
+        self._spatial_filter = None
+        try:
+            return super(CKANSpatialHarvester, self).gather_stage(harvest_job)
+        finally:
+            self._spatial_id_set = None
+            self._spatial_filter = None
+
+    def _get_spatial_filter_wkt(self):
+        spatial_filter_file = self.config.get('spatial_filter_file', None)
+        if spatial_filter_file:
+            with open(spatial_filter_file, "r") as f:
+                return f.read().strip()
+        return self.config.get('spatial_filter', None) or ''
+
+    def _get_spatial_filter(self):
+        crs = str(self.config.get('spatial_crs', 4326))
+        if crs.upper() not in spatial_filter.WGS84:
+            raise SearchError('spatial_crs %s is not supported with spatial_filter_mode local, '
+                              'the filter must be in EPSG:4326' % crs)
+        try:
+            return spatial_filter.SpatialFilter.from_wkt(self._get_spatial_filter_wkt())
+        except ValueError as e:
+            raise SearchError('Unable to parse spatial_filter: %s' % e)
+
+    def _get_spatial_id_list(self, remote_ckan_base_url, calls=None):
+        ss_params = {}
+        spatial_filter_wkt = self._get_spatial_filter_wkt()
+        if spatial_filter_wkt.startswith(('POLYGON', 'MULTIPOLYGON')):
+            ss_params['poly'] = spatial_filter_wkt
+        if spatial_filter_wkt.startswith('BOX'):
+            ss_params['bbox'] = spatial_filter_wkt[4:-1]
+        ss_params['crs'] = self.config.get('spatial_crs', 4326)
+        spatial_id_list = []
+        if spatial_filter_wkt:
+            spatial_search_url = remote_ckan_base_url + '/api/2/search/dataset/geo'
+            try:
+                ss_content = (calls or HookCalls(self)).post_content(spatial_search_url, ss_params)
+            except ContentFetchError as e:
+                raise SearchError(
+                    'Error sending request to spatial search remote '
+                    'CKAN instance %s using URL %r. Error: %s' %
+                    (remote_ckan_base_url, spatial_search_url, e))
+            try:
+                ss_response_dict = json.loads(ss_content)
+            except ValueError:
+                raise SearchError('Spatial Search response from remote CKAN was not JSON: %r'
+                                  % ss_content)
+            try:
+                spatial_id_list = ss_response_dict.get('results', [])
+            except ValueError:
+                raise SearchError('Response JSON did not contain '
+                                  'results list: %r' % ss_response_dict)
+        return spatial_id_list
+
+    @replay.capture('modify_search')
+    def modify_search(self, pkg_dicts, remote_ckan_base_url, fq_terms, calls=None):
+        if spatial_filter.filter_mode(self.config) == 'local':
+            if self._spatial_filter is None:
+                self._spatial_filter = self._get_spatial_filter()
+            pkg_dicts = self._spatial_filter.filter(pkg_dicts)
+            log.debug('Found the follow packages during spatial search:\n %r', pkg_dicts)
+            return pkg_dicts
+
+        # called once per page of search results, the spatial search only
+        # needs to be sent to the remote once per gather
+        if self._spatial_id_set is None:
+            self._spatial_id_set = set(self._get_spatial_id_list(remote_ckan_base_url, calls))
+
+        # Filter out packages not found by spatial search
+        pkg_dicts = [p for p in pkg_dicts
+                     if p['id'] in self._spatial_id_set]
+
+        log.debug('Found the follow packages during spatial search:\n %r', pkg_dicts)
+
+        return pkg_dicts
+
+
+
+# place holder, spatial extension expects a validator to be present
+class MyValidator(BaseValidator):
+
+    name = 'my-validator'
+
+    title = 'My very own validator'
+
+    @classmethod
+    def is_valid(cls, xml):
+
+        return True, []
+
+
+
+class CIOOSWAFHarvester(MemoryMonitorMixin, SpatialDeduplicateSourcesMixin, WAFHarvester):
+
+    def info(self):
+        return {
+            'name': 'waf_cioos',
+            'title': 'Web Accessible Folder (WAF) CIOOS',
+            'description': 'A Web Accessible Folder (WAF) of ISO documents, skipping records imported through other sources',
+        }
+
+
+class CIOOSCSWHarvester(MemoryMonitorMixin, SpatialDeduplicateSourcesMixin, CSWHarvester):
+
+    def info(self):
+        return {
+            'name': 'csw_cioos',
+            'title': 'CSW Server CIOOS',
+            'description': 'A server that implements OGC\'s Catalog Service for the Web (CSW) standard, skipping records imported through other sources',
+        }
+
+
+# source types whose harvester can skip records in get_package_dict
+DEDUPLICATING_SPATIAL_HARVESTERS = ('waf_cioos', 'csw_cioos')
+
+
+class SpatialHarvesterHooks(object):
+    '''
+    Implementation of the ISpatialHarvester hooks of Cioos_HarvestPlugin
+    '''
+
+    def get_validators(self):
+        return [MyValidator]
+
+    def from_json(self, val):
+        return normalize.from_json(val)
+
+    def _get_object_extra(self, harvest_object, key):
+        '''
+        Helper function for retrieving the value from a harvest object extra,
+        given the key, copied from ckanext-spatial/ckanext/spatial/harvesters/base.py
+        '''
+        for extra in harvest_object.extras:
+            if extra.key == key:
+                return extra.value
+        return None
+
+    def trim_values(self, values):
+        return normalize.trim_values(values)
+
+    def cioos_guess_resource_format(self, url, use_mimetypes=True):
+        '''
+        Given a URL try to guess the best format to assign to the resource
+
+        This function does not replace the guess_resource_format() in the base
+        spatial harvester. In stead it adds some resource and file types that
+        are missing from that function.
+
+        Returns None if no format could be guessed.
+
+        '''
+        url = url.lower().strip()
+        resource_types = {
+            # ERDDAP
+            'ERDDAP': ('/erddap/',),
+            # OBIS
+            'OBIS': ('/ipt.iobis.org/',),
+        }
+
+        for resource_type, parts in resource_types.items():
+            if any(part in url for part in parts):
+                return resource_type
+
+        file_types = {
+            'CSV': ('csv',),
+            'PDF': ('pdf',),
+            'TXT': ('txt',),
+            'XML': ('xml',),
+            'HTML': ('html',),
+            'JSON': ('json',),
+        }
+
+        for file_type, extensions in file_types.items():
+            if any(url.endswith(extension) for extension in extensions):
+                return file_type
+
+        return None
+
+    @replay.capture('get_package_dict')
+    @memory.monitor_stage('get_package_dict', lambda self, context, data_dict, calls=None: data_dict['harvest_object'])
+    @profiling.profile_stage('get_package_dict', lambda self, context, data_dict, calls=None: data_dict['harvest_object'])
+    def get_package_dict(self, context, data_dict, calls=None):
+        calls = calls or HookCalls(self)
+        package_dict = data_dict['package_dict']
+        iso_values = data_dict['iso_values']
+        harvest_object = data_dict['harvest_object']
+        source_config = json.loads(data_dict['harvest_object'].source.config)
+        xml_location_url = self._get_object_extra(data_dict['harvest_object'], 'waf_location')
+        xml_modified_date = self._get_object_extra(data_dict['harvest_object'], 'waf_modified_date')
+
+        record_identifiers = None
+        if identifiers.deduplicate_enabled(source_config) and \
+                getattr(harvest_object.source, 'type', None) in DEDUPLICATING_SPATIAL_HARVESTERS:
+            record_identifiers = identifiers.record_identifiers(
+                harvest_object.guid, iso_values.get('unique-resource-identifier-full'))
+            preferred = identifiers.preferred_copy(record_identifiers, harvest_object.source.id)
+            if preferred:
+                source_id, package_id = preferred
+                log.info('Record with GUID %s was imported from harvest source %s as %s, skipping',
+                         harvest_object.guid, source_id, package_id)
+                catalogues = load_json(source_config.get('data_catalogue_source')) or []
+                try:
+                    identifiers.merge_data_catalogues(package_id, catalogues, context.get('user'), calls.get_action)
+                except (toolkit.ValidationError, toolkit.ObjectNotFound) as e:
+                    log.warning('Unable to add data catalogues to %s: %s', package_id, e)
+                # without a package dict the spatial import stage stops, the
+                # harvester reports the record as not modified
+                harvest_object.cioos_duplicate_of = preferred
+                return {}
+
+        # convert extras key:value list to dictinary
+        extras = {x['key']: x['value'] for x in package_dict.get('extras', [])}
+
+        extras['xml_location_url'] = xml_location_url
+        if xml_modified_date:
+            extras['xml_modified_date'] = xml_modified_date.replace('Z','')
+
+        # copy some fields over from iso_values if they exist
+        if(iso_values.get('limitations-on-public-access')):
+            extras['limitations-on-public-access'] = iso_values.get('limitations-on-public-access')
+        if(iso_values.get('access-constraints')):
+            extras['access-constraints'] = iso_values.get('access-constraints')
+        if(iso_values.get('use-constraints')):
+            extras['use-constraints'] = iso_values.get('use-constraints')
+        if(iso_values.get('use-constraints-code')):
+            extras['use-constraints-code'] = iso_values.get('use-constraints-code')
+        if(iso_values.get('legal-constraints-reference-code')):
+            extras['legal-constraints-reference-code'] = iso_values.get('legal-constraints-reference-code')
+        if(iso_values.get('distributor')):
+            extras['distributor'] = iso_values.get('distributor')
+        if(iso_values.get('dataset-language')):
+            extras['dataset-language'] = iso_values.get('dataset-language')
+        if(iso_values.get('dataset-language-other')):
+            extras['dataset-language-other'] = iso_values.get('dataset-language-other')
+
+        # populate harvest source organization
+        harvest_source = calls.get_action("harvest_source_show")(
+            data_dict = {
+            "id": harvest_object.source.id
+        })
+        extras['harvest_source_organization'] = harvest_source.get('organization')   
+        
+
+        # load remote xml content
+        package_dict = _extract_xml_from_harvest_object(package_dict, harvest_object, extras, calls)
+
+        # Handle Scheming, Composit, and Fluent extensions
+        loaded_plugins = plugins.toolkit.config.get("ckan.plugins")
+        if 'scheming_datasets' in loaded_plugins:
+            # composite = 'composite' in loaded_plugins
+            fluent = 'fluent' in loaded_plugins
+
+            log.debug('#### Scheming, Composite, or Fluent extensions found, processing dictionary ####')
+            schema = plugins.toolkit.h.scheming_get_dataset_schema('dataset')
+
+            # Package name, default harvester uses title or guid in that order.
+            # we want to reverse that order, so guid or title. Also use english
+            # title only for name
+            title_as_name = self.from_json(package_dict.get('title', '{}')).get('en', package_dict['name'])
+            name = munge.munge_name(extras.get('guid', title_as_name)).lower()
+            package_dict['name'] = name
+
+            # add uri key for dcat extension to use. this field is used as the
+            # dataset id in rdf / jsonld output
+            package_uri = toolkit.config.get('ckan.site_url') + '/dataset/' + name
+            extras['uri'] = package_uri
+
+            # populate license_id
+            if not package_dict.get('license_id'):
+                package_dict['license_id'] = iso_values.get('legal-constraints-reference-code') or iso_values.get('use-constraints') or 'CC-BY-4.0'
+
+            # populate citation
+            package_dict['citation'] = iso_values.get('citation')
+
+            # populate projects
+            package_dict['projects'] = iso_values.get('keyword-project', [])
+
+            # populate datacentre
+            package_dict['datacentre'] = iso_values.get('keyword-datacentre', [])
+
+            # populate lineage - convert string to list of dicts as required by schema
+            lineage_value = iso_values.get('lineage', [])
+            if isinstance(lineage_value, str):
+                # Convert string lineage to required list of dicts format
+                log.warning('Converting lineage from string to list of dicts for dataset: %s',
+                           iso_values.get('guid', 'unknown'))
+                package_dict['lineage'] = [{
+                    'statment': {'en': lineage_value},
+                    'scope': 'dataset',
+                    'additional-documentation': [],
+                    'source': [],
+                    'processing-step': []
+                }]
+            else:
+                package_dict['lineage'] = lineage_value if lineage_value else []
+
+            # populate publishing data catalogue list
+            package_dict['included_in_data_catalogue'] = [{
+                "name": load_json(toolkit.config.get('ckan.site_title')),
+                "description": load_json(toolkit.config.get('ckan.site_description')),
+                "url": toolkit.config.get('ckan.site_url')
+            }]
+
+            if source_config.get('data_catalogue_source'):
+                 package_dict['included_in_data_catalogue'] = load_json(source_config['data_catalogue_source']) +  package_dict['included_in_data_catalogue']
+
+            # populate translation method for bilingual field
+            if iso_values.get('title_translation_method'):
+                package_dict['title_translation_method'] = iso_values['title_translation_method']
+            if iso_values.get('abstract_translation_method'):
+                package_dict['notes_translation_method'] = iso_values['abstract_translation_method']
+            if iso_values.get('keywords_translation_method'):
+                package_dict['keywords_translation_method'] = iso_values['keywords_translation_method']
+
+            # set default language, default to english
+            default_language = iso_values.get('metadata-language', 'en')[0:2]
+            if not default_language:
+                default_language = 'en'
+
+            # iterate over schema fields and update package dictionary as needed
+            for field in schema['dataset_fields']:
+                handled_fields = []
+                self.handle_composite_harvest_dictinary(field, iso_values, extras, package_dict, default_language, handled_fields)
+
+                if fluent:
+                    self.handle_fluent_harvest_dictinary(field, iso_values, package_dict, schema, default_language, handled_fields, source_config)
+
+                self.handle_scheming_harvest_dictinary(field, iso_values, extras, package_dict, default_language, handled_fields)
+
+            # set default values
+            package_dict['progress'] = package_dict.get('progress', 'onGoing') or 'onGoing'
+            package_dict['frequency-of-update'] = package_dict.get('frequency-of-update', 'asNeeded') or 'asNeeded'
+
+        extras_as_list = []
+        for key, value in extras.items():
+            if package_dict.get(key, ''):
+                log.error('extras %s found in package dict: key:%s value:%s', key, key, value)
+            if isinstance(value, (list, dict)):
+                extras_as_list.append({'key': key, 'value': json.dumps(value)})
+            else:
+                extras_as_list.append({'key': key, 'value': value})
+
+        package_dict['extras'] = extras_as_list
+
+         ## Configuring Responsible Organization group
+        group_mapping = source_config.get('organization_mapping', {})
+        group_type = 'resorg'
+        # filter out entries with no organisation
+        parties = [ x for x in iso_values.get("cited-responsible-party",[]) if x.get('organisation-name')]
+        # filter out entries with no organisation from metadata-point-of-contact
+        additional_parties = [ x for x in iso_values.get("metadata-point-of-contact",[]) if x.get('organisation-name')]
+        # generate groups
+        groups = handle_groups(context, harvest_object, group_mapping, group_type, parties, additional_parties, calls)
+        if groups:
+            # remove duplicates by populating dictionary and then converting to list
+            package_dict['groups'] = list({x['id']: x for x in (package_dict.get('groups',[]) + groups)}.values())
+
+        # update resource format and translated relevant fields
+        resources = package_dict.get('resources', [])
+        for resource in resources:
+            url = resource.get('url', '').strip()
+            protocol = resource.get('resource_locator_protocol') or resource.get('protocol')
+            format = resource.get('format') or 'text/html'
+            if url:
+                format = self.cioos_guess_resource_format(url) or format
+            resource['format'] = format
+
+            if resource.get('name') and not resource.get('name_translated'):
+                resource['name_translated'] = normalize.as_language_dict(resource.get('name'), [default_language])
+
+            if resource.get('description') and not resource.get('description_translated'):
+                resource['description_translated'] = normalize.as_language_dict(resource.get('description'), [default_language])
+
+        # give resources the ids of the resources they replace so package_update
+        # updates them in place instead of deleting and recreating them
+        if harvest_object.package_id and _patch_updates_enabled(source_config):
+            try:
+                existing_package_dict = calls.get_action('package_show')(
+                    context.copy(), {'id': harvest_object.package_id})
+            except toolkit.ObjectNotFound:
+                pass
+            else:
+                resources = package_diff.reuse_resource_ids(existing_package_dict.get('resources'), resources)
+
+        package_dict['resources'] = resources
+
+        # the spatial harvester writes the package after this hook returns,
+        # the identifiers are recorded with its id by the import stage
+        harvest_object.cioos_identifiers = record_identifiers
+
+        if indexing.defer_indexing_enabled(source_config):
+            indexing.mark_job_pending(harvest_object)
+            indexing.disable_automatic_indexing_until_commit()
+
+        return self.trim_values(package_dict)
+
+    
+    def handle_fluent_harvest_dictinary(self, field, iso_values, package_dict, schema, default_language, handled_fields, harvest_config):
+        field_name = field['field_name']
+        if field_name in handled_fields:
+            return
+
+        field_value = {}
+
+        if not field.get('preset', '').startswith(u'fluent'):
+            return
+
+        # handle tag fields
+        if field.get('preset', '') == u'fluent_tags':
+            fluent_tags = iso_values.get(field_name, [])
+            schema_languages = plugins.toolkit.h.fluent_form_languages(schema=schema)
+            do_clean = toolkit.asbool(harvest_config.get('clean_tags', False))
+
+            # init language key
+            field_value = {sl: [] for sl in schema_languages}
+
+            # process fluent_tags by convert list of language dictionaries into
+            # a dictionary of language lists
+            for t in fluent_tags:
+                tobj = self.from_json(t.get('keyword', t))
+                if isinstance(tobj, Number):
+                    tobj = str(tobj)
+                if isinstance(tobj, dict):
+                    for key, value in tobj.items():
+                        if key in schema_languages:
+                            if do_clean:
+                                if isinstance(value, list):
+                                    value = [normalize.munge_tag(kw) for kw in value]
+                                else:
+                                    value = normalize.munge_tag(value)
+                            field_value[key].append(value)
+                else:
+                    if do_clean:
+                        tobj = normalize.munge_tag(tobj)
+                    field_value[default_language].append(tobj)
+
+            # add tags to default language fluent field
+            for item in package_dict['tags']:
+                if item.get('name'):
+                    item = item['name']
+                field_value[default_language].append(item)
+
+            # remove duplicate tags, cleaning can map different keywords to
+            # the same tag
+            package_dict[field_name] = {lang: normalize.unique(tags) for lang, tags in field_value.items()}
+
+            # clear tags as its garbage anyway
+            package_dict['tags'] = []
+
+        else:
+            # Populate translated fields from core. this could have been done in
+            # the spatial extensions. example 'title' -> 'title_translated'
+
+            # strip trailing _translated part of field name
+            if field_name.endswith(u'_translated'):
+                package_fn = field_name[:-11]
+            else:
+                package_fn = field_name
+
+            # values that are already a language dictionary are used as is,
+            # otherwise create a bilingual dictionary. This will likely fail
+            # validation as it does not contain all the languages
+            package_val = package_dict.get(package_fn, '')
+            package_dict[field_name] = normalize.as_language_dict(package_val, [default_language])
+
+        handled_fields.append(field_name)
+
+    def flatten_composite_keys(self, obj, new_obj=None, keys=None):
+        if new_obj is None:
+            new_obj = {}
+        keys = keys or []
+        for key, value in obj.items():
+            if isinstance(value, dict):
+                self.flatten_composite_keys(obj[key], new_obj, keys + [key])
+            else:
+                new_obj['_'.join(keys + [key])] = value
+        return new_obj
+
+    def handle_composite_harvest_dictinary(self, field, iso_values, extras, package_dict, default_language, handled_fields):
+        sep = plugins.toolkit.h.scheming_composite_separator()
+        field_name = field['field_name']
+        if field_name in handled_fields:
+            return
+
+        field_value = iso_values.get(field_name, {})
+
+        # populate composite fields from multi-level dictionary
+        if field_value and field.get('simple_subfields'):
+            if isinstance(field_value, list):
+                field_value = field_value[0]
+            field_value = self.flatten_composite_keys(field_value, {}, [])
+
+            for key, value in field_value.items():
+                newKey = field_name + sep + key
+                package_dict[newKey] = value
+
+            # remove from extras so as not to duplicate fields
+            if extras.get(field_name):
+                del extras[field_name]
+            handled_fields.append(field_name)
+
+        # populate composite repeating fields
+        elif field_value and field.get('repeating_subfields'):
+            if isinstance(field_value, dict):
+                field_value[0] = field_value
+
+            for idx, subitem in enumerate(field_value):
+                # collapse subfields into one key value pair
+                subitem = self.flatten_composite_keys(subitem, {}, [])
+                for key, value in subitem.items():
+                    newKey = field_name + sep + str(idx + 1) + sep + key
+                    package_dict[newKey] = value
+
+            # remove from extras so as not to duplicate fields
+            if extras.get(field_name):
+                del extras[field_name]
+            handled_fields.append(field_name)
+
+    def handle_scheming_harvest_dictinary(self, field, iso_values, extras, package_dict, default_language, handled_fields):
+        field_name = field['field_name']
+        if field_name in handled_fields:
+            return
+        iso_field_value = iso_values.get(field_name, {})
+        extra_field_value = extras.get(field_name, "")
+
+        # move schema fields, in extras, to package dictionary
+        if field_name in extras and not package_dict.get(field_name, ''):
+            package_dict[field_name] = extra_field_value
+            del extras[field_name]
+            handled_fields.append(field_name)
+        # move schema fields, in iso_values, to package dictionary
+        elif iso_field_value and not package_dict.get(field_name, ''):
+            # convert list to single value for select fields (not multi-select)
+            if field.get('preset', '') == 'select' and isinstance(iso_field_value, list):
+                iso_field_value = iso_field_value[0]
+            package_dict[field_name] = iso_field_value
+            # remove from extras so as not to duplicate fields
+            if extras.get(field_name):
+                del extras[field_name]
+            handled_fields.append(field_name)
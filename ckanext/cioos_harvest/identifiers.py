@@ -0,0 +1,207 @@
+# encoding: utf-8
+'''
+Index of the record identifiers imported by each harvest source.
+
+CIOOS regional nodes harvest each other, so the same record often reaches
+this catalogue through several harvest sources. With deduplication enabled
+the import stage looks up the guid and DOI of a record in this index before
+transforming it. If another source has already imported a copy and wins on
+`ckan.harvest_source_precedence`, the record is not imported again, only the
+data catalogues it was found in are added to `included_in_data_catalogue` of
+the existing copy.
+
+Sources listed in `ckan.harvest_source_precedence`, by name or id, win over
+sources that are not listed, earlier entries over later ones. Between sources
+with the same precedence the copy that was indexed first wins.
+
+The index is kept in the `cioos_harvest_identifier` table, created by
+`ckan cioos_harvest initdb`. Until it exists records are not deduplicated.
+
+The identifiers are recorded with the id of the package the import wrote.
+'''
+import datetime
+
+from six import string_types
+from sqlalchemy import Column, Index, MetaData, Table, types
+from sqlalchemy.dialects.postgresql import insert
+
+from ckan import model
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.cioos_harvest import normalize
+
+import logging
+log = logging.getLogger(__name__)
+
+DOI_PREFIXES = ('https://doi.org/', 'http://doi.org/', 'https://dx.doi.org/', 'http://dx.doi.org/', 'doi:')
+
+metadata = MetaData()
+
+identifier_table = Table(
+    'cioos_harvest_identifier', metadata,
+    Column('identifier', types.UnicodeText, primary_key=True),
+    Column('source_id', types.UnicodeText, primary_key=True),
+    Column('kind', types.UnicodeText, nullable=False),
+    Column('package_id', types.UnicodeText),
+    Column('created', types.DateTime, default=datetime.datetime.utcnow),
+    Column('modified', types.DateTime, default=datetime.datetime.utcnow),
+    Index('idx_cioos_harvest_identifier_package_id', 'package_id'),
+)
+
+_table_exists = []
+
+
+def deduplicate_enabled(source_config):
+    return toolkit.asbool(source_config.get('deduplicate_sources', toolkit.config.get('ckan.harvest_deduplicate_sources', False)))
+
+
+def init_db():
+    identifier_table.create(bind=model.meta.engine, checkfirst=True)
+
+
+def table_exists():
+    '''
+    True if the index table has been created. Checked until it has.
+    '''
+    if not _table_exists:
+        engine = model.meta.engine
+        with engine.connect() as connection:
+            if not engine.dialect.has_table(connection, identifier_table.name):
+                log.warning('The %s table does not exist, records are not deduplicated. '
+                            'Create it with `ckan cioos_harvest initdb`', identifier_table.name)
+                return False
+        _table_exists.append(True)
+    return True
+
+
+def normalize_doi(code):
+    if not isinstance(code, string_types):
+        return None
+    code = code.strip().lower()
+    for prefix in DOI_PREFIXES:
+        if code.startswith(prefix):
+            code = code[len(prefix):]
+            break
+    return code if code.startswith('10.') else None
+
+
+def doi_identifiers(value):
+    '''
+    DOIs in a unique-resource-identifier-full value, a dict or list of dicts
+    with a `code` or their json
+    '''
+    value = normalize.from_json(value) if value else value
+    if isinstance(value, dict):
+        value = [value]
+    dois = []
+    for item in value or []:
+        doi = normalize_doi(item.get('code')) if isinstance(item, dict) else None
+        if doi and doi not in dois:
+            dois.append(doi)
+    return dois
+
+
+def record_identifiers(guid, uri_value, extra_guids=()):
+    '''
+    (identifier, kind) pairs of a record
+    '''
+    identifiers = []
+    for value in [guid] + list(extra_guids):
+        if value and (value, 'guid') not in identifiers:
+            identifiers.append((value, 'guid'))
+    identifiers.extend((doi, 'doi') for doi in doi_identifiers(uri_value))
+    return identifiers
+
+
+def _precedence(source_id, names):
+    '''
+    Sort key of a source, lower wins
+    '''
+    precedence = toolkit.aslist(toolkit.config.get('ckan.harvest_source_precedence'))
+    for key in (source_id, names.get(source_id)):
+        if key in precedence:
+            return precedence.index(key)
+    return len(precedence)
+
+
+def _source_names(source_ids):
+    return dict(model.Session.query(model.Package.id, model.Package.name)
+                .filter(model.Package.id.in_(source_ids)))
+
+
+def _package_active(package_id):
+    package = model.Package.get(package_id)
+    return package is not None and package.state == 'active'
+
+
+def preferred_copy(identifiers, source_id):
+    '''
+    (source id, package id) of the copy of a record that wins over the
+    copy from `source_id`, or None if this source's copy should be imported
+    '''
+    if not identifiers or not table_exists():
+        return None
+    rows = model.Session.execute(
+        identifier_table.select()
+        .where(identifier_table.c.identifier.in_([identifier for identifier, _ in identifiers]))).fetchall()
+    if not rows or all(row.source_id == source_id for row in rows):
+        return None
+
+    now = datetime.datetime.utcnow()
+    candidates = {source_id: (now, None)}
+    for row in rows:
+        if row.source_id == source_id:
+            candidates[source_id] = (min(candidates[source_id][0], row.created or now), None)
+        elif _package_active(row.package_id):
+            created, _ = candidates.get(row.source_id, (now, None))
+            candidates[row.source_id] = (min(created, row.created or now), row.package_id)
+    names = _source_names(list(candidates))
+    winner = min(candidates, key=lambda candidate: (_precedence(candidate, names), candidates[candidate][0]))
+    if winner == source_id:
+        return None
+    return winner, candidates[winner][1]
+
+
+def record(identifiers, source_id, package_id):
+    '''
+    Add the identifiers of a record imported from `source_id` to the index.
+    Not committed, the caller commits with the package.
+    '''
+    if not identifiers or not package_id or not table_exists():
+        return
+    now = datetime.datetime.utcnow()
+    for identifier, kind in identifiers:
+        statement = insert(identifier_table).values(
+            identifier=identifier, source_id=source_id, kind=kind,
+            package_id=package_id, created=now, modified=now)
+        model.Session.execute(statement.on_conflict_do_update(
+            index_elements=[identifier_table.c.identifier, identifier_table.c.source_id],
+            set_={'kind': kind, 'package_id': package_id, 'modified': now}))
+
+
+def merge_data_catalogues(package_id, catalogues, user, get_action=None):
+    '''
+    Add the data catalogues in `catalogues` that are missing from the
+    included_in_data_catalogue of a package. Returns True if it was updated.
+    '''
+    get_action = get_action or toolkit.get_action
+    context = {'model': model, 'session': model.Session, 'user': user, 'ignore_auth': True}
+    package_dict = get_action('package_show')(context.copy(), {'id': package_id})
+    existing = normalize.from_json(package_dict.get('included_in_data_catalogue')) or []
+    if isinstance(existing, dict):
+        existing = [existing]
+    urls = set((item.get('url') or '').strip('/') for item in existing)
+    missing = []
+    for catalogue in catalogues:
+        url = (catalogue.get('url') or '').strip('/')
+        if url and url not in urls:
+            urls.add(url)
+            missing.append(catalogue)
+    if not missing:
+        return False
+    log.info('Adding data catalogues %s to %s', ', '.join(c['url'] for c in missing), package_id)
+    get_action('package_patch')(context.copy(), {
+        'id': package_dict['id'],
+        'included_in_data_catalogue': existing + missing,
+    })
+    return True
@@ -0,0 +1,135 @@
+# encoding: utf-8
+'''
+Deferred search indexing for harvest jobs.
+
+With defer_indexing enabled for a harvest source, datasets written while
+importing its harvest objects are not indexed as they are written. The
+datasets of the job are indexed, with a single solr commit, once
+ckanext-harvest marks the job as finished and reindexes the harvest source.
+
+Jobs waiting to be indexed are recorded as marker files in the plugin storage
+directory, so a job that was not indexed, because the process running
+harvest_jobs_run died for example, is indexed the next time a job of the same
+source finishes.
+'''
+import os
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from ckan import model
+import ckan.plugins.toolkit as toolkit
+from ckan.lib.search import commit, index_for
+from ckanext.harvest.model import HarvestJob, HarvestObject
+
+from ckanext.cioos_harvest.blobstore import get_storage_dir
+
+import logging
+log = logging.getLogger(__name__)
+
+AUTOMATIC_INDEXING = 'ckan.search.automatic_indexing'
+
+# jobs this process has already written a marker for
+_marked_jobs = set()
+# value of ckan.search.automatic_indexing to restore at the end of the
+# current transaction
+_restore_after_transaction = []
+_listening = []
+
+
+def defer_indexing_enabled(source_config):
+    return toolkit.asbool(source_config.get('defer_indexing', toolkit.config.get('ckan.harvest_defer_indexing', False)))
+
+
+def _pending_dir(source_id):
+    return get_storage_dir('pending_index', source_id)
+
+
+def mark_job_pending(harvest_object):
+    '''
+    Record that the datasets of this harvest object's job need indexing
+    '''
+    job_id = harvest_object.harvest_job_id
+    if job_id in _marked_jobs:
+        return
+    directory = _pending_dir(harvest_object.source.id)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    open(os.path.join(directory, job_id), 'a').close()
+    _marked_jobs.add(job_id)
+
+
+@contextmanager
+def automatic_indexing_disabled():
+    previous = toolkit.config.get(AUTOMATIC_INDEXING, True)
+    toolkit.config[AUTOMATIC_INDEXING] = False
+    try:
+        yield
+    finally:
+        toolkit.config[AUTOMATIC_INDEXING] = previous
+
+
+def _restore_automatic_indexing(session, *args):
+    while _restore_after_transaction:
+        toolkit.config[AUTOMATIC_INDEXING] = _restore_after_transaction.pop()
+
+
+def disable_automatic_indexing_until_commit():
+    '''
+    Turn automatic indexing off until the current transaction is committed or
+    rolled back. Used by hooks that run before a write they do not control,
+    like the spatial harvester's package_create or package_update.
+    '''
+    if not _listening:
+        event.listen(model.Session, 'after_commit', _restore_automatic_indexing)
+        event.listen(model.Session, 'after_rollback', _restore_automatic_indexing)
+        _listening.append(True)
+    if not _restore_after_transaction:
+        _restore_after_transaction.append(toolkit.config.get(AUTOMATIC_INDEXING, True))
+    toolkit.config[AUTOMATIC_INDEXING] = False
+
+
+def index_job_packages(job_id):
+    '''
+    Index the datasets written by a harvest job and commit once at the end
+    '''
+    package_ids = [row[0] for row in model.Session.query(HarvestObject.package_id)
+                   .filter(HarvestObject.harvest_job_id == job_id)
+                   .filter(HarvestObject.package_id != None)  # noqa: E711
+                   .distinct()]
+    package_index = index_for(model.Package)
+    context = {'model': model, 'ignore_auth': True, 'validate': False, 'use_cache': False}
+    for package_id in package_ids:
+        try:
+            pkg_dict = toolkit.get_action('package_show')(context.copy(), {'id': package_id})
+        except toolkit.ObjectNotFound:
+            continue
+        if pkg_dict.get('state') == 'deleted':
+            package_index.remove_dict(pkg_dict)
+        else:
+            package_index.update_dict(pkg_dict, defer_commit=True)
+    commit()
+    log.info('Indexed %s datasets from harvest job %s', len(package_ids), job_id)
+    return len(package_ids)
+
+
+def index_pending_jobs(source_id):
+    '''
+    Index the datasets of the finished jobs of a source that are waiting to
+    be indexed
+    '''
+    directory = _pending_dir(source_id)
+    if not os.path.isdir(directory):
+        return
+    for job_id in os.listdir(directory):
+        job = HarvestJob.get(job_id)
+        if job is not None:
+            if job.status != 'Finished':
+                continue
+            index_job_packages(job_id)
+        os.remove(os.path.join(directory, job_id))
+        _marked_jobs.discard(job_id)
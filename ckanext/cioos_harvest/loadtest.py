@@ -0,0 +1,377 @@
+# encoding: utf-8
+'''
+Local stand-in for remote CKAN portals and WAF servers, for load testing the
+harvesters without touching partner portals.
+
+FakePortal serves a synthetic catalogue of `datasets` records over HTTP:
+
+    /api/action/package_search    CKAN dataset search, at most `page_size` rows
+                                  per page
+    /api/2/search/dataset/geo     CKAN spatial search, returns the ids of a
+                                  fixed fraction of the datasets
+    /waf/                         Apache style listing of ISO 19115 documents
+    /waf/<name>.xml               the ISO document of a dataset, also used as
+                                  the xml_location_url of the CKAN datasets
+
+Every request waits `latency` seconds and fails with a 500 error with a
+probability of `error_rate`. The catalogue is generated from a seed and does
+not change between requests, so repeated harvests of it exercise the
+unchanged dataset code paths.
+
+run_load_test runs complete gather, fetch and import cycles against a portal
+in the current process and reports the time taken by each stage. Only these
+functions need ckan, it is imported where they use it.
+'''
+import datetime
+import json
+import random
+import threading
+import time
+import uuid
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import parse_qs, urlparse
+
+import logging
+log = logging.getLogger(__name__)
+
+BASE_DATE = datetime.datetime(2020, 1, 1)
+
+ISO_TEMPLATE = u'''<?xml version="1.0" encoding="UTF-8"?>
+<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd" xmlns:gco="http://www.isotc211.org/2005/gco">
+  <gmd:fileIdentifier><gco:CharacterString>{id}</gco:CharacterString></gmd:fileIdentifier>
+  <gmd:language><gco:CharacterString>eng</gco:CharacterString></gmd:language>
+  <gmd:hierarchyLevel><gmd:MD_ScopeCode codeList="http://standards.iso.org/iso/19139/resources/gmxCodelists.xml#MD_ScopeCode" codeListValue="dataset">dataset</gmd:MD_ScopeCode></gmd:hierarchyLevel>
+  <gmd:contact><gmd:CI_ResponsibleParty>
+    <gmd:organisationName><gco:CharacterString>Load Test Organization {group}</gco:CharacterString></gmd:organisationName>
+    <gmd:role><gmd:CI_RoleCode codeList="http://standards.iso.org/iso/19139/resources/gmxCodelists.xml#CI_RoleCode" codeListValue="pointOfContact">pointOfContact</gmd:CI_RoleCode></gmd:role>
+  </gmd:CI_ResponsibleParty></gmd:contact>
+  <gmd:dateStamp><gco:DateTime>{modified}</gco:DateTime></gmd:dateStamp>
+  <gmd:identificationInfo><gmd:MD_DataIdentification>
+    <gmd:citation><gmd:CI_Citation>
+      <gmd:title><gco:CharacterString>{title}</gco:CharacterString></gmd:title>
+      <gmd:date><gmd:CI_Date>
+        <gmd:date><gco:Date>{created}</gco:Date></gmd:date>
+        <gmd:dateType><gmd:CI_DateTypeCode codeList="http://standards.iso.org/iso/19139/resources/gmxCodelists.xml#CI_DateTypeCode" codeListValue="publication">publication</gmd:CI_DateTypeCode></gmd:dateType>
+      </gmd:CI_Date></gmd:date>
+    </gmd:CI_Citation></gmd:citation>
+    <gmd:abstract><gco:CharacterString>{abstract}</gco:CharacterString></gmd:abstract>
+    <gmd:descriptiveKeywords><gmd:MD_Keywords>
+      <gmd:keyword><gco:CharacterString>load test</gco:CharacterString></gmd:keyword>
+      <gmd:keyword><gco:CharacterString>keyword {group}</gco:CharacterString></gmd:keyword>
+    </gmd:MD_Keywords></gmd:descriptiveKeywords>
+    <gmd:extent><gmd:EX_Extent><gmd:geographicElement><gmd:EX_GeographicBoundingBox>
+      <gmd:westBoundLongitude><gco:Decimal>{west}</gco:Decimal></gmd:westBoundLongitude>
+      <gmd:eastBoundLongitude><gco:Decimal>{east}</gco:Decimal></gmd:eastBoundLongitude>
+      <gmd:southBoundLatitude><gco:Decimal>{south}</gco:Decimal></gmd:southBoundLatitude>
+      <gmd:northBoundLatitude><gco:Decimal>{north}</gco:Decimal></gmd:northBoundLatitude>
+    </gmd:EX_GeographicBoundingBox></gmd:geographicElement></gmd:EX_Extent></gmd:extent>
+  </gmd:MD_DataIdentification></gmd:identificationInfo>
+  <gmd:distributionInfo><gmd:MD_Distribution><gmd:transferOptions><gmd:MD_DigitalTransferOptions>
+{online_resources}
+  </gmd:MD_DigitalTransferOptions></gmd:transferOptions></gmd:MD_Distribution></gmd:distributionInfo>
+</gmd:MD_Metadata>
+'''
+
+ONLINE_RESOURCE_TEMPLATE = u'''    <gmd:onLine><gmd:CI_OnlineResource>
+      <gmd:linkage><gmd:URL>{url}</gmd:URL></gmd:linkage>
+      <gmd:protocol><gco:CharacterString>WWW:LINK</gco:CharacterString></gmd:protocol>
+      <gmd:name><gco:CharacterString>{name}</gco:CharacterString></gmd:name>
+    </gmd:CI_OnlineResource></gmd:onLine>'''
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def _respond(self, body=None):
+        portal = self.server.portal
+        url = urlparse(self.path)
+        status, content_type, content = portal.handle(self.command, url.path, parse_qs(url.query), body)
+        content = content.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self._respond(self.rfile.read(length).decode('utf-8') if length else '')
+
+    def log_message(self, format, *args):
+        log.debug('%s - %s', self.address_string(), format % args)
+
+
+class FakePortal(object):
+    '''
+    Synthetic CKAN portal and WAF server, see the module documentation
+    '''
+
+    def __init__(self, datasets=1000, page_size=100, latency=0.0, error_rate=0.0,
+                 resources=2, spatial_fraction=0.5, external_xml=True, seed=0,
+                 host='127.0.0.1', port=0):
+        self.datasets = datasets
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.resources = resources
+        self.spatial_fraction = spatial_fraction
+        self.external_xml = external_xml
+        self.seed = seed
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._server = None
+        # package_search results are sorted by id like the harvesters ask for
+        self._order = sorted(range(datasets), key=self.dataset_id)
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % (self.host, self.port)
+
+    def start(self):
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.portal = self
+        self.port = self._server.server_address[1]
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        log.info('Fake portal with %s datasets serving on %s', self.datasets, self.url)
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def dataset_name(self, index):
+        return 'loadtest-%06d' % index
+
+    def dataset_id(self, index):
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, 'loadtest/%s/%s' % (self.seed, index)))
+
+    def dataset_modified(self, index):
+        return BASE_DATE + datetime.timedelta(minutes=index)
+
+    def _bbox(self, index):
+        rand = random.Random('%s/%s' % (self.seed, index))
+        west = round(rand.uniform(-140, -55), 3)
+        south = round(rand.uniform(40, 80), 3)
+        return west, round(west + rand.uniform(0.1, 5), 3), south, round(south + rand.uniform(0.1, 5), 3)
+
+    def in_spatial_search(self, index):
+        return index % 100 < self.spatial_fraction * 100
+
+    def package_dict(self, index):
+        name = self.dataset_name(index)
+        modified = self.dataset_modified(index).isoformat()
+        west, east, south, north = self._bbox(index)
+        title = 'Load test dataset %s' % index
+        return {
+            'id': self.dataset_id(index),
+            'name': name,
+            'title': json.dumps({'en': title, 'fr': title}),
+            'notes': json.dumps({'en': 'Synthetic dataset %s for load testing' % index,
+                                 'fr': 'Jeu de donnees synthetique %s' % index}),
+            'type': 'dataset',
+            'state': 'active',
+            'metadata_created': BASE_DATE.isoformat(),
+            'metadata_modified': modified,
+            'organization': {'id': 'loadtest-org-%s' % (index % 10),
+                             'name': 'loadtest-org-%s' % (index % 10),
+                             'title': 'Load Test Organization %s' % (index % 10)},
+            'groups': [],
+            'tags': [{'name': 'loadtest'}],
+            'spatial': json.dumps({'type': 'Polygon', 'coordinates': [[
+                [west, south], [east, south], [east, north], [west, north], [west, south]]]}),
+            'xml_location_url': '%s/waf/%s.xml' % (self.url, name) if self.external_xml else '',
+            'harvest_document_content': '',
+            'extras': [],
+            'resources': [{
+                'id': str(uuid.uuid5(uuid.NAMESPACE_URL, '%s/%s' % (name, r))),
+                'name': 'Resource %s' % r,
+                'url': '%s/data/%s/%s.csv' % (self.url, name, r),
+                'format': 'CSV',
+            } for r in range(self.resources)],
+        }
+
+    def iso_document(self, index):
+        name = self.dataset_name(index)
+        west, east, south, north = self._bbox(index)
+        return ISO_TEMPLATE.format(
+            id=self.dataset_id(index),
+            title='Load test dataset %s' % index,
+            abstract='Synthetic dataset %s for load testing' % index,
+            group=index % 10,
+            created=BASE_DATE.date().isoformat(),
+            modified=self.dataset_modified(index).isoformat(),
+            west=west, east=east, south=south, north=north,
+            online_resources='\n'.join(ONLINE_RESOURCE_TEMPLATE.format(
+                url='%s/data/%s/%s.csv' % (self.url, name, r), name='Resource %s' % r)
+                for r in range(self.resources)))
+
+    def waf_listing(self):
+        lines = ['<html><head><title>Index of /waf</title></head><body>',
+                 '<h1>Index of /waf</h1><pre>']
+        for index in range(self.datasets):
+            name = self.dataset_name(index)
+            lines.append('<a href="%s.xml">%s.xml</a>    %s  4.0K' % (
+                name, name, self.dataset_modified(index).strftime('%d-%b-%Y %H:%M')))
+        lines.append('</pre></body></html>')
+        return '\n'.join(lines)
+
+    def _package_search(self, query):
+        rows = min(int((query.get('rows') or [10])[0]), self.page_size)
+        start = int((query.get('start') or [0])[0])
+        results = [self.package_dict(index) for index in self._order[start:start + rows]]
+        return {'success': True, 'result': {'count': self.datasets, 'results': results}}
+
+    def _spatial_search(self):
+        return {'results': [self.dataset_id(index) for index in range(self.datasets)
+                            if self.in_spatial_search(index)]}
+
+    def _index_from_name(self, name):
+        try:
+            index = int(name.rsplit('-', 1)[-1])
+        except ValueError:
+            return None
+        return index if 0 <= index < self.datasets else None
+
+    def handle(self, method, path, query, body=None):
+        '''
+        Return (status, content type, content) for a request
+        '''
+        with self._lock:
+            self.requests += 1
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            return 500, 'text/plain', 'Injected error'
+
+        if path.endswith('/api/action/package_search') or path.endswith('/api/3/action/package_search'):
+            return 200, 'application/json', json.dumps(self._package_search(query))
+        if path.endswith('/api/2/search/dataset/geo'):
+            return 200, 'application/json', json.dumps(self._spatial_search())
+        if path.rstrip('/') == '/waf':
+            return 200, 'text/html', self.waf_listing()
+        if path.startswith('/waf/') and path.endswith('.xml'):
+            index = self._index_from_name(path[len('/waf/'):-len('.xml')])
+            if index is not None:
+                return 200, 'application/xml', self.iso_document(index)
+        return 404, 'text/plain', 'Not found'
+
+
+def _context():
+    from ckan import model
+    import ckan.plugins.toolkit as toolkit
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    return {'model': model, 'session': model.Session, 'user': site_user['name'], 'ignore_auth': True}
+
+
+def create_source(portal, source_type, source_config=None, owner_org=None):
+    '''
+    Create a harvest source for `portal`
+    '''
+    import ckan.plugins.toolkit as toolkit
+    name = 'loadtest-%s' % uuid.uuid4().hex[:8]
+    url = portal.url + '/waf/' if source_type == 'waf' else portal.url
+    data_dict = {
+        'name': name,
+        'title': 'Load test %s' % name,
+        'url': url,
+        'source_type': source_type,
+        'frequency': 'MANUAL',
+        'config': json.dumps(source_config or {}),
+    }
+    if owner_org:
+        data_dict['owner_org'] = owner_org
+    return toolkit.get_action('harvest_source_create')(_context(), data_dict)
+
+
+def run_cycle(source, harvester):
+    '''
+    Run one harvest job for `source` the way the gather and fetch consumers
+    would, and return the time taken by each stage
+    '''
+    from ckan import model
+    import ckan.plugins.toolkit as toolkit
+    from ckanext.harvest import queue
+    from ckanext.harvest.model import HarvestJob, HarvestObject
+
+    context = _context()
+    job_dict = toolkit.get_action('harvest_job_create')(context.copy(), {'source_id': source['id'], 'run': False})
+    job = HarvestJob.get(job_dict['id'])
+    job.status = 'Running'
+    job.save()
+
+    stats = {'job_id': job.id, 'report_status': {}}
+    start = time.time()
+    object_ids = queue.gather_stage(harvester, job)
+    if not isinstance(object_ids, list):
+        object_ids = []
+    stats['gather_seconds'] = time.time() - start
+    stats['objects'] = len(object_ids)
+
+    start = time.time()
+    for object_id in object_ids:
+        harvest_object = HarvestObject.get(object_id)
+        queue.fetch_and_import_stages(harvester, harvest_object)
+        status = harvest_object.report_status or harvest_object.state
+        stats['report_status'][status] = stats['report_status'].get(status, 0) + 1
+        model.Session.remove()
+    stats['import_seconds'] = time.time() - start
+
+    # marks the job finished and reindexes the source
+    start = time.time()
+    toolkit.get_action('harvest_jobs_run')(context.copy(), {'source_id': source['id']})
+    stats['finish_seconds'] = time.time() - start
+    stats['total_seconds'] = stats['gather_seconds'] + stats['import_seconds'] + stats['finish_seconds']
+    return stats
+
+
+def run_load_test(portal, source_type, cycles=1, source_config=None, owner_org=None, keep=False):
+    '''
+    Harvest `portal` `cycles` times with a new harvest source of `source_type`.
+    Yields the stats of each cycle. The source and its datasets are removed
+    at the end unless `keep` is set.
+    '''
+    import ckan.plugins.toolkit as toolkit
+    from ckanext.harvest import queue
+
+    harvester = queue.get_harvester(source_type)
+    if harvester is None:
+        raise toolkit.ValidationError({'source_type': ['No harvester found for type %s' % source_type]})
+    source = create_source(portal, source_type, source_config, owner_org)
+    try:
+        for cycle in range(cycles):
+            requests_before, errors_before = portal.requests, portal.errors
+            stats = run_cycle(source, harvester)
+            stats['cycle'] = cycle + 1
+            stats['requests'] = portal.requests - requests_before
+            stats['request_errors'] = portal.errors - errors_before
+            yield stats
+    finally:
+        if not keep:
+            context = _context()
+            context['clear_source'] = True
+            toolkit.get_action('harvest_source_delete')(context, {'id': source['id']})
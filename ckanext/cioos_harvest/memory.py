@@ -0,0 +1,248 @@
+# encoding: utf-8
+'''
+Memory accounting for harvest import workers.
+
+With the memory monitor enabled, tracemalloc records the memory allocated by
+each stage (fetch, import, the plugin hooks) of every harvest object. Objects
+that allocate more then `ckan.harvest_memory_object_threshold_mb` in a stage
+are logged, and when the worker imports the last object of a job a report
+with the memory allocated per stage and the top allocation sites since the
+start of the job is logged and written to the `memory` directory in the
+plugin storage directory.
+
+Independently of the monitor, a fetch worker started with
+`ckan cioos_harvest fetch-consumer` whose resident memory has grown by more
+then `ckan.harvest_memory_recycle_mb` since it started exits between two
+harvest objects, so the process supervisor can replace it. The worker exits
+after the previous object has been acknowledged and before the next one is
+taken from the queue, never inside a harvest stage, so no object is left
+half imported or counted as a retry.
+'''
+import functools
+import json
+import os
+import resource
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ckan import model
+import ckan.plugins.toolkit as toolkit
+from ckanext.harvest.model import HarvestObject
+
+from ckanext.cioos_harvest.blobstore import get_storage_dir
+
+import logging
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+TRACE_FRAMES = 5
+# number of jobs a worker keeps memory stats for
+MAX_TRACKED_JOBS = 10
+UNFINISHED_STATES = ('WAITING', 'FETCH', 'IMPORT')
+
+_monitor = None
+_recycle = {'start_rss': None, 'pending': False}
+
+
+def monitor_enabled(source_config):
+    return toolkit.asbool(source_config.get('memory_monitor', toolkit.config.get('ckan.harvest_memory_monitor', False)))
+
+
+def _config_mb(key, default):
+    return float(toolkit.config.get(key) or default) * MB
+
+
+def rss_bytes():
+    '''
+    Resident memory of this process
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        # peak rather then current resident memory, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _filtered(snapshot):
+    return snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    ))
+
+
+class MemoryMonitor(object):
+    '''
+    Collects the memory allocated per harvest object and stage, by job
+    '''
+
+    def __init__(self, threshold, top_sites=10):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+        self.threshold = threshold
+        self.top_sites = top_sites
+        self.jobs = OrderedDict()
+        self._depth = 0
+
+    def _job_stats(self, job_id):
+        stats = self.jobs.get(job_id)
+        if stats is None:
+            stats = self.jobs[job_id] = {
+                'started': time.time(),
+                'objects': set(),
+                'stages': {},
+                'flagged': [],
+                'baseline': _filtered(tracemalloc.take_snapshot()),
+            }
+            while len(self.jobs) > MAX_TRACKED_JOBS:
+                self.report(next(iter(self.jobs)))
+        return stats
+
+    @contextmanager
+    def stage(self, harvest_object, stage):
+        stats = self._job_stats(harvest_object.harvest_job_id)
+        outermost = self._depth == 0
+        # the peak can only be measured for the outermost stage, resetting
+        # it for a nested stage would lose the peak of the enclosing one
+        if outermost and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            current, peak = tracemalloc.get_traced_memory()
+            allocated = current - before
+            peak = peak - before if outermost and hasattr(tracemalloc, 'reset_peak') else allocated
+            stats['objects'].add(harvest_object.id)
+            stage_stats = stats['stages'].setdefault(stage, {'calls': 0, 'allocated': 0, 'peak': 0})
+            stage_stats['calls'] += 1
+            stage_stats['allocated'] += allocated
+            stage_stats['peak'] = max(stage_stats['peak'], peak)
+            if max(allocated, peak) > self.threshold:
+                session_objects = len(model.Session.identity_map)
+                stats['flagged'].append((harvest_object.id, stage, allocated, peak, session_objects))
+                log.warning(
+                    'Harvest object %s allocated %.1f MB in %s, peak %.1f MB, '
+                    '%s objects in the database session',
+                    harvest_object.id, allocated / float(MB), stage, peak / float(MB), session_objects)
+
+    def object_finished(self, harvest_object):
+        '''
+        Report the job of `harvest_object` if no objects of the job are left
+        to import
+        '''
+        job_id = harvest_object.harvest_job_id
+        if job_id not in self.jobs:
+            return
+        remaining = (model.Session.query(HarvestObject.id)
+                     .filter(HarvestObject.harvest_job_id == job_id)
+                     .filter(HarvestObject.state.in_(UNFINISHED_STATES))
+                     .filter(HarvestObject.id != harvest_object.id)
+                     .count())
+        if not remaining:
+            self.report(job_id)
+
+    def report(self, job_id):
+        stats = self.jobs.pop(job_id)
+        snapshot = _filtered(tracemalloc.take_snapshot())
+        lines = ['Memory report for harvest job %s, %s objects in %.0fs, worker pid %s, rss %.1f MB' % (
+            job_id, len(stats['objects']), time.time() - stats['started'], os.getpid(), rss_bytes() / float(MB))]
+        lines.append('Allocated per stage:')
+        for stage, stage_stats in sorted(stats['stages'].items()):
+            lines.append('  %s: %s calls, %.1f MB retained, %.1f MB largest peak' % (
+                stage, stage_stats['calls'], stage_stats['allocated'] / float(MB), stage_stats['peak'] / float(MB)))
+        if stats['flagged']:
+            lines.append('Objects over the %.1f MB threshold:' % (self.threshold / float(MB)))
+            for object_id, stage, allocated, peak, session_objects in stats['flagged']:
+                lines.append('  %s %s: %.1f MB allocated, %.1f MB peak, %s session objects' % (
+                    object_id, stage, allocated / float(MB), peak / float(MB), session_objects))
+        lines.append('Top allocation sites since the start of the job:')
+        for diff in snapshot.compare_to(stats['baseline'], 'lineno')[:self.top_sites]:
+            lines.append('  %s' % diff)
+        report = '\n'.join(lines)
+        log.info(report)
+
+        directory = get_storage_dir('memory')
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(os.path.join(directory, '%s-%s.txt' % (job_id, os.getpid())), 'w') as f:
+                f.write(report + '\n')
+        except (IOError, OSError) as e:
+            log.warning('Unable to write memory report for job %s: %s', job_id, e)
+        return report
+
+
+def get_monitor():
+    global _monitor
+    if _monitor is None:
+        _monitor = MemoryMonitor(
+            _config_mb('ckan.harvest_memory_object_threshold_mb', 50),
+            int(toolkit.config.get('ckan.harvest_memory_top_sites') or 10))
+    return _monitor
+
+
+def _source_config(harvest_object):
+    return json.loads(harvest_object.source.config or '{}')
+
+
+@contextmanager
+def monitored(harvest_object, stage):
+    '''
+    Record the memory allocated by `stage` for `harvest_object` when the
+    monitor is enabled for its source
+    '''
+    if harvest_object is None or not monitor_enabled(_source_config(harvest_object)):
+        yield
+        return
+    with get_monitor().stage(harvest_object, stage):
+        yield
+
+
+def monitor_stage(stage, get_harvest_object):
+    '''
+    Decorator form of `monitored`. `get_harvest_object` returns the harvest
+    object from the arguments of the decorated function
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with monitored(get_harvest_object(*args, **kwargs), stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def recycle_if_requested():
+    '''
+    Called by the fetch consumer between harvest objects. Exits the worker if
+    its memory grew past the recycle limit while importing earlier objects.
+    '''
+    if _recycle['start_rss'] is None:
+        _recycle['start_rss'] = rss_bytes()
+    if _recycle['pending']:
+        log.warning('Exiting harvest worker %s to release memory, rss %.1f MB',
+                    os.getpid(), rss_bytes() / float(MB))
+        raise SystemExit(3)
+
+
+def object_finished(harvest_object):
+    '''
+    Called when a worker has finished importing a harvest object
+    '''
+    if _monitor is not None and monitor_enabled(_source_config(harvest_object)):
+        _monitor.object_finished(harvest_object)
+
+    limit = _config_mb('ckan.harvest_memory_recycle_mb', 0)
+    if limit and _recycle['start_rss'] is not None:
+        growth = rss_bytes() - _recycle['start_rss']
+        if growth > limit:
+            log.warning('Harvest worker %s grew by %.1f MB, over the %.1f MB limit. '
+                        'It will exit before taking the next harvest object.',
+                        os.getpid(), growth / float(MB), limit / float(MB))
+            _recycle['pending'] = True
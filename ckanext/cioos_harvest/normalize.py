@@ -0,0 +1,111 @@
+# encoding: utf-8
+'''
+Value normalization shared by the harvest hooks.
+
+Most harvested names, descriptions and keywords are plain strings, so the
+json helpers below only call json.loads when a value could actually be json
+instead of relying on the exception for every string.
+'''
+import json
+from numbers import Number
+
+from six import string_types
+
+# json text can only start with one of these characters or be one of the
+# literals below
+_JSON_START_CHARS = frozenset('{["-0123456789')
+_JSON_LITERALS = frozenset(['true', 'false', 'null', 'NaN', 'Infinity'])
+
+MUNGED_TAG_CACHE_SIZE = 10000
+_munged_tags = {}
+
+
+def looks_like_json(value):
+    stripped = value.strip()
+    if not stripped:
+        return False
+    return stripped[0] in _JSON_START_CHARS or stripped in _JSON_LITERALS
+
+
+def from_json(value):
+    '''
+    Return the decoded value if `value` is json, otherwise return it unchanged
+    '''
+    if isinstance(value, string_types) and not looks_like_json(value):
+        return value
+    try:
+        return json.loads(value)
+    except Exception:
+        return value
+
+
+def as_language_dict(value, languages):
+    '''
+    Return `value` as a fluent language dictionary. Values that are not
+    already a language dictionary are used for each language in `languages`
+    '''
+    value = from_json(value)
+    if isinstance(value, dict):
+        return value
+    return dict((lang, value) for lang in languages)
+
+
+def munge_tag(tag):
+    '''
+    munge.munge_tag with a cache, keyword heavy sources repeat the same
+    keywords in most records
+    '''
+    import ckan.lib.munge as munge
+    try:
+        return _munged_tags[tag]
+    except KeyError:
+        pass
+    except TypeError:
+        return munge.munge_tag(tag)
+    munged = munge.munge_tag(tag)
+    if len(_munged_tags) >= MUNGED_TAG_CACHE_SIZE:
+        _munged_tags.clear()
+    _munged_tags[tag] = munged
+    return munged
+
+
+def unique(values):
+    '''
+    Remove duplicates from a list keeping the first occurrence of each value
+    '''
+    seen = set()
+    result = []
+    for value in values:
+        try:
+            if value in seen:
+                continue
+            seen.add(value)
+        except TypeError:
+            # unhashable values, lists of keywords for example
+            if value in result:
+                continue
+        result.append(value)
+    return result
+
+
+def trim_values(values):
+    '''
+    Strip white space from all strings, dictionary keys and json encoded
+    strings in `values`
+    '''
+    if isinstance(values, Number):
+        return values
+    elif isinstance(values, list):
+        return [trim_values(x) for x in values]
+    elif isinstance(values, dict):
+        return {k.strip(): trim_values(v) for k, v in values.items()}
+    elif isinstance(values, str):
+        if not looks_like_json(values):
+            return values.strip()
+        try:
+            json_object = json.loads(values)
+        except ValueError:
+            return values.strip()
+        else:
+            return json.dumps(trim_values(json_object))
+    return values
@@ -0,0 +1,167 @@
+# encoding: utf-8
+'''
+Compare a harvested package dict with the existing package.
+
+Values are compared after the same normalization the harvest hooks apply,
+json encoded strings are decoded and white space is trimmed (see
+normalize.trim_values), and extras are compared as a dictionary. Only fields
+present in the harvested dict are compared, fields managed by CKAN are
+ignored.
+'''
+from six import string_types
+
+from ckanext.cioos_harvest import normalize
+
+IGNORED_FIELDS = frozenset([
+    'id', 'name', 'metadata_created', 'metadata_modified', 'revision_id',
+    'num_resources', 'num_tags', 'organization', 'creator_user_id',
+    'relationships_as_object', 'relationships_as_subject', 'tracking_summary',
+    'isopen',
+])
+
+# added to package_show output by ckanext-harvest
+IGNORED_EXTRAS = frozenset([
+    'harvest_object_id', 'harvest_source_id', 'harvest_source_title',
+])
+
+IGNORED_RESOURCE_FIELDS = frozenset([
+    'id', 'package_id', 'position', 'created', 'last_modified',
+    'metadata_modified', 'revision_id', 'cache_last_updated', 'cache_url',
+    'datastore_active', 'url_type', 'tracking_summary', 'state',
+])
+
+
+def canonical(value):
+    '''
+    Normalized form of a value used for comparisons
+    '''
+    if isinstance(value, string_types):
+        decoded = normalize.from_json(value)
+        if isinstance(decoded, string_types):
+            return decoded.strip() or None
+        return canonical(decoded)
+    if isinstance(value, list):
+        return [canonical(x) for x in value] or None
+    if isinstance(value, dict):
+        return {k.strip(): canonical(v) for k, v in value.items()} or None
+    return value
+
+
+def _extras_as_dict(extras):
+    return {x['key']: canonical(x.get('value')) for x in extras or []
+            if x['key'] not in IGNORED_EXTRAS}
+
+
+def _group_keys(groups):
+    keys = set()
+    for group in groups or []:
+        keys.update(k for k in (group.get('id'), group.get('name')) if k)
+    return keys
+
+
+def groups_changed(existing_groups, new_groups):
+    existing_keys = _group_keys(existing_groups)
+    if len(new_groups or []) != len(existing_groups or []):
+        return True
+    return any(
+        not (existing_keys & set(k for k in (g.get('id'), g.get('name')) if k))
+        for g in new_groups or [])
+
+
+def tags_changed(existing_tags, new_tags):
+    def names(tags):
+        return sorted(t.get('name') if isinstance(t, dict) else t for t in tags or [])
+    return names(existing_tags) != names(new_tags)
+
+
+def resource_changed(existing_resource, new_resource):
+    for key, value in new_resource.items():
+        if key in IGNORED_RESOURCE_FIELDS:
+            continue
+        if canonical(value) != canonical(existing_resource.get(key)):
+            return True
+    return False
+
+
+def match_resources(existing_resources, new_resources):
+    '''
+    Pair each new resource with an existing one by id, or else by url. Returns
+    a list of (new resource, existing resource or None)
+    '''
+    by_id = dict((r['id'], r) for r in existing_resources or [] if r.get('id'))
+    unused = list(existing_resources or [])
+    pairs = []
+    for resource in new_resources or []:
+        match = by_id.get(resource.get('id'))
+        if match is None or not any(match is r for r in unused):
+            url = (resource.get('url') or '').strip()
+            match = next((r for r in unused if (r.get('url') or '').strip() == url), None)
+        if match is not None:
+            unused = [r for r in unused if r is not match]
+        pairs.append((resource, match))
+    return pairs
+
+
+def reuse_resource_ids(existing_resources, new_resources):
+    '''
+    Give new resources the id of the existing resource they replace, so
+    package_update updates them in place rather then deleting and recreating
+    them
+    '''
+    for resource, match in match_resources(existing_resources, new_resources):
+        if match is not None and match.get('id'):
+            resource['id'] = match['id']
+    return new_resources
+
+
+def merge_resources(existing_resources, new_resources):
+    '''
+    The resources to send to update `existing_resources` to `new_resources`.
+    Resources that did not change are sent as they are stored, so
+    package_update leaves them untouched, changed resources keep the id of
+    the resource they replace.
+    '''
+    resources = []
+    for resource, match in match_resources(existing_resources, new_resources):
+        if match is not None and not resource_changed(match, resource):
+            resources.append(match)
+            continue
+        if match is not None and match.get('id'):
+            resource['id'] = match['id']
+        resources.append(resource)
+    return resources
+
+
+def resources_changed(existing_resources, new_resources):
+    if len(new_resources or []) != len(existing_resources or []):
+        return True
+    return any(
+        match is None or resource_changed(match, resource)
+        for resource, match in match_resources(existing_resources, new_resources))
+
+
+def diff_package(existing, new, ignore_fields=()):
+    '''
+    Return a dict with the fields of `new` that differ from `existing`. An
+    empty dict means the package does not need to be updated. `resources`
+    is always the full list, see merge_resources.
+    '''
+    patch = {}
+    for key, value in new.items():
+        if key in IGNORED_FIELDS or key in ignore_fields:
+            continue
+        if key == 'extras':
+            changed = _extras_as_dict(existing.get('extras')) != _extras_as_dict(value)
+        elif key == 'groups':
+            changed = groups_changed(existing.get('groups'), value)
+        elif key == 'tags':
+            changed = tags_changed(existing.get('tags'), value)
+        elif key == 'resources':
+            changed = resources_changed(existing.get('resources'), value)
+            if changed:
+                value = merge_resources(existing.get('resources'), value)
+        else:
+            changed = canonical(value) != canonical(existing.get(key))
+        if changed:
+            patch[key] = value
+    return patch
@@ -0,0 +1,227 @@
+# encoding: utf-8
+'''
+Per harvest object profiles of the harvest hooks.
+
+Aggregate timings do not show why one record took much longer than the
+others. With profiling enabled the get_package_dict and modify_package_dict
+hooks of one in `ckan.harvest_profile_sample_rate` harvest objects run under
+cProfile. Independently, with `ckan.harvest_profile_threshold` set, a
+background thread samples the stack of every hook call and the samples of
+the calls that take longer than the threshold are kept.
+
+Profiles are written to the `profiles` directory of the plugin storage
+directory, one file per harvest object and hook:
+
+* `<harvest object id>.<hook>.prof`, cProfile stats readable with pstats
+* `<harvest object id>.<hook>.stacks`, sampled stacks in the collapsed
+  `frame;frame;frame count` format used by flame graph tools
+
+`ckan cioos_harvest profile-summary` merges them into a report of the
+functions that took the most time.
+'''
+import cProfile
+import functools
+import glob
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.cioos_harvest.blobstore import get_storage_dir
+
+import logging
+log = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.01
+MAX_STACK_DEPTH = 64
+
+_sampler = []
+_local = threading.local()
+
+
+def _setting(source_config, key, config_key, default):
+    return float(source_config.get(key) or toolkit.config.get(config_key) or default)
+
+
+def sample_rate(source_config):
+    return int(_setting(source_config, 'profile_sample_rate', 'ckan.harvest_profile_sample_rate', 0))
+
+
+def slow_threshold(source_config):
+    return _setting(source_config, 'profile_threshold', 'ckan.harvest_profile_threshold', 0)
+
+
+def get_profile_dir():
+    return toolkit.config.get('ckan.harvest_profile_path') or get_storage_dir('profiles')
+
+
+def is_sampled(harvest_object_id, rate):
+    '''
+    True for one in `rate` harvest objects. Decided on the id so every hook
+    of a sampled object is profiled.
+    '''
+    if rate <= 0:
+        return False
+    return zlib.crc32(harvest_object_id.encode('utf-8')) % rate == 0
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s:%s(%s)' % (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+class StackSampler(object):
+    '''
+    Background thread sampling the stacks of the threads it watches
+    '''
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self._watched = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='harvest-profile-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def watch(self, thread_id):
+        samples = Counter()
+        with self._lock:
+            self._watched[thread_id] = samples
+        return samples
+
+    def unwatch(self, thread_id):
+        with self._lock:
+            self._watched.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._watched:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, samples in self._watched.items():
+                    frame = frames.get(thread_id)
+                    stack = []
+                    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                        stack.append(_frame_name(frame))
+                        frame = frame.f_back
+                    if stack:
+                        samples[';'.join(reversed(stack))] += 1
+
+
+def get_sampler():
+    if not _sampler:
+        _sampler.append(StackSampler())
+    return _sampler[0]
+
+
+def _write(path, write):
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        write(path)
+        log.info('Wrote harvest profile %s', path)
+    except (IOError, OSError) as e:
+        log.warning('Unable to write harvest profile %s: %s', path, e)
+
+
+def _write_stacks(path, samples):
+    with open(path, 'w') as f:
+        for stack, count in samples.most_common():
+            f.write('%s %s\n' % (stack, count))
+
+
+@contextmanager
+def profiled(harvest_object, stage):
+    '''
+    Profile `stage` of `harvest_object` if it is sampled or, with a slow
+    threshold set, keep its stack samples if it is slow
+    '''
+    if harvest_object is None or getattr(_local, 'active', False):
+        # hooks called from a profiled hook are part of its profile
+        yield
+        return
+    source_config = json.loads(harvest_object.source.config or '{}')
+    rate = sample_rate(source_config)
+    threshold = slow_threshold(source_config)
+    if not rate and not threshold:
+        yield
+        return
+
+    profile = cProfile.Profile() if is_sampled(harvest_object.id, rate) else None
+    samples = get_sampler().watch(threading.current_thread().ident) if threshold else None
+    _local.active = True
+    start = time.time()
+    if profile:
+        try:
+            profile.enable()
+        except ValueError as e:
+            # another profiler is active in this thread
+            log.debug('Unable to profile harvest object %s: %s', harvest_object.id, e)
+            profile = None
+    try:
+        yield
+    finally:
+        if profile:
+            profile.disable()
+        seconds = time.time() - start
+        _local.active = False
+        if samples is not None:
+            get_sampler().unwatch(threading.current_thread().ident)
+        try:
+            path = os.path.join(get_profile_dir(), '%s.%s' % (harvest_object.id, stage))
+        except RuntimeError as e:
+            log.warning('Unable to write harvest profiles: %s', e)
+            profile = samples = None
+        if profile:
+            _write(path + '.prof', profile.dump_stats)
+        if samples and seconds > threshold:
+            log.warning('%s of harvest object %s took %.1fs', stage, harvest_object.id, seconds)
+            _write(path + '.stacks', lambda p: _write_stacks(p, samples))
+
+
+def profile_stage(stage, get_harvest_object):
+    '''
+    Decorator form of `profiled`. `get_harvest_object` returns the harvest
+    object from the arguments of the decorated function
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profiled(get_harvest_object(*args, **kwargs), stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profile_files(directory, extension):
+    return sorted(glob.glob(os.path.join(directory, '*.%s' % extension)))
+
+
+def merge_stacks(paths):
+    '''
+    Samples per function over the `.stacks` files in `paths`, as (own,
+    total) counters. Own samples are those with the function at the top of
+    the stack.
+    '''
+    own = Counter()
+    total = Counter()
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                if not stack:
+                    continue
+                frames = stack.split(';')
+                own[frames[-1]] += int(count)
+                for frame in set(frames):
+                    total[frame] += int(count)
+    return own, total
@@ -0,0 +1,399 @@
+# encoding: utf-8
+'''
+Record and replay the inputs of the harvest hooks.
+
+With capture enabled for a harvest source, every call to get_package_dict,
+modify_package_dict and modify_search is written to a corpus: the hook
+inputs, the harvest object and source config, the CKAN actions the hook
+called and the external XML and spatial search responses it received,
+together with the output of the hook. Each call is one line of a
+`records-<pid>.ndjson` file, harvest object content and response bodies are
+stored once, compressed, in a blob store next to them.
+
+The hooks make their actions and external requests through the `calls`
+argument they are given, see harvesters.HookCalls, so both can be done
+without touching the functions other code uses. The replay runs the hooks
+over a corpus offline. Actions are answered by in-memory stubs from the
+recorded responses and external requests from the recorded bodies, so a
+harvest can be re-run at full speed and the outputs compared with the
+captured outputs, or with an earlier replay.
+'''
+import functools
+import glob
+import importlib
+import json
+import os
+import time
+import uuid
+
+from ckan import model
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.cioos_harvest.blobstore import BlobStore, get_storage_dir
+
+import logging
+log = logging.getLogger(__name__)
+
+HOOKS = ('get_package_dict', 'modify_package_dict', 'modify_search')
+
+
+def capture_enabled(source_config):
+    return toolkit.asbool(source_config.get('capture', toolkit.config.get('ckan.harvest_capture', False)))
+
+
+def get_capture_dir():
+    return toolkit.config.get('ckan.harvest_capture_path') or get_storage_dir('capture')
+
+
+def _to_json(value):
+    # json compatible copy, dates and other objects are converted to strings
+    return json.loads(json.dumps(value, default=str))
+
+
+def _http_key(method, url, params):
+    return json.dumps([method, url, params], sort_keys=True)
+
+
+def _action_key(name, data_dict):
+    return json.dumps([name, _to_json(data_dict or {})], sort_keys=True)
+
+
+class Corpus(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.blobs = BlobStore(os.path.join(path, 'blobs'))
+
+    def put(self, data):
+        return self.blobs.put(data) if data else None
+
+    def get(self, reference):
+        return self.blobs.get(reference) if reference else None
+
+    def append(self, record):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+        # one file per process, harvest workers run in separate processes
+        path = os.path.join(self.path, 'records-%s.ndjson' % os.getpid())
+        with open(path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+    def records(self, hook=None):
+        for path in sorted(glob.glob(os.path.join(self.path, '*.ndjson'))):
+            with open(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if hook is None or record['hook'] == hook:
+                        yield record
+
+
+class _Recorder(object):
+    '''
+    Records the actions and external requests a hook makes through `calls`,
+    a harvesters.HookCalls. Passed to the hook as its `calls` argument.
+    '''
+
+    def __init__(self, corpus, calls):
+        self.corpus = corpus
+        self.calls = calls
+        self.actions = []
+        self.http = []
+
+    def get_action(self, name):
+        action = self.calls.get_action(name)
+
+        def call(context=None, data_dict=None):
+            entry = {'name': name, 'data_dict': _to_json(data_dict or {})}
+            self.actions.append(entry)
+            try:
+                result = action(context, data_dict)
+            except Exception as e:
+                entry['error'] = type(e).__name__
+                raise
+            entry['result'] = _to_json(result)
+            return result
+        return call
+
+    def get_xml_url_content(self, xml_url, *args, **kwargs):
+        body = self.calls.get_xml_url_content(xml_url, *args, **kwargs)
+        self.http.append({'method': 'GET', 'url': xml_url, 'params': None,
+                          'body': self.corpus.put(body)})
+        return body
+
+    def post_content(self, url, params={}):
+        body = self.calls.post_content(url, params)
+        self.http.append({'method': 'POST', 'url': url, 'params': _to_json(params),
+                          'body': self.corpus.put(body)})
+        return body
+
+
+def _serialize_harvest_object(harvest_object, corpus):
+    source = harvest_object.source
+    return {
+        'id': harvest_object.id,
+        'guid': harvest_object.guid,
+        'package_id': harvest_object.package_id,
+        'harvest_job_id': harvest_object.harvest_job_id,
+        'content': corpus.put(harvest_object.content),
+        'extras': [[e.key, e.value] for e in harvest_object.extras],
+        'source': {'id': source.id, 'url': source.url, 'title': source.title,
+                   'config': source.config},
+    }
+
+
+def _get_package_dict_inputs(target, context, data_dict):
+    harvest_object = data_dict['harvest_object']
+    return harvest_object, json.loads(harvest_object.source.config or '{}'), {
+        'package_dict': data_dict['package_dict'],
+        'iso_values': data_dict['iso_values'],
+    }
+
+
+def _modify_package_dict_inputs(target, package_dict, harvest_object):
+    return harvest_object, getattr(target, 'config', None) or {}, {
+        'package_dict': package_dict,
+    }
+
+
+def _modify_search_inputs(target, pkg_dicts, remote_ckan_base_url, fq_terms):
+    return None, getattr(target, 'config', None) or {}, {
+        'pkg_dicts': pkg_dicts,
+        'remote_ckan_base_url': remote_ckan_base_url,
+        'fq_terms': fq_terms,
+    }
+
+
+_HOOK_INPUTS = {
+    'get_package_dict': _get_package_dict_inputs,
+    'modify_package_dict': _modify_package_dict_inputs,
+    'modify_search': _modify_search_inputs,
+}
+
+
+def capture(hook):
+    '''
+    Decorator for the harvest hooks. Records the inputs and output of the
+    hook when capture is enabled for the harvest source. The hook is called
+    with a `calls` argument recording the actions and external requests it
+    makes.
+    '''
+    get_inputs = _HOOK_INPUTS[hook]
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            harvest_object, source_config, inputs = get_inputs(self, *args)
+            if not capture_enabled(source_config):
+                return func(self, *args, **kwargs)
+
+            calls = kwargs.pop('calls', None)
+            if calls is None:
+                from ckanext.cioos_harvest.harvesters import HookCalls
+                calls = HookCalls(self)
+            corpus = Corpus(get_capture_dir())
+            recorder = _Recorder(corpus, calls)
+            record = {
+                'id': uuid.uuid4().hex,
+                'hook': hook,
+                'harvester': '%s.%s' % (type(self).__module__, type(self).__name__),
+                'time': time.time(),
+                'source_config': _to_json(source_config),
+                'harvest_object': harvest_object and _serialize_harvest_object(harvest_object, corpus),
+                # copied before the call, the hooks modify their arguments
+                'inputs': _to_json(inputs),
+            }
+            try:
+                output = func(self, *args, calls=recorder, **kwargs)
+            except Exception as e:
+                record['error'] = '%s: %s' % (type(e).__name__, e)
+                raise
+            else:
+                record['output'] = _to_json(output)
+                return output
+            finally:
+                record['actions'] = recorder.actions
+                record['http'] = recorder.http
+                try:
+                    corpus.append(record)
+                except Exception:
+                    log.exception('Unable to write capture record for %s', hook)
+        return wrapper
+    return decorator
+
+
+class _Replayed(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _replay_source_config(source_config):
+    # replays must not be captured again, mark jobs for indexing or use the
+    # identifier index
+    source_config = dict(source_config or {})
+    source_config['capture'] = False
+    source_config['defer_indexing'] = False
+    source_config['deduplicate_sources'] = False
+    return source_config
+
+
+def _replay_harvest_object(data, corpus):
+    if data is None:
+        return None
+    source_data = dict(data['source'])
+    source_data['config'] = json.dumps(_replay_source_config(json.loads(source_data['config'] or '{}')))
+    source = _Replayed(**source_data)
+    return _Replayed(
+        id=data['id'],
+        guid=data['guid'],
+        package_id=data['package_id'],
+        harvest_job_id=data['harvest_job_id'],
+        content=corpus.get(data['content']),
+        extras=[_Replayed(key=key, value=value) for key, value in data['extras']],
+        source=source,
+        job=_Replayed(id=data['harvest_job_id'], source=source),
+    )
+
+
+_ACTION_ERRORS = {
+    'ObjectNotFound': lambda: toolkit.ObjectNotFound(),
+    'NotAuthorized': lambda: toolkit.NotAuthorized(),
+    'ValidationError': lambda: toolkit.ValidationError({}),
+}
+
+
+class ActionStubs(object):
+    '''
+    In memory stand-ins for the CKAN actions called by a hook. Actions are
+    answered with the response recorded for the same data dict, writes that
+    were not recorded return the data they were given.
+    '''
+
+    def __init__(self, recorded_actions):
+        self.responses = dict(
+            (_action_key(entry['name'], entry['data_dict']), entry)
+            for entry in recorded_actions or [])
+
+    def get_action(self, name):
+        def call(context=None, data_dict=None):
+            entry = self.responses.get(_action_key(name, data_dict))
+            if entry is not None:
+                if 'error' in entry:
+                    raise _ACTION_ERRORS.get(entry['error'], lambda: Exception(entry['error']))()
+                return _to_json(entry['result'])
+            if name.endswith(('_create', '_update', '_patch')):
+                result = dict(data_dict or {})
+                result.setdefault('id', uuid.uuid4().hex)
+                return result
+            if name == 'get_site_user':
+                return {'name': 'replay'}
+            raise toolkit.ObjectNotFound('%s was not called with %r when the corpus was captured' % (name, data_dict))
+        return call
+
+
+class HttpStubs(object):
+    '''
+    Answers external requests with the bodies recorded in the corpus
+    '''
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.bodies = {}
+        for record in corpus.records():
+            for entry in record.get('http') or []:
+                self.bodies[_http_key(entry['method'], entry['url'], entry['params'])] = entry['body']
+
+    def get_xml_url_content(self, xml_url, *args, **kwargs):
+        return self.corpus.get(self.bodies.get(_http_key('GET', xml_url, None))) or ''
+
+    def post_content(self, url, params={}):
+        key = _http_key('POST', url, _to_json(params))
+        if key not in self.bodies:
+            from ckanext.cioos_harvest.harvesters import ContentFetchError
+            raise ContentFetchError('No response recorded for %s' % url)
+        return self.corpus.get(self.bodies[key]) or ''
+
+
+def _call_hook(target, record, harvest_object, calls):
+    inputs = record['inputs']
+    if record['hook'] == 'get_package_dict':
+        context = {'model': model, 'session': model.Session, 'user': 'replay'}
+        return target.get_package_dict(context, {
+            'package_dict': inputs['package_dict'],
+            'iso_values': inputs['iso_values'],
+            'harvest_object': harvest_object,
+        }, calls=calls)
+    if record['hook'] == 'modify_package_dict':
+        return target.modify_package_dict(inputs['package_dict'], harvest_object, calls=calls)
+    return target.modify_search(inputs['pkg_dicts'], inputs['remote_ckan_base_url'], inputs['fq_terms'], calls=calls)
+
+
+def diff(old, new, path=''):
+    '''
+    Yield the paths at which two json values differ
+    '''
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in sorted(set(old) | set(new)):
+            key_path = '%s/%s' % (path, key)
+            if key not in old or key not in new:
+                yield key_path
+            else:
+                for difference in diff(old[key], new[key], key_path):
+                    yield difference
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for index, (old_item, new_item) in enumerate(zip(old, new)):
+            for difference in diff(old_item, new_item, '%s/%s' % (path, index)):
+                yield difference
+    elif old != new:
+        yield path or '/'
+
+
+def _harvester_class(name):
+    '''
+    Class of the harvester that made a recorded call. Records name the class
+    with its module, records captured before the module was recorded name a
+    class of the harvesters module.
+    '''
+    module_name, _, class_name = name.rpartition('.')
+    module = importlib.import_module(module_name or 'ckanext.cioos_harvest.harvesters')
+    return getattr(module, class_name)
+
+
+def replay(corpus, hook=None, limit=None):
+    '''
+    Run the hooks over the records of `corpus`. Yields a dict for each record
+    with the output, or error, of the hook and the time the call took
+    '''
+    http = HttpStubs(corpus)
+    for count, record in enumerate(corpus.records(hook)):
+        if limit is not None and count >= limit:
+            return
+        result = {'id': record['id'], 'hook': record['hook']}
+        try:
+            target = _harvester_class(record['harvester'])()
+        except (ImportError, AttributeError) as e:
+            result['error'] = 'Harvester %s not available: %s' % (record['harvester'], e)
+            result['seconds'] = 0.0
+            yield record, result
+            continue
+        if record['hook'] != 'get_package_dict':
+            target.config = _replay_source_config(record['source_config'])
+            target._user_name = 'replay'
+        harvest_object = _replay_harvest_object(record['harvest_object'], corpus)
+        calls = _Replayed(
+            get_action=ActionStubs(record.get('actions')).get_action,
+            get_xml_url_content=http.get_xml_url_content,
+            post_content=http.post_content)
+        start = time.time()
+        try:
+            result['output'] = _to_json(_call_hook(target, record, harvest_object, calls))
+        except Exception as e:
+            result['error'] = '%s: %s' % (type(e).__name__, e)
+        result['seconds'] = time.time() - start
+        yield record, result
@@ -0,0 +1,162 @@
+# encoding: utf-8
+'''
+Cost aware ordering of the harvest objects created by a gather.
+
+ckanext-harvest publishes the harvest objects returned by a gather stage to
+the fetch queue in the order they are returned, so a handful of records with
+many external XML documents or contacts at the front of a job hold up every
+record behind them. The order is decided here instead:
+
+* the cost of each object is estimated from the time its previous import
+  took or, for new records, from the number of external XML documents,
+  contacts and resources of the remote dataset
+* objects are grouped, by remote organization by default, and the groups are
+  interleaved so each group gets a fair share of the import time, cheapest
+  objects first within a group
+
+The fetch queue itself is shared by all harvest sources and owned by
+ckanext-harvest, so objects of different jobs are still imported in the
+order their gathers finished.
+'''
+import heapq
+
+from ckanext.cioos_harvest import normalize
+
+import logging
+log = logging.getLogger(__name__)
+
+# relative cost of the parts of a record
+BASE_UNITS = 1.0
+XML_URL_UNITS = 10.0
+CONTACT_UNITS = 2.0
+RESOURCE_UNITS = 0.5
+
+CONTACT_FIELDS = ('cited-responsible-party', 'metadata-point-of-contact')
+
+
+def schedule_mode(source_config):
+    # ckan is imported where it is used, the ordering itself does not need it
+    import ckan.plugins.toolkit as toolkit
+    return source_config.get('schedule') or toolkit.config.get('ckan.harvest_schedule') or 'cost'
+
+
+def _as_list(value):
+    value = normalize.from_json(value) if value else value
+    if not value:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def estimate_units(pkg_dict):
+    '''
+    Estimated relative import cost of a remote dataset
+    '''
+    units = BASE_UNITS
+    content = pkg_dict.get('harvest_document_content') or ''
+    # documents are only fetched if the remote does not include them
+    if not content.startswith('<'):
+        units += XML_URL_UNITS * len(_as_list(pkg_dict.get('xml_location_url')))
+    for field in CONTACT_FIELDS:
+        units += CONTACT_UNITS * len(_as_list(pkg_dict.get(field)))
+    units += RESOURCE_UNITS * len(pkg_dict.get('resources') or [])
+    return units
+
+
+def group_key(pkg_dict, group_by):
+    if group_by == 'organization':
+        organization = pkg_dict.get('organization') or {}
+        return organization.get('name') or pkg_dict.get('owner_org') or ''
+    return ''
+
+
+def previous_durations(source_id):
+    '''
+    Seconds taken by the fetch and import of the current harvest object of
+    each guid of a source
+    '''
+    from ckan import model
+    from ckanext.harvest.model import HarvestObject
+
+    durations = {}
+    query = (model.Session.query(HarvestObject.guid, HarvestObject.fetch_started,
+                                 HarvestObject.import_started, HarvestObject.import_finished)
+             .filter(HarvestObject.harvest_source_id == source_id)
+             .filter(HarvestObject.current == True))  # noqa: E712
+    for guid, fetch_started, import_started, import_finished in query:
+        started = fetch_started or import_started
+        if guid and started and import_finished and import_finished >= started:
+            durations[guid] = (import_finished - started).total_seconds()
+    return durations
+
+
+def fair_order(items):
+    '''
+    Order (object id, group, cost) tuples. The next object always comes from
+    the group that has been given the least cost so far, and within a group
+    objects go from cheapest to most expensive.
+    '''
+    groups = {}
+    for object_id, group, cost in items:
+        groups.setdefault(group, []).append((cost, object_id))
+    queues = []
+    for index, (group, objects) in enumerate(groups.items()):
+        objects.sort(reverse=True)
+        # (cost given to the group so far, tie breaker, objects left)
+        queues.append((0.0, index, objects))
+    heapq.heapify(queues)
+
+    ordered = []
+    while queues:
+        served, index, objects = heapq.heappop(queues)
+        cost, object_id = objects.pop()
+        ordered.append(object_id)
+        if objects:
+            heapq.heappush(queues, (served + cost, index, objects))
+    return ordered
+
+
+class Scheduler(object):
+    '''
+    Collects the harvest objects created by a gather and orders them
+    '''
+
+    def __init__(self, source_id, source_config):
+        self.source_id = source_id
+        self.group_by = source_config.get('schedule_group_by', 'organization')
+        self._objects = []
+
+    def add_page(self, pkg_dicts, object_ids):
+        for pkg_dict, object_id in zip(pkg_dicts, object_ids):
+            self._objects.append((object_id, pkg_dict['id'], group_key(pkg_dict, self.group_by),
+                                  estimate_units(pkg_dict)))
+
+    def estimates(self):
+        '''
+        Estimated seconds per object id. Objects imported before are expected
+        to take as long as last time, the others are estimated from their
+        units at the rate the objects of this source were imported at.
+        '''
+        durations = previous_durations(self.source_id)
+        known_units = sum(units for _, guid, _, units in self._objects if guid in durations)
+        known_seconds = sum(durations[guid] for _, guid, _, _ in self._objects if guid in durations)
+        rate = known_seconds / known_units if known_units and known_seconds else 1.0
+        return dict((object_id, durations.get(guid, units * rate))
+                    for object_id, guid, _, units in self._objects)
+
+    def order(self, object_ids):
+        '''
+        Return `object_ids` in import order. Ids this scheduler was not told
+        about keep their place at the end.
+        '''
+        if not self._objects:
+            return object_ids
+        estimates = self.estimates()
+        groups = dict((object_id, group) for object_id, _, group, _ in self._objects)
+        scheduled = fair_order(
+            (object_id, groups[object_id], estimates[object_id])
+            for object_id in object_ids if object_id in estimates)
+        log.info('Scheduled %s harvest objects in %s groups, %.0f estimated seconds',
+                 len(scheduled), len(set(groups.values())), sum(estimates.values()))
+        return scheduled + [object_id for object_id in object_ids if object_id not in estimates]
@@ -0,0 +1,131 @@
+# encoding: utf-8
+'''
+Extract the searchable text of harvested ISO documents.
+
+Indexing the raw xml also indexes element names, attributes and namespaces.
+The text of the elements, and the attributes, selected by an allow-list of
+simple xpath expressions is extracted here with a streaming parser instead.
+
+Supported expressions are a subset of xpath matched on local names,
+namespace prefixes are ignored:
+
+    //title                  title elements anywhere in the document
+    //citation/*/title       title elements with a citation grandparent
+    /MD_Metadata/identificationInfo   elements at an absolute path
+    //*/@codeListValue       codeListValue attributes of any element
+
+The text of a selected element includes the text of all its descendants,
+including the text between and after its child elements.
+'''
+import io
+import xml.etree.ElementTree as ET
+
+from ckanext.cioos_harvest import normalize
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_XPATHS = ['//*', '//*/@codeListValue']
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+class _Pattern(object):
+
+    def __init__(self, xpath):
+        xpath = xpath.strip()
+        self.anchored = not xpath.startswith('//')
+        steps = [step for step in xpath.strip('/').split('/') if step]
+        self.attribute = None
+        if steps and steps[-1].startswith('@'):
+            self.attribute = steps.pop()[1:].split(':')[-1]
+        steps = [step.split(':')[-1] for step in steps]
+        if not steps:
+            raise ValueError('Invalid search text xpath: %s' % xpath)
+        self.steps = steps
+
+    def matches(self, path):
+        if len(path) < len(self.steps) or (self.anchored and len(path) != len(self.steps)):
+            return False
+        for step, name in zip(self.steps, path[-len(self.steps):]):
+            if step != '*' and step != name:
+                return False
+        return True
+
+
+class SearchTextExtractor(object):
+
+    def __init__(self, xpaths=None):
+        patterns = [_Pattern(x) for x in (xpaths or DEFAULT_XPATHS)]
+        self.element_patterns = [p for p in patterns if p.attribute is None]
+        self.attribute_patterns = [p for p in patterns if p.attribute is not None]
+
+    def iter_text(self, source):
+        '''
+        Yield the selected text of the xml document in the file like object
+        `source`, in document order
+
+        The text before the first child of an element and the tails of its
+        children are only complete once the parser reaches the next tag, so
+        each piece of text is read at the event that follows it.
+        '''
+        path = []
+        # open elements, whether their text is selected and their last closed
+        # child
+        stack = []
+        selected = []
+        last_child = []
+
+        def pending_text():
+            # text between the previous event and the current one, it belongs
+            # to the innermost open element
+            if not stack or not selected[-1]:
+                return None
+            text = stack[-1].text if last_child[-1] is None else last_child[-1].tail
+            return text.strip() if text and text.strip() else None
+
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            text = pending_text()
+            if text:
+                yield text
+            if event == 'start':
+                path.append(_local_name(elem.tag))
+                stack.append(elem)
+                selected.append(
+                    (selected and selected[-1]) or
+                    any(p.matches(path) for p in self.element_patterns))
+                last_child.append(None)
+                for pattern in self.attribute_patterns:
+                    if not pattern.matches(path):
+                        continue
+                    for key, value in elem.attrib.items():
+                        if _local_name(key) == pattern.attribute and value.strip():
+                            yield value.strip()
+            else:
+                path.pop()
+                stack.pop()
+                selected.pop()
+                last_child.pop()
+                if stack:
+                    # free processed elements as we go, the last one is kept
+                    # until its tail has been read
+                    del stack[-1][-1]
+                    last_child[-1] = elem
+
+    def extract(self, document):
+        '''
+        Return the selected text of `document` with duplicate values removed
+        '''
+        if not isinstance(document, bytes):
+            document = document.encode('utf-8')
+        try:
+            return ' '.join(normalize.unique(self.iter_text(io.BytesIO(document))))
+        except ET.ParseError as e:
+            log.warn('Unable to extract search text from harvest document: %s', e)
+            return ''
+
+
+def extract_search_text(document, xpaths=None):
+    return SearchTextExtractor(xpaths).extract(document)
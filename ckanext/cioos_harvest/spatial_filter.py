@@ -0,0 +1,145 @@
+# encoding: utf-8
+'''
+Local evaluation of the `spatial_filter` of CKANSpatialHarvester sources.
+
+By default the harvester sends the filter to the spatial search of the
+remote CKAN, `/api/2/search/dataset/geo`, which only exists on portals
+running ckanext-spatial. With `spatial_filter_mode` set to `local` the
+filter is parsed once per gather and the `spatial` field of each remote
+dataset is tested against it as the pages of search results come in, so
+any CKAN can be harvested and no spatial search request is made.
+
+Datasets are first compared to the bounding box of the filter and only
+those whose bounding box overlaps it are tested against the prepared filter
+geometry. With shapely 2 both steps are done for a whole page at once.
+'''
+import json
+import re
+
+import shapely.wkt
+from shapely.geometry import box, shape
+from six import string_types
+
+try:
+    import numpy
+    from shapely import bounds, intersects, prepare
+except ImportError:
+    # shapely < 2
+    numpy = None
+    from shapely.prepared import prep
+
+import logging
+log = logging.getLogger(__name__)
+
+BOX_PATTERN = re.compile(r'^BOX\s*\(\s*([^,\s]+)[,\s]+([^,\s]+)[,\s]+([^,\s]+)[,\s]+([^,\s\)]+)\s*\)$', re.I)
+SRID_PATTERN = re.compile(r'^SRID=(\d+);', re.I)
+WGS84 = ('4326', 'EPSG:4326')
+
+
+def filter_mode(source_config):
+    import ckan.plugins.toolkit as toolkit
+
+    return source_config.get('spatial_filter_mode') or toolkit.config.get('ckan.spatial_filter_mode') or 'remote'
+
+
+def parse_filter(wkt):
+    '''
+    Geometry of a spatial filter, WKT or BOX(minx,miny,maxx,maxy) in
+    EPSG:4326. Raises ValueError if it can not be parsed.
+    '''
+    wkt = (wkt or '').strip()
+    srid = SRID_PATTERN.match(wkt)
+    if srid:
+        if srid.group(1) != '4326':
+            raise ValueError('Only EPSG:4326 spatial filters can be evaluated locally, got SRID=%s' % srid.group(1))
+        wkt = wkt[srid.end():].strip()
+    if not wkt:
+        raise ValueError('Empty spatial filter')
+    match = BOX_PATTERN.match(wkt)
+    if match:
+        minx, miny, maxx, maxy = (float(value) for value in match.groups())
+        return box(minx, miny, maxx, maxy)
+    try:
+        geometry = shapely.wkt.loads(wkt)
+    except Exception as e:
+        raise ValueError('Invalid spatial filter %r: %s' % (wkt[:100], e))
+    if geometry.is_empty:
+        raise ValueError('Empty spatial filter')
+    return geometry
+
+
+def package_geometry(pkg_dict):
+    '''
+    Geometry of the `spatial` GeoJSON of a remote dataset, a top level field
+    with scheming or an extra, or None
+    '''
+    value = pkg_dict.get('spatial')
+    if not value:
+        for extra in pkg_dict.get('extras') or []:
+            if extra.get('key') == 'spatial':
+                value = extra.get('value')
+                break
+    if not value:
+        return None
+    try:
+        if isinstance(value, string_types):
+            value = json.loads(value)
+        geometry = shape(value)
+    except Exception as e:
+        log.debug('Invalid spatial field in dataset %s: %s', pkg_dict.get('id'), e)
+        return None
+    return None if geometry.is_empty else geometry
+
+
+class SpatialFilter(object):
+    '''
+    A spatial filter geometry, prepared for testing many datasets
+    '''
+
+    def __init__(self, geometry):
+        self.geometry = geometry
+        self.minx, self.miny, self.maxx, self.maxy = geometry.bounds
+        if numpy is not None:
+            prepare(geometry)
+            self._prepared = None
+        else:
+            self._prepared = prep(geometry)
+
+    @classmethod
+    def from_wkt(cls, wkt):
+        return cls(parse_filter(wkt))
+
+    def _in_bbox(self, minx, miny, maxx, maxy):
+        return not (maxx < self.minx or minx > self.maxx or maxy < self.miny or miny > self.maxy)
+
+    def matches(self, geometries):
+        '''
+        List of booleans, True for the geometries that intersect the filter.
+        None geometries never match.
+        '''
+        result = [False] * len(geometries)
+        candidates = [i for i, geometry in enumerate(geometries) if geometry is not None]
+        if not candidates:
+            return result
+        if numpy is not None:
+            array = numpy.array([geometries[i] for i in candidates], dtype=object)
+            b = bounds(array)
+            in_bbox = ((b[:, 2] >= self.minx) & (b[:, 0] <= self.maxx) &
+                       (b[:, 3] >= self.miny) & (b[:, 1] <= self.maxy))
+            hits = numpy.zeros(len(candidates), dtype=bool)
+            if in_bbox.any():
+                hits[in_bbox] = intersects(self.geometry, array[in_bbox])
+            for i, hit in zip(candidates, hits):
+                result[i] = bool(hit)
+        else:
+            for i in candidates:
+                geometry = geometries[i]
+                result[i] = self._in_bbox(*geometry.bounds) and self._prepared.intersects(geometry)
+        return result
+
+    def filter(self, pkg_dicts):
+        '''
+        The remote datasets whose `spatial` field intersects the filter
+        '''
+        matches = self.matches([package_geometry(pkg_dict) for pkg_dict in pkg_dicts])
+        return [pkg_dict for pkg_dict, match in zip(pkg_dicts, matches) if match]
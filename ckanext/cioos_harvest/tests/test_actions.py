@@ -0,0 +1,56 @@
+"""Tests for actions.py."""
+import pytest
+
+pytest.importorskip('ckan')
+
+from ckanext.cioos_harvest import actions  # noqa: E402
+
+
+class FluentGroupForm(object):
+
+    def form_to_db_schema_options(self, options):
+        return {'name': [], 'title': [], 'title_translated': []}
+
+
+class DefaultGroupForm(object):
+
+    def form_to_db_schema(self):
+        return {'name': [], 'title': []}
+
+
+@pytest.fixture
+def group_forms(monkeypatch):
+    forms = {'organization': FluentGroupForm(), 'group': FluentGroupForm()}
+    monkeypatch.setattr(actions, 'lookup_group_plugin', lambda group_type: forms.get(group_type, DefaultGroupForm()))
+    return forms
+
+
+def _created(action, data_dict, context=None):
+    created = []
+    action(lambda context, data_dict: created.append(data_dict) or data_dict, context or {}, data_dict)
+    return created[0]
+
+
+@pytest.mark.parametrize('action', [actions.organization_create, actions.group_create])
+def test_translated_title_is_filled(group_forms, action):
+    assert _created(action, {'name': 'cioos', 'title': 'CIOOS'})['title_translated'] == {'en': 'CIOOS', 'fr': 'CIOOS'}
+    assert _created(action, {'name': 'cioos', 'title_translated': '{}'})['title_translated'] == {'en': 'cioos', 'fr': 'cioos'}
+
+
+def test_existing_translated_title_is_kept(group_forms):
+    title_translated = {'en': 'CIOOS', 'fr': 'SIOOC'}
+    data_dict = {'name': 'cioos', 'title': 'CIOOS', 'title_translated': title_translated}
+    assert _created(actions.organization_create, data_dict) is data_dict
+
+
+def test_schema_without_translated_title(group_forms):
+    group_forms['organization'] = DefaultGroupForm()
+    data_dict = {'name': 'cioos', 'title': 'CIOOS'}
+    assert _created(actions.organization_create, data_dict) is data_dict
+    # another type of group, with the default schema
+    assert 'title_translated' not in _created(actions.group_create, {'name': 'theme', 'type': 'theme'})
+
+
+def test_schema_from_the_context(group_forms):
+    data_dict = {'name': 'cioos', 'title': 'CIOOS'}
+    assert _created(actions.organization_create, data_dict, {'schema': {'name': []}}) is data_dict
@@ -0,0 +1,67 @@
+"""Tests for blobstore.py."""
+import os
+
+import pytest
+
+from ckanext.cioos_harvest import blobstore
+from ckanext.cioos_harvest.blobstore import BlobStore
+
+DOCUMENT = u'<?xml version="1.0" encoding="utf-8"?><MD_Metadata><title>Température</title></MD_Metadata>'
+
+
+def _blob_files(path):
+    return sorted(os.path.relpath(os.path.join(root, name), path)
+                  for root, _, names in os.walk(path) for name in names)
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_put_and_get(tmp_path, compression):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    store = BlobStore(str(tmp_path), compression)
+    reference = store.put(DOCUMENT)
+    assert reference.startswith(blobstore.REFERENCE_PREFIX)
+    assert store.get(reference) == DOCUMENT
+    digest = reference[len(blobstore.REFERENCE_PREFIX):]
+    assert _blob_files(str(tmp_path)) == [os.path.join(digest[:2], digest + blobstore.EXTENSIONS[compression])]
+
+
+def test_documents_are_stored_once(tmp_path):
+    store = BlobStore(str(tmp_path), 'gzip')
+    reference = store.put(DOCUMENT)
+    assert store.put(DOCUMENT.encode('utf-8')) == reference
+    assert store.put(DOCUMENT + ' ') != reference
+    assert len(_blob_files(str(tmp_path))) == 2
+
+
+def test_gzip_output_is_reproducible(tmp_path):
+    # no timestamp in the gzip header, the same document gives the same file
+    data = DOCUMENT.encode('utf-8')
+    assert blobstore._compress(data, 'gzip') == blobstore._compress(data, 'gzip')
+    assert blobstore._decompress(blobstore._compress(data, 'gzip'), 'gzip') == data
+
+
+def test_get_missing_or_invalid_reference(tmp_path):
+    store = BlobStore(str(tmp_path), 'gzip')
+    assert store.get(None) is None
+    assert store.get('') is None
+    assert store.get('md5:abc') is None
+    assert store.get(blobstore.REFERENCE_PREFIX + '0' * 64) is None
+
+
+def test_blobs_written_with_another_compression_are_found(tmp_path):
+    pytest.importorskip('zstandard')
+    reference = BlobStore(str(tmp_path), 'zstd').put(DOCUMENT)
+    store = BlobStore(str(tmp_path), 'gzip')
+    assert store.get(reference) == DOCUMENT
+    # not written again with the new compression
+    assert store.put(DOCUMENT) == reference
+    assert len(_blob_files(str(tmp_path))) == 1
+
+
+def test_zstd_falls_back_to_gzip(tmp_path, monkeypatch):
+    monkeypatch.setattr(blobstore, 'zstandard', None)
+    store = BlobStore(str(tmp_path), 'zstd')
+    assert store.compression == 'gzip'
+    assert BlobStore(str(tmp_path)).compression == 'gzip'
+    assert store.get(store.put(DOCUMENT)) == DOCUMENT
@@ -0,0 +1,205 @@
+"""Tests for cli.py."""
+import json
+
+import pytest
+
+pytest.importorskip('ckan')
+pytest.importorskip('ckanext.harvest')
+
+from click.testing import CliRunner  # noqa: E402
+
+from ckanext.cioos_harvest import cli, fetch  # noqa: E402
+
+DOCUMENT = '''<?xml version="1.0" encoding="utf-8"?>
+<MD_Metadata>
+  <title>Sea surface temperature</title>
+  <abstract>Hourly means</abstract>
+</MD_Metadata>
+'''
+
+SOURCE_CONFIG = {'harvest_document_storage': 'inline', 'harvest_document_index': 'xml'}
+
+
+@pytest.fixture
+def actions(monkeypatch):
+    calls = []
+    package = {'id': 'package-id', 'harvest_document_content': DOCUMENT, 'extras': []}
+
+    def get_action(name):
+        def action(context, data_dict):
+            calls.append((name, data_dict))
+            return package
+        return action
+
+    monkeypatch.setattr(cli.toolkit, 'get_action', get_action)
+    return calls
+
+
+def test_unchanged_document_is_not_patched(actions):
+    # refetched documents are minified, the stored one is not
+    assert not cli._update_document('package-id', fetch.minify_xml(DOCUMENT), SOURCE_CONFIG, {})
+    assert [name for name, _ in actions] == ['package_show']
+
+
+def test_changed_document_is_patched(actions):
+    value = fetch.minify_xml(DOCUMENT.replace('Hourly', 'Daily'))
+    assert cli._update_document('package-id', value, SOURCE_CONFIG, {})
+    assert actions[-1] == ('package_patch', {'id': 'package-id', 'harvest_document_content': value})
+
+
+class FakeColumn(object):
+
+    def __eq__(self, other):
+        return ('eq', other)
+
+    def __gt__(self, other):
+        return ('gt', other)
+
+    def in_(self, values):
+        return ('in', values)
+
+
+class FakeGroup(object):
+    id = FakeColumn()
+    state = FakeColumn()
+
+    def __init__(self, id, title, type='organization'):
+        self.id = self.name = id
+        self.title = title
+        self.type = type
+
+
+class FakeGroupExtra(object):
+    group_id = FakeColumn()
+    key = FakeColumn()
+
+    def __init__(self, group_id, key, value, state='active'):
+        self.group_id = group_id
+        self.key = key
+        self.value = value
+        self.state = state
+
+
+class FakeQuery(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def filter(self, condition):
+        if condition[0] == 'gt':
+            self.rows = [row for row in self.rows if row.id > condition[1]]
+        return self
+
+    def order_by(self, column):
+        self.rows = sorted(self.rows, key=lambda row: row.id)
+        return self
+
+    def limit(self, limit):
+        self.rows = self.rows[:limit]
+        return self
+
+    def all(self):
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakeSession(object):
+
+    def __init__(self, groups, extras):
+        self.groups = groups
+        self.extras = extras
+        self.commits = 0
+        self.rollbacks = 0
+
+    def query(self, model_class):
+        return FakeQuery(self.groups if model_class is FakeGroup else self.extras)
+
+    def add(self, extra):
+        self.extras.append(extra)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+@pytest.fixture
+def groups(monkeypatch):
+    class FakeModel(object):
+        Group = FakeGroup
+        GroupExtra = FakeGroupExtra
+        Session = FakeSession([
+            FakeGroup('cioos', 'CIOOS'),
+            FakeGroup('translated', 'Translated'),
+            FakeGroup('untranslated', 'Untranslated'),
+            FakeGroup('theme', 'Theme', type='theme'),
+        ], [
+            FakeGroupExtra('translated', 'title_translated', '{"en": "Translated", "fr": "Traduit"}'),
+            FakeGroupExtra('untranslated', 'title_translated', '{}'),
+        ])
+
+    monkeypatch.setattr(cli, 'model', FakeModel)
+    # only organizations have a title_translated field
+    monkeypatch.setattr('ckanext.cioos_harvest.actions.has_translated_title', lambda group_type: group_type == 'organization')
+    return FakeModel.Session
+
+
+def _title_translated(session):
+    return dict((extra.group_id, json.loads(extra.value)) for extra in session.extras)
+
+
+def test_backfill_translations_dry_run(groups):
+    result = CliRunner().invoke(cli.backfill_translations, ['--dry-run', '--batch-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert 'Done. 2 organizations and groups need updating' in result.output
+    assert (groups.commits, len(groups.extras)) == (0, 2)
+    assert _title_translated(groups)['untranslated'] == {}
+
+
+def test_backfill_translations(groups):
+    result = CliRunner().invoke(cli.backfill_translations, ['--batch-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert 'Done. 2 organizations and groups updated' in result.output
+    assert _title_translated(groups) == {
+        'cioos': {'en': 'CIOOS', 'fr': 'CIOOS'},
+        'translated': {'en': 'Translated', 'fr': 'Traduit'},
+        'untranslated': {'en': 'Untranslated', 'fr': 'Untranslated'},
+    }
+
+    # existing translations are left alone
+    extras = [(extra.group_id, extra.value) for extra in groups.extras]
+    result = CliRunner().invoke(cli.backfill_translations, [])
+    assert 'Done. 0 organizations and groups updated' in result.output
+    assert [(extra.group_id, extra.value) for extra in groups.extras] == extras
+
+
+def test_profile_summary(tmp_path):
+    import cProfile
+
+    profile = cProfile.Profile()
+    profile.runcall(sorted, range(100))
+    profile.dump_stats(str(tmp_path / 'object-1.get_package_dict.prof'))
+    (tmp_path / 'object-2.get_package_dict.stacks').write_text(
+        'harvest.py:1(import_stage);hooks.py:1(get_package_dict);fetch.py:1(get) 3\n'
+        'harvest.py:1(import_stage);hooks.py:1(get_package_dict) 1\n')
+
+    result = CliRunner().invoke(cli.profile_summary, [str(tmp_path)])
+    assert result.exit_code == 0, result.output
+    assert 'cProfile of 1 sampled hook calls:' in result.output
+    assert 'Stack samples of 1 slow hook calls, 4 samples:' in result.output
+    lines = result.output.splitlines()
+    rows = lines[lines.index('   own %  total %  function') + 1:]
+    assert sorted(row.split() for row in rows) == [
+        ['0.0', '100.0', 'harvest.py:1(import_stage)'],
+        ['25.0', '100.0', 'hooks.py:1(get_package_dict)'],
+        ['75.0', '75.0', 'fetch.py:1(get)'],
+    ]
+    assert rows[-1].split()[-1] == 'fetch.py:1(get)'
+
+
+def test_profile_summary_without_profiles(tmp_path):
+    result = CliRunner().invoke(cli.profile_summary, [str(tmp_path)])
+    assert result.output == 'No profiles found in %s\n' % tmp_path
@@ -0,0 +1,230 @@
+"""Tests for fetch.py."""
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+from ckanext.cioos_harvest import fetch
+from ckanext.cioos_harvest.search_text import extract_search_text
+
+ISO_19115_3_DOCUMENT = '''<?xml version="1.0" encoding="UTF-8"?>
+<mdb:MD_Metadata xmlns:mdb="http://standards.iso.org/iso/19115/-3/mdb/2.0"
+    xmlns:cat="http://standards.iso.org/iso/19115/-3/cat/1.0"
+    xmlns:cit="http://standards.iso.org/iso/19115/-3/cit/2.0"
+    xmlns:gco="http://standards.iso.org/iso/19115/-3/gco/1.0"
+    xmlns:lan="http://standards.iso.org/iso/19115/-3/lan/1.0"
+    xmlns:mcc="http://standards.iso.org/iso/19115/-3/mcc/1.0"
+    xmlns:mri="http://standards.iso.org/iso/19115/-3/mri/1.0"
+    xmlns:xlink="http://www.w3.org/1999/xlink"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+    xsi:schemaLocation="http://standards.iso.org/iso/19115/-3/mdb/2.0 http://standards.iso.org/iso/19115/-3/mdb/2.0/mdb.xsd">
+  <mdb:metadataIdentifier>
+    <mcc:MD_Identifier>
+      <mcc:code>
+        <gco:CharacterString>c8e0b7a4-52d7-4f5e-9d1b-2b4a8c3f0e11</gco:CharacterString>
+      </mcc:code>
+    </mcc:MD_Identifier>
+  </mdb:metadataIdentifier>
+  <mdb:defaultLocale>
+    <lan:PT_Locale>
+      <lan:language>
+        <lan:LanguageCode codeList="http://standards.iso.org/iso/19115/resources/Codelists/cat/codelists.xml#LanguageCode" codeListValue="eng"/>
+      </lan:language>
+      <lan:characterEncoding>
+        <lan:MD_CharacterSetCode codeList="http://standards.iso.org/iso/19115/resources/Codelists/cat/codelists.xml#MD_CharacterSetCode" codeListValue="utf8"/>
+      </lan:characterEncoding>
+    </lan:PT_Locale>
+  </mdb:defaultLocale>
+  <mdb:identificationInfo>
+    <mri:MD_DataIdentification>
+      <mri:citation>
+        <cit:CI_Citation>
+          <cit:title>
+            <gco:CharacterString>Sea surface temperature, Hakai Pruth Dock</gco:CharacterString>
+          </cit:title>
+          <cit:date>
+            <cit:CI_Date>
+              <cit:date>
+                <gco:DateTime>2021-03-01T00:00:00</gco:DateTime>
+              </cit:date>
+              <cit:dateType>
+                <cit:CI_DateTypeCode codeList="http://standards.iso.org/iso/19115/resources/Codelists/cat/codelists.xml#CI_DateTypeCode" codeListValue="publication"/>
+              </cit:dateType>
+            </cit:CI_Date>
+          </cit:date>
+        </cit:CI_Citation>
+      </mri:citation>
+      <mri:abstract>
+        <gco:CharacterString>Hourly sea surface temperature measured at the Pruth Dock station.</gco:CharacterString>
+      </mri:abstract>
+    </mri:MD_DataIdentification>
+  </mdb:identificationInfo>
+</mdb:MD_Metadata>
+'''
+
+ISO_19139_DOCUMENT = u'''﻿<?xml version='1.0' encoding='utf-8' standalone='no'?>
+<!DOCTYPE gmd:MD_Metadata [
+  <!ENTITY agency "Fisheries and Oceans Canada">
+]>
+<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd"
+    xmlns:gco="http://www.isotc211.org/2005/gco">
+  <gmd:fileIdentifier>
+    <gco:CharacterString>f2d1a6a0-7a3b-4c57-8c61-3e8d0a6f9b72</gco:CharacterString>
+  </gmd:fileIdentifier>
+  <gmd:language>
+    <gmd:LanguageCode codeList="http://www.loc.gov/standards/iso639-2/" codeListValue="fre"/>
+  </gmd:language>
+  <gmd:identificationInfo>
+    <gmd:MD_DataIdentification>
+      <gmd:citation>
+        <gmd:CI_Citation>
+          <gmd:title>
+            <gco:CharacterString>Salinité de surface, golfe du Saint-Laurent</gco:CharacterString>
+          </gmd:title>
+        </gmd:CI_Citation>
+      </gmd:citation>
+      <gmd:abstract>
+        <gco:CharacterString>Données de salinité recueillies par les bouées.</gco:CharacterString>
+      </gmd:abstract>
+    </gmd:MD_DataIdentification>
+  </gmd:identificationInfo>
+</gmd:MD_Metadata>
+'''
+
+
+def test_strip_prolog():
+    assert fetch.strip_prolog('<?xml version="1.0"?>\n<a>x</a>\n') == '<a>x</a>'
+    assert fetch.strip_prolog('<!DOCTYPE a SYSTEM "a.dtd">\n<a>x</a>') == '<a>x</a>'
+    assert fetch.strip_prolog('<a><b>&lt;!DOCTYPE b&gt;</b></a>') == '<a><b>&lt;!DOCTYPE b&gt;</b></a>'
+    assert fetch.strip_prolog('') == ''
+
+
+def test_strip_prolog_keeps_doctypes_after_the_root_element():
+    document = '<a><![CDATA[<!DOCTYPE b>]]></a>'
+    assert fetch.strip_prolog(document) == document
+
+
+def test_bundle_documents_is_valid_xml():
+    bundle = fetch.minify_xml(fetch.bundle_documents([ISO_19115_3_DOCUMENT, ISO_19139_DOCUMENT]))
+    assert bundle.count('<?xml') == 1
+    assert '<!DOCTYPE' not in bundle
+    root = ET.fromstring(bundle.encode('utf-8'))
+    assert root.tag == 'docs'
+    assert [doc.tag for doc in root] == ['doc', 'doc']
+    assert [child.tag for doc in root for child in doc] == [
+        '{http://standards.iso.org/iso/19115/-3/mdb/2.0}MD_Metadata',
+        '{http://www.isotc211.org/2005/gmd}MD_Metadata',
+    ]
+
+
+def test_bundle_documents_search_text():
+    bundle = fetch.minify_xml(fetch.bundle_documents([ISO_19115_3_DOCUMENT, ISO_19139_DOCUMENT]))
+    text = extract_search_text(bundle, ['//title', '//abstract'])
+    assert text == (
+        u'Sea surface temperature, Hakai Pruth Dock '
+        u'Hourly sea surface temperature measured at the Pruth Dock station. '
+        u'Salinité de surface, golfe du Saint-Laurent '
+        u'Données de salinité recueillies par les bouées.')
+
+
+def test_bundle_documents_with_failed_fetch():
+    bundle = fetch.bundle_documents([ISO_19115_3_DOCUMENT, ''])
+    root = ET.fromstring(fetch.minify_xml(bundle).encode('utf-8'))
+    assert len(root[1]) == 0
+
+
+def test_minify_xml():
+    assert fetch.minify_xml('<a>\n  <b>x  y</b>\n  <c/>\n</a>\n') == '<a><b>x y</b><c/></a>'
+
+
+def test_same_document():
+    assert fetch.same_document(ISO_19115_3_DOCUMENT, fetch.minify_xml(ISO_19115_3_DOCUMENT))
+    assert fetch.same_document(fetch.minify_xml(ISO_19115_3_DOCUMENT), ISO_19115_3_DOCUMENT)
+    assert fetch.same_document(None, '')
+    assert not fetch.same_document(ISO_19115_3_DOCUMENT, ISO_19139_DOCUMENT)
+    assert not fetch.same_document('<a>x y</a>', '<a>xy</a>')
+
+
+def _saved_files(path):
+    return sorted(os.listdir(str(path)))
+
+
+def _dead_worker_file(path, samples, timeouts=None):
+    # pid of a process that exited
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    name = '%s.%s.json' % (socket.gethostname(), process.pid)
+    with open(os.path.join(str(path), name), 'w') as f:
+        json.dump({'samples': samples, 'timeouts': timeouts or {}}, f)
+    return name
+
+
+def test_latency_tracker_saves_only_its_own_samples(tmp_path):
+    other = fetch.LatencyTracker(str(tmp_path))
+    other.record('a.org', 1.0)
+    other.save()
+    # a running worker on another host
+    os.rename(os.path.join(str(tmp_path), _saved_files(tmp_path)[0]),
+              os.path.join(str(tmp_path), 'other-host.1.json'))
+
+    tracker = fetch.LatencyTracker(str(tmp_path))
+    tracker.load()
+    tracker.record('a.org', 2.0)
+    tracker.save()
+    tracker.load()
+    assert sorted(tracker.samples('a.org')) == [1.0, 2.0]
+    with open(tracker._file_path()) as f:
+        assert json.load(f) == {'samples': {'a.org': [2.0]}, 'timeouts': {}}
+    assert _saved_files(tmp_path) == sorted(['other-host.1.json', os.path.basename(tracker._file_path())])
+
+
+def test_latency_samples_are_not_multiplied_by_restarts(tmp_path):
+    _dead_worker_file(tmp_path, {'a.org': [1.0, 2.0]}, {'a.org': 1})
+    for restart in range(3):
+        tracker = fetch.LatencyTracker(str(tmp_path))
+        tracker.load()
+        assert tracker.samples('a.org') == [1.0, 2.0]
+        assert tracker.stats()['a.org']['timeouts'] == 1
+        tracker.save()
+        # the next worker finds the file of this one once it exited
+        saved = _dead_worker_file(tmp_path, {})
+        os.rename(tracker._file_path(), os.path.join(str(tmp_path), saved))
+        assert len(_saved_files(tmp_path)) == 1
+
+
+def test_latency_tracker_takes_over_the_file_of_its_pid(tmp_path):
+    with open(fetch.LatencyTracker(str(tmp_path))._file_path(), 'w') as f:
+        json.dump({'samples': {'a.org': [1.0]}}, f)
+    tracker = fetch.LatencyTracker(str(tmp_path))
+    tracker.load()
+    tracker.load()
+    tracker.record('a.org', 2.0)
+    tracker.save()
+    tracker.load()
+    assert tracker.samples('a.org') == [1.0, 2.0]
+    with open(tracker._file_path()) as f:
+        assert json.load(f)['samples'] == {'a.org': [1.0, 2.0]}
+
+
+def test_stale_latency_stats_are_removed(tmp_path):
+    path = os.path.join(str(tmp_path), 'other-host.1.json')
+    with open(path, 'w') as f:
+        json.dump({'samples': {'a.org': [1.0]}}, f)
+    old = time.time() - fetch.STALE_STATS_AGE - 1
+    os.utime(path, (old, old))
+    tracker = fetch.LatencyTracker(str(tmp_path))
+    tracker.load()
+    assert tracker.samples('a.org') == []
+    assert _saved_files(tmp_path) == []
+
+
+def test_latency_tracker_window(tmp_path):
+    tracker = fetch.LatencyTracker(str(tmp_path), window=3)
+    for seconds in range(5):
+        tracker.record('a.org', float(seconds))
+    tracker.record_timeout('a.org', 10.0)
+    assert tracker.samples('a.org') == [3.0, 4.0, 10.0]
+    assert tracker.stats()['a.org']['timeouts'] == 1
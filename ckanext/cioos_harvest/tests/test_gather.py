@@ -0,0 +1,324 @@
+"""Tests for gather.py."""
+import datetime
+import json
+import os
+
+import pytest
+
+pytest.importorskip('ckan')
+pytest.importorskip('ckanext.harvest')
+
+from six.moves.urllib.parse import parse_qs, urlparse  # noqa: E402
+
+from ckanext.harvest.harvesters.ckanharvester import ContentFetchError  # noqa: E402
+
+from ckanext.cioos_harvest import gather, scheduling  # noqa: E402
+from ckanext.cioos_harvest.gather import StreamingGatherMixin  # noqa: E402
+
+REMOTE_URL = 'https://catalogue.example.org'
+
+
+class FakeSource(object):
+
+    def __init__(self, config):
+        self.id = 'source-id'
+        self.url = REMOTE_URL + '/'
+        self.config = json.dumps(config)
+
+
+class FakeJob(object):
+
+    def __init__(self, job_id='job-1', config=None):
+        self.id = job_id
+        self.source = FakeSource(config or {})
+        self.gather_started = datetime.datetime(2021, 3, 1, 12, 0)
+
+
+class FakeHarvestObject(object):
+
+    def __init__(self, guid, harvest_job_id, content):
+        self.id = None
+        self.guid = guid
+        self.harvest_job_id = harvest_job_id
+        self.content = content
+        self.state = 'WAITING'
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.objects = []
+        self.commits = 0
+        self._added = []
+
+    def add_all(self, objs):
+        self._added.extend(objs)
+
+    def commit(self):
+        for obj in self._added:
+            obj.id = 'object-%s' % (len(self.objects) + 1)
+            self.objects.append(obj)
+        self._added = []
+        self.commits += 1
+
+    def expunge(self, obj):
+        pass
+
+
+class FakeModel(object):
+
+    def __init__(self):
+        self.Session = FakeSession()
+
+
+class FakeToolkit(object):
+    config = {}
+
+    @staticmethod
+    def asbool(value):
+        return str(value).lower() in ('true', '1', 'yes')
+
+    @staticmethod
+    def requires_ckan_version(min_version=None):
+        pass
+
+
+class FakeCKANHarvester(object):
+    '''
+    The parts of CKANHarvester the gather uses, with a remote catalogue
+    served from memory
+    '''
+
+    def __init__(self, datasets, last_job=None):
+        self.datasets = datasets
+        self.last_job = last_job
+        self.requests = []
+        self.errors = []
+        # start offsets of search requests that fail
+        self.fail_at = set()
+        # called with the start offset before each search request
+        self.before_request = None
+
+    def _set_config(self, config_str):
+        self.config = json.loads(config_str or '{}')
+
+    def _get_search_api_offset(self):
+        return '/api/3/action/package_search'
+
+    def last_error_free_job(self, harvest_job):
+        return self.last_job
+
+    def _save_gather_error(self, message, harvest_job):
+        self.errors.append(message)
+
+    def _get_content(self, url):
+        params = dict((k, v[0]) for k, v in parse_qs(urlparse(url).query).items())
+        self.requests.append(params)
+        start, rows = int(params['start']), int(params['rows'])
+        if self.before_request:
+            self.before_request(start)
+        if start in self.fail_at:
+            raise ContentFetchError('HTTP error: 500')
+        datasets = self.datasets
+        if 'metadata_modified' in params.get('fq', ''):
+            datasets = [d for d in datasets if d.get('modified')]
+        return json.dumps({'result': {'count': len(datasets), 'results': datasets[start:start + rows]}})
+
+
+class Harvester(StreamingGatherMixin, FakeCKANHarvester):
+    pass
+
+
+def _datasets(count):
+    return [{'id': 'id-%03d' % i, 'name': 'dataset-%03d' % i} for i in range(count)]
+
+
+@pytest.fixture
+def fake_ckan(monkeypatch, tmp_path):
+    fake_model = FakeModel()
+    monkeypatch.setattr(gather, 'model', fake_model)
+    monkeypatch.setattr(gather, 'toolkit', FakeToolkit)
+    monkeypatch.setattr(gather, 'HarvestObject', FakeHarvestObject)
+    monkeypatch.setattr(gather, 'get_storage_dir', lambda *parts: os.path.join(str(tmp_path), *parts))
+    monkeypatch.setattr(scheduling, 'schedule_mode', lambda source_config: 'fifo')
+    monkeypatch.setattr(gather, '_existing_harvest_objects', lambda harvest_job: dict(
+        (obj.guid, obj.id) for obj in fake_model.Session.objects
+        if obj.harvest_job_id == harvest_job.id and obj.state == 'WAITING'))
+    return fake_model.Session
+
+
+def _guids(session, object_ids):
+    by_id = dict((obj.id, obj.guid) for obj in session.objects)
+    return [by_id[object_id] for object_id in object_ids]
+
+
+def test_multi_page_gather(fake_ckan):
+    harvester = Harvester(_datasets(25))
+    object_ids = harvester.gather_stage(FakeJob(config={'page_size': 10}))
+    assert _guids(fake_ckan, object_ids) == ['id-%03d' % i for i in range(25)]
+    assert [r['start'] for r in harvester.requests] == ['0', '10', '20', '30']
+    assert all(r['sort'] == 'id asc' and r['rows'] == '10' for r in harvester.requests)
+    # one commit per page
+    assert fake_ckan.commits == 3
+    assert json.loads(fake_ckan.objects[0].content)['name'] == 'dataset-000'
+    assert harvester.errors == []
+
+
+def test_duplicate_ids_across_pages(fake_ckan):
+    harvester = Harvester(_datasets(25))
+
+    def add_dataset(start):
+        # a dataset added while paging pushes the last of the first page to
+        # the second page
+        if start == 10:
+            harvester.datasets.insert(0, {'id': 'id-new', 'name': 'new'})
+
+    harvester.before_request = add_dataset
+    object_ids = harvester.gather_stage(FakeJob(config={'page_size': 10}))
+    guids = _guids(fake_ckan, object_ids)
+    assert len(guids) == len(set(guids)) == 25
+    assert 'id-new' not in guids
+
+
+def test_modify_search_is_called_per_page(fake_ckan):
+    calls = []
+
+    class FilteringHarvester(Harvester):
+
+        def modify_search(self, pkg_dicts, remote_ckan_base_url, fq_terms):
+            calls.append(([p['id'] for p in pkg_dicts], remote_ckan_base_url, fq_terms))
+            return [p for p in pkg_dicts if int(p['id'][3:]) % 2 == 0]
+
+    harvester = FilteringHarvester(_datasets(15))
+    config = {'page_size': 10, 'organizations_filter_include': ['hakai']}
+    object_ids = harvester.gather_stage(FakeJob(config=config))
+    assert [len(ids) for ids, _, _ in calls] == [10, 5]
+    assert all(url == REMOTE_URL and fq_terms == ['organization:hakai'] for _, url, fq_terms in calls)
+    assert _guids(fake_ckan, object_ids) == ['id-%03d' % i for i in range(0, 15, 2)]
+
+
+def test_datasets_changed_since_the_last_error_free_job(fake_ckan):
+    datasets = _datasets(5)
+    datasets[3]['modified'] = True
+
+    class LastJob(object):
+        gather_started = datetime.datetime(2021, 2, 1, 12, 0)
+
+    harvester = Harvester(datasets, last_job=LastJob())
+    object_ids = harvester.gather_stage(FakeJob())
+    assert _guids(fake_ckan, object_ids) == ['id-003']
+    assert harvester.requests[0]['fq'] == 'metadata_modified:[2021-02-01T11:00:00Z TO *]'
+
+    harvester = Harvester(_datasets(5), last_job=LastJob())
+    assert harvester.gather_stage(FakeJob('job-2')) == []
+    assert harvester.errors == []
+
+    harvester = Harvester(datasets, last_job=LastJob())
+    object_ids = harvester.gather_stage(FakeJob('job-3', config={'force_all': True}))
+    assert len(object_ids) == 5
+    assert 'fq' not in harvester.requests[0]
+
+
+def test_no_datasets_on_the_remote(fake_ckan):
+    harvester = Harvester([])
+    assert harvester.gather_stage(FakeJob()) == []
+    assert harvester.errors == ['No datasets found at CKAN: %s' % REMOTE_URL]
+
+
+def test_search_error_on_the_first_page(fake_ckan):
+    harvester = Harvester(_datasets(5))
+    harvester.fail_at = {0}
+    assert harvester.gather_stage(FakeJob()) is None
+    assert len(harvester.errors) == 1
+    assert fake_ckan.objects == []
+
+
+class WorkerDied(BaseException):
+    pass
+
+
+def _checkpoint_path(tmp_path):
+    return os.path.join(str(tmp_path), 'gather', 'source-id.json')
+
+
+@pytest.fixture
+def die_on_save(monkeypatch):
+    # the worker dies after the page of the n-th save was committed, before
+    # its checkpoint is saved
+    saves = []
+    die = {'at': None}
+    save = gather.GatherCheckpoint.save
+
+    def dying_save(self, *args):
+        saves.append(args)
+        if len(saves) == die['at']:
+            raise WorkerDied()
+        return save(self, *args)
+
+    monkeypatch.setattr(gather.GatherCheckpoint, 'save', dying_save)
+    return die
+
+
+def test_crash_and_resume(fake_ckan, die_on_save, tmp_path):
+    harvester = Harvester(_datasets(35))
+    job = FakeJob(config={'page_size': 10})
+    die_on_save['at'] = 2
+    with pytest.raises(WorkerDied):
+        harvester.gather_stage(job)
+    assert len(fake_ckan.objects) == 20
+    with open(_checkpoint_path(tmp_path)) as f:
+        assert json.load(f)['searches'] == [[[], 10]]
+
+    # the job is delivered again, the first page it gets was gathered already
+    die_on_save['at'] = None
+    harvester.requests = []
+    object_ids = harvester.gather_stage(job)
+    assert [r['start'] for r in harvester.requests] == ['10', '20', '30', '40']
+    assert sorted(_guids(fake_ckan, object_ids)) == ['id-%03d' % i for i in range(35)]
+    assert len(fake_ckan.objects) == 35
+    assert not os.path.exists(_checkpoint_path(tmp_path))
+
+
+def test_resume_after_the_last_page(fake_ckan, die_on_save, tmp_path):
+    harvester = Harvester(_datasets(20))
+    job = FakeJob(config={'page_size': 10})
+    die_on_save['at'] = 2
+    with pytest.raises(WorkerDied):
+        harvester.gather_stage(job)
+
+    die_on_save['at'] = None
+    object_ids = harvester.gather_stage(job)
+    assert sorted(_guids(fake_ckan, object_ids)) == ['id-%03d' % i for i in range(20)]
+    assert not os.path.exists(_checkpoint_path(tmp_path))
+
+
+def test_error_and_resume(fake_ckan, tmp_path):
+    datasets = _datasets(35)
+    harvester = Harvester(datasets)
+    harvester.fail_at = {20}
+    object_ids = harvester.gather_stage(FakeJob('job-1', config={'page_size': 10}))
+    assert len(object_ids) == 20
+    assert len(harvester.errors) == 1
+    with open(_checkpoint_path(tmp_path)) as f:
+        state = json.load(f)
+    assert (state['job_id'], state['searches']) == ('job-1', [[[], 20]])
+
+    # the next job gathers the pages that were left, then the datasets on
+    # the other pages that changed since the first job started
+    datasets[5]['modified'] = True
+    harvester = Harvester(datasets)
+    object_ids = harvester.gather_stage(FakeJob('job-2', config={'page_size': 10}))
+    assert _guids(fake_ckan, object_ids) == ['id-%03d' % i for i in range(20, 35)] + ['id-005']
+    assert [(r['start'], r.get('fq')) for r in harvester.requests] == [
+        ('20', None), ('30', None), ('40', None),
+        ('0', 'metadata_modified:[2021-03-01T11:00:00Z TO *]'),
+        ('10', 'metadata_modified:[2021-03-01T11:00:00Z TO *]')]
+    assert harvester.errors == []
+    assert not os.path.exists(_checkpoint_path(tmp_path))
+
+
+def test_checkpoints_disabled(fake_ckan, tmp_path):
+    harvester = Harvester(_datasets(15))
+    harvester.fail_at = {10}
+    harvester.gather_stage(FakeJob(config={'page_size': 10, 'gather_checkpoint': False}))
+    assert not os.path.exists(_checkpoint_path(tmp_path))
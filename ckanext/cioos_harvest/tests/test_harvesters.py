@@ -0,0 +1,264 @@
+"""Tests for harvesters.py."""
+import json
+
+import pytest
+
+pytest.importorskip('ckan')
+pytest.importorskip('ckanext.harvest')
+pytest.importorskip('ckanext.spatial.harvesters')
+
+from ckanext.cioos_harvest import harvesters, identifiers  # noqa: E402
+from ckanext.cioos_harvest.harvesters import SpatialDeduplicateSourcesMixin, SpatialHarvesterHooks  # noqa: E402
+
+
+class FakeSource(object):
+    id = 'source-id'
+    type = 'waf_cioos'
+    config = json.dumps({'deduplicate_sources': True, 'data_catalogue_source': [{'url': 'https://waf.example.org'}]})
+
+
+class FakeHarvestObject(object):
+    guid = 'guid-1'
+    current = False
+    package_id = None
+    extras = []
+
+    def __init__(self, id='object-1', current=False, package_id=None):
+        self.id = id
+        self.current = current
+        self.package_id = package_id
+        self.source = FakeSource()
+
+    def add(self):
+        pass
+
+
+class FakeQuery(object):
+
+    def __init__(self, result):
+        self.result = result
+
+    def filter(self, *args):
+        return self
+
+    def first(self):
+        return self.result
+
+
+class FakeSession(object):
+
+    def __init__(self, previous_object):
+        self.previous_object = previous_object
+        self.commits = 0
+
+    def query(self, *args):
+        return FakeQuery(self.previous_object)
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakeModel(object):
+
+    def __init__(self, previous_object):
+        self.Session = FakeSession(previous_object)
+
+
+class FakeSpatialHarvester(object):
+    '''
+    The part of the ckanext-spatial import stage around the get_package_dict
+    hook
+    '''
+
+    def __init__(self, hook, previous_object):
+        self.hook = hook
+        self.previous_object = previous_object
+
+    def import_stage(self, harvest_object):
+        if self.previous_object is not None:
+            self.previous_object.current = False
+        package_dict = self.hook.get_package_dict({'user': 'harvest'}, {
+            'package_dict': {'extras': []},
+            'iso_values': {'unique-resource-identifier-full': {'code': 'https://doi.org/10.1234/abc'}},
+            'xml_tree': None,
+            'harvest_object': harvest_object,
+        })
+        if not package_dict:
+            return False
+        harvest_object.current = True
+        harvest_object.package_id = harvest_object.package_id or 'new-package-id'
+        return True
+
+
+class Harvester(SpatialDeduplicateSourcesMixin, FakeSpatialHarvester):
+    pass
+
+
+@pytest.fixture
+def dedup(monkeypatch):
+    calls = {'merged': [], 'recorded': []}
+    monkeypatch.setattr(identifiers, 'deduplicate_enabled', lambda source_config: True)
+    monkeypatch.setattr(identifiers, 'merge_data_catalogues',
+                        lambda package_id, catalogues, user, get_action=None: calls['merged'].append((package_id, catalogues)))
+    monkeypatch.setattr(identifiers, 'record', lambda *args: calls['recorded'].append(args))
+    monkeypatch.setattr(harvesters, 'HarvestObject', FakeHarvestObject)
+    return calls
+
+
+def test_skipped_spatial_record_is_not_modified(dedup, monkeypatch):
+    monkeypatch.setattr(identifiers, 'preferred_copy', lambda ids, source_id: ('other-source', 'other-package'))
+    previous_object = FakeHarvestObject('object-0', current=True, package_id='own-package')
+    monkeypatch.setattr(harvesters, 'model', FakeModel(previous_object))
+    harvest_object = FakeHarvestObject()
+
+    result = Harvester(SpatialHarvesterHooks(), previous_object).import_stage(harvest_object)
+    # ckanext-harvest reports 'unchanged' as not modified
+    assert result == 'unchanged'
+    assert previous_object.current
+    assert not harvest_object.current
+    assert dedup['merged'] == [('other-package', [{'url': 'https://waf.example.org'}])]
+    assert dedup['recorded'] == []
+
+
+def test_skip_needs_a_deduplicating_harvester(dedup, monkeypatch):
+    lookups = []
+    monkeypatch.setattr(identifiers, 'preferred_copy', lambda ids, source_id: lookups.append(ids))
+
+    class PlainSource(FakeSource):
+        type = 'waf'
+
+    class Transformed(Exception):
+        pass
+
+    class PackageDict(dict):
+        # the hook goes on to transform the package once the lookup is done
+        def get(self, key, default=None):
+            raise Transformed()
+
+    harvest_object = FakeHarvestObject()
+    harvest_object.source = PlainSource()
+    with pytest.raises(Transformed):
+        SpatialHarvesterHooks().get_package_dict({}, {
+            'package_dict': PackageDict(), 'iso_values': {}, 'harvest_object': harvest_object})
+    assert lookups == []
+
+    harvest_object.source = FakeSource()
+    with pytest.raises(Transformed):
+        SpatialHarvesterHooks().get_package_dict({}, {
+            'package_dict': PackageDict(), 'iso_values': {}, 'harvest_object': harvest_object})
+    assert lookups == [[('guid-1', 'guid')]]
+
+
+class RecordingHook(object):
+
+    def get_package_dict(self, context, data_dict):
+        data_dict['harvest_object'].cioos_identifiers = [('guid-1', 'guid')]
+        return {'name': 'remote-name'}
+
+
+def test_identifiers_are_recorded_with_the_written_package_id(dedup, monkeypatch):
+    fake_model = FakeModel(None)
+    monkeypatch.setattr(harvesters, 'model', fake_model)
+    harvest_object = FakeHarvestObject()
+    assert Harvester(RecordingHook(), None).import_stage(harvest_object) is True
+    assert dedup['recorded'] == [([('guid-1', 'guid')], 'source-id', 'new-package-id')]
+    assert fake_model.Session.commits == 1
+
+
+def test_failed_import_records_nothing(dedup, monkeypatch):
+    monkeypatch.setattr(harvesters, 'model', FakeModel(None))
+
+    class FailingHook(RecordingHook):
+
+        def get_package_dict(self, context, data_dict):
+            super(FailingHook, self).get_package_dict(context, data_dict)
+            return {}
+
+    assert Harvester(FailingHook(), None).import_stage(FakeHarvestObject()) is False
+    assert dedup['recorded'] == []
+
+
+@pytest.mark.parametrize('harvester_class', ['CIOOSWAFHarvester', 'CIOOSCSWHarvester'])
+def test_spatial_harvesters_are_memory_monitored(harvester_class):
+    mro = getattr(harvesters, harvester_class).__mro__
+    assert mro.index(harvesters.MemoryMonitorMixin) < mro.index(SpatialDeduplicateSourcesMixin)
+
+
+def test_memory_monitor_sees_failed_imports(dedup, monkeypatch):
+    finished = []
+    monkeypatch.setattr(harvesters, 'model', FakeModel(None))
+    monkeypatch.setattr(harvesters.memory, 'object_finished', finished.append)
+
+    class MonitoredHarvester(harvesters.MemoryMonitorMixin, Harvester):
+        pass
+
+    class FailingHook(object):
+
+        def get_package_dict(self, context, data_dict):
+            return {}
+
+    harvest_object = FakeHarvestObject()
+    assert MonitoredHarvester(FailingHook(), None).import_stage(harvest_object) is False
+    assert finished == [harvest_object]
+
+
+class FakeUpdateQuery(FakeQuery):
+
+    def update(self, values):
+        pass
+
+
+class FakeUpdateSession(FakeSession):
+
+    def query(self, *args):
+        return FakeUpdateQuery(None)
+
+
+class FakeCKANHarvester(object):
+    config = None
+
+    def _get_user_name(self):
+        return 'harvest'
+
+    def _find_existing_package(self, package_dict):
+        return {'id': 'package-id', 'name': 'dataset', 'title': 'Old title'}
+
+    def _create_or_update_package(self, package_dict, harvest_object, package_dict_form='rest'):
+        raise AssertionError('existing packages are patched')
+
+
+class PatchingHarvester(harvesters.PackagePatchMixin, FakeCKANHarvester):
+    pass
+
+
+class SavedHarvestObject(FakeHarvestObject):
+
+    def save(self):
+        pass
+
+
+def test_patch_uses_the_update_context(monkeypatch):
+    patches = []
+
+    def package_patch(context, data_dict):
+        patches.append((context, data_dict))
+        return {'id': data_dict['id']}
+
+    fake_model = FakeModel(None)
+    fake_model.Session = FakeUpdateSession(None)
+    monkeypatch.setattr(harvesters, 'model', fake_model)
+    monkeypatch.setattr(harvesters, 'HarvestObject', FakeHarvestObject)
+    monkeypatch.setattr(harvesters.toolkit, 'get_action', lambda name: package_patch)
+    harvester = PatchingHarvester()
+    harvester.config = {'patch_updates': True, 'api_version': '3'}
+    harvest_object = SavedHarvestObject()
+
+    assert harvester._create_or_update_package(
+        {'id': 'package-id', 'name': 'dataset', 'title': 'New title'}, harvest_object, 'package_show') is True
+
+    (context, data_dict), = patches
+    assert data_dict == {'id': 'package-id', 'title': 'New title'}
+    assert (context['user'], context['api_version'], context['id']) == ('harvest', 3, 'package-id')
+    # the base harvester's create schema, accepting the remote id
+    assert 'id' in context['schema'] and '__junk' in context['schema']
+    assert harvest_object.package_id == 'package-id' and harvest_object.current
@@ -0,0 +1,26 @@
+"""Tests for identifiers.py."""
+import pytest
+
+pytest.importorskip('ckan')
+pytest.importorskip('ckanext.harvest')
+
+from ckanext.cioos_harvest import identifiers  # noqa: E402
+
+
+def test_normalize_doi():
+    assert identifiers.normalize_doi(' https://doi.org/10.1234/ABC ') == '10.1234/abc'
+    assert identifiers.normalize_doi('doi:10.1234/abc') == '10.1234/abc'
+    assert identifiers.normalize_doi('https://example.org/10.1234') is None
+    assert identifiers.normalize_doi(None) is None
+
+
+def test_doi_identifiers():
+    value = '[{"code": "https://doi.org/10.1234/ABC"}, {"code": "doi:10.1234/abc"}, {"code": "not a doi"}]'
+    assert identifiers.doi_identifiers(value) == ['10.1234/abc']
+    assert identifiers.doi_identifiers({'code': 'http://dx.doi.org/10.5678/x'}) == ['10.5678/x']
+    assert identifiers.doi_identifiers(None) == []
+
+
+def test_record_identifiers():
+    assert identifiers.record_identifiers('guid-1', {'code': '10.1234/abc'}, ['guid-1', 'guid-2', None]) == [
+        ('guid-1', 'guid'), ('guid-2', 'guid'), ('10.1234/abc', 'doi')]
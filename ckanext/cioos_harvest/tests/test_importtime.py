@@ -0,0 +1,70 @@
+"""Import cost of the plugin module and its commands."""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('ckan')
+pytest.importorskip('ckanext.spatial')
+
+# modules only the harvesters need, the plugin must not import them on load
+HARVESTER_MODULES = [
+    'requests',
+    'urllib3.contrib.pyopenssl',
+    'ckanext.harvest.harvesters.ckanharvester',
+    'ckanext.spatial.harvesters.base',
+    'ckanext.spatial.validation.validation',
+    'ckanext.cioos_harvest.harvesters',
+]
+
+# modules loaded by any CKAN process, their cost is not the plugin's
+PRELOAD = 'import ckan.plugins.toolkit; import ckanext.spatial.interfaces'
+
+# cumulative import time budget of the plugin module, in microseconds
+IMPORT_BUDGET_US = int(os.environ.get('CIOOS_HARVEST_IMPORT_BUDGET_US', 500000))
+
+
+def _run(args, code):
+    return subprocess.run(
+        [sys.executable] + args + ['-c', code],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+
+
+def test_plugin_does_not_import_harvester_modules():
+    result = _run([], PRELOAD + '''
+import json, sys
+before = set(sys.modules)
+import ckanext.cioos_harvest.plugin
+print(json.dumps(sorted(set(sys.modules) - before)))
+''')
+    imported = set(json.loads(result.stdout.strip().splitlines()[-1]))
+    assert not imported & set(HARVESTER_MODULES)
+
+
+def test_commands_do_not_import_harvester_modules():
+    # IClick loads the commands for every ckan command
+    result = _run([], PRELOAD + '''
+import json, sys
+before = set(sys.modules)
+import ckanext.cioos_harvest.plugin
+ckanext.cioos_harvest.plugin.Cioos_HarvestPlugin().get_commands()
+print(json.dumps(sorted(set(sys.modules) - before)))
+''')
+    imported = set(json.loads(result.stdout.strip().splitlines()[-1]))
+    assert 'ckanext.cioos_harvest.cli' in imported
+    assert not imported & set(HARVESTER_MODULES)
+
+
+def test_plugin_import_time():
+    result = _run(['-X', 'importtime'], PRELOAD + '; import ckanext.cioos_harvest.plugin')
+    cumulative = None
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() == 'ckanext.cioos_harvest.plugin':
+            cumulative = int(parts[1].strip())
+    assert cumulative is not None
+    assert cumulative < IMPORT_BUDGET_US
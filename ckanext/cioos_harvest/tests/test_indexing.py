@@ -0,0 +1,216 @@
+"""Tests for indexing.py."""
+import os
+
+import pytest
+
+pytest.importorskip('ckan')
+pytest.importorskip('ckanext.harvest')
+
+from ckanext.cioos_harvest import actions, indexing  # noqa: E402
+
+
+class FakeSource(object):
+    id = 'source-1'
+
+
+class FakeHarvestObject(object):
+    source = FakeSource()
+
+    def __init__(self, job_id):
+        self.harvest_job_id = job_id
+
+
+class FakeJob(object):
+
+    def __init__(self, status):
+        self.status = status
+
+
+class FakeJobModel(object):
+    jobs = {}
+
+    @classmethod
+    def get(cls, job_id):
+        return cls.jobs.get(job_id)
+
+
+class FakePackageModel(object):
+
+    @staticmethod
+    def get(id):
+        return FakeSource()
+
+
+class FakeActionsModel(object):
+    Package = FakePackageModel
+
+
+class FakeColumn(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, other):
+        return (self.name, other)
+
+    def __ne__(self, other):
+        return None
+
+
+class FakeHarvestObjectModel(object):
+    package_id = FakeColumn('package_id')
+    harvest_job_id = FakeColumn('harvest_job_id')
+
+
+class FakeQuery(object):
+
+    def __init__(self, package_ids_by_job):
+        self.package_ids_by_job = package_ids_by_job
+        self.job_id = None
+
+    def filter(self, condition):
+        if condition and condition[0] == 'harvest_job_id':
+            self.job_id = condition[1]
+        return self
+
+    def distinct(self):
+        return self
+
+    def __iter__(self):
+        return iter((package_id,) for package_id in self.package_ids_by_job.get(self.job_id, []))
+
+
+class FakeIndex(object):
+
+    def __init__(self):
+        self.updated = []
+        self.removed = []
+
+    def update_dict(self, pkg_dict, defer_commit=False):
+        assert defer_commit
+        self.updated.append(pkg_dict['id'])
+
+    def remove_dict(self, pkg_dict):
+        self.removed.append(pkg_dict['id'])
+
+
+@pytest.fixture
+def storage(monkeypatch, tmp_path):
+    monkeypatch.setattr(indexing, 'get_storage_dir', lambda *parts: os.path.join(str(tmp_path), *parts))
+    monkeypatch.setattr(indexing, '_marked_jobs', set())
+    return tmp_path
+
+
+@pytest.fixture
+def solr(monkeypatch):
+    '''
+    Datasets written by each job, and the datasets indexed and the solr
+    commits made by index_job_packages
+    '''
+    state = {
+        'jobs': {},
+        'datasets': {},
+        'index': FakeIndex(),
+        'commits': 0,
+    }
+
+    class FakeSession(object):
+
+        @staticmethod
+        def query(column):
+            return FakeQuery(state['jobs'])
+
+    class FakeModel(object):
+        Session = FakeSession()
+        Package = FakePackageModel
+
+    def package_show(context, data_dict):
+        if data_dict['id'] not in state['datasets']:
+            raise indexing.toolkit.ObjectNotFound()
+        return state['datasets'][data_dict['id']]
+
+    def commit():
+        state['commits'] += 1
+
+    monkeypatch.setattr(indexing, 'model', FakeModel)
+    monkeypatch.setattr(indexing, 'HarvestObject', FakeHarvestObjectModel)
+    monkeypatch.setattr(indexing, 'index_for', lambda model_class: state['index'])
+    monkeypatch.setattr(indexing, 'commit', commit)
+    monkeypatch.setattr(indexing.toolkit, 'get_action', lambda name: package_show)
+    return state
+
+
+def test_mark_job_pending(storage):
+    indexing.mark_job_pending(FakeHarvestObject('job-1'))
+    indexing.mark_job_pending(FakeHarvestObject('job-1'))
+    indexing.mark_job_pending(FakeHarvestObject('job-2'))
+    assert sorted(os.listdir(str(storage / 'pending_index' / 'source-1'))) == ['job-1', 'job-2']
+
+
+def test_automatic_indexing_disabled(monkeypatch):
+    monkeypatch.setitem(indexing.toolkit.config, indexing.AUTOMATIC_INDEXING, True)
+    with pytest.raises(ValueError):
+        with indexing.automatic_indexing_disabled():
+            assert indexing.toolkit.config[indexing.AUTOMATIC_INDEXING] is False
+            raise ValueError()
+    assert indexing.toolkit.config[indexing.AUTOMATIC_INDEXING] is True
+
+
+def test_index_job_packages(solr):
+    solr['jobs']['job-1'] = ['kept', 'deleted', 'purged']
+    solr['datasets'] = {'kept': {'id': 'kept', 'state': 'active'},
+                        'deleted': {'id': 'deleted', 'state': 'deleted'}}
+
+    assert indexing.index_job_packages('job-1') == 3
+    assert solr['index'].updated == ['kept']
+    assert solr['index'].removed == ['deleted']
+    assert solr['commits'] == 1
+
+
+def test_index_pending_jobs(storage, solr, monkeypatch):
+    jobs = {'finished': FakeJob('Finished'), 'running': FakeJob('Running')}
+    monkeypatch.setattr(FakeJobModel, 'jobs', jobs)
+    monkeypatch.setattr(indexing, 'HarvestJob', FakeJobModel)
+    solr['jobs'] = {'finished': ['a', 'b'], 'running': ['c']}
+    solr['datasets'] = dict((package_id, {'id': package_id}) for package_id in 'abc')
+    for job_id in ('finished', 'running', 'deleted-job'):
+        indexing.mark_job_pending(FakeHarvestObject(job_id))
+
+    indexing.index_pending_jobs('source-1')
+
+    # the running job is indexed when it finishes, the marker of a job that
+    # no longer exists is dropped
+    assert os.listdir(str(storage / 'pending_index' / 'source-1')) == ['running']
+    assert solr['index'].updated == ['a', 'b']
+    assert solr['commits'] == 1
+
+    jobs['running'].status = 'Finished'
+    indexing.index_pending_jobs('source-1')
+    assert os.listdir(str(storage / 'pending_index' / 'source-1')) == []
+    assert solr['index'].updated == ['a', 'b', 'c']
+
+
+def test_index_pending_jobs_without_markers(storage, solr):
+    indexing.index_pending_jobs('source-1')
+    assert solr['commits'] == 0
+
+
+def test_harvest_source_reindex_indexes_pending_jobs(monkeypatch):
+    indexed = []
+    monkeypatch.setattr(indexing, 'index_pending_jobs', indexed.append)
+    monkeypatch.setattr(actions, 'model', FakeActionsModel)
+
+    result = actions.harvest_source_reindex(lambda context, data_dict: 'reindexed', {}, {'id': 'source-name'})
+
+    assert result == 'reindexed'
+    assert indexed == ['source-1']
+
+
+def test_harvest_source_reindex_ignores_indexing_errors(monkeypatch):
+    def index_pending_jobs(source_id):
+        raise IOError('storage unavailable')
+
+    monkeypatch.setattr(indexing, 'index_pending_jobs', index_pending_jobs)
+    monkeypatch.setattr(actions, 'model', FakeActionsModel)
+
+    assert actions.harvest_source_reindex(lambda context, data_dict: 'reindexed', {}, {'id': 'source-1'}) == 'reindexed'
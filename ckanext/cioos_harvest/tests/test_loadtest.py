@@ -0,0 +1,84 @@
+"""Tests for loadtest.py."""
+import json
+import xml.etree.ElementTree as ET
+
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import urlopen
+
+import pytest
+
+from ckanext.cioos_harvest.loadtest import FakePortal
+
+
+def _json(response):
+    status, content_type, content = response
+    assert (status, content_type) == (200, 'application/json')
+    return json.loads(content)
+
+
+def test_package_search_pages():
+    portal = FakePortal(datasets=25, page_size=10)
+    pages = [_json(portal.handle('GET', '/api/action/package_search', {'rows': ['100'], 'start': [str(start)]}))
+             for start in (0, 10, 20, 30)]
+    assert [page['result']['count'] for page in pages] == [25] * 4
+    assert [len(page['result']['results']) for page in pages] == [10, 10, 5, 0]
+    ids = [pkg['id'] for page in pages for pkg in page['result']['results']]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == 25
+
+
+def test_package_dict():
+    portal = FakePortal(datasets=5, resources=3)
+    pkg_dict = _json(portal.handle('GET', '/api/3/action/package_search', {}))['result']['results'][0]
+    assert len(pkg_dict['resources']) == 3
+    assert json.loads(pkg_dict['title'])['fr'].startswith('Load test dataset')
+    assert json.loads(pkg_dict['spatial'])['type'] == 'Polygon'
+    assert pkg_dict['xml_location_url'] == '%s/waf/%s.xml' % (portal.url, pkg_dict['name'])
+    assert FakePortal(datasets=5, external_xml=False).package_dict(0)['xml_location_url'] == ''
+
+
+def test_catalogue_depends_on_the_seed_only():
+    assert FakePortal(seed=1).package_dict(3) == FakePortal(seed=1).package_dict(3)
+    assert FakePortal(seed=1).dataset_id(3) != FakePortal(seed=2).dataset_id(3)
+
+
+def test_spatial_search():
+    portal = FakePortal(datasets=200, spatial_fraction=0.25)
+    results = _json(portal.handle('POST', '/api/2/search/dataset/geo', {}, '{}'))['results']
+    assert len(results) == 50
+    assert results[0] == portal.dataset_id(0)
+
+
+def test_waf():
+    portal = FakePortal(datasets=3)
+    status, content_type, listing = portal.handle('GET', '/waf/', {})
+    assert (status, content_type) == (200, 'text/html')
+    assert listing.count('<a href="loadtest-') == 3
+
+    status, content_type, document = portal.handle('GET', '/waf/loadtest-000002.xml', {})
+    assert (status, content_type) == (200, 'application/xml')
+    root = ET.fromstring(document.encode('utf-8'))
+    assert root.find('{http://www.isotc211.org/2005/gmd}fileIdentifier')[0].text == portal.dataset_id(2)
+
+    assert portal.handle('GET', '/waf/loadtest-000003.xml', {})[0] == 404
+    assert portal.handle('GET', '/waf/other.xml', {})[0] == 404
+    assert portal.handle('GET', '/api/action/package_show', {})[0] == 404
+
+
+def test_injected_errors():
+    portal = FakePortal(datasets=3, error_rate=1.0)
+    assert portal.handle('GET', '/waf/', {}) == (500, 'text/plain', 'Injected error')
+    assert (portal.requests, portal.errors) == (1, 1)
+    portal = FakePortal(datasets=3, error_rate=0.0)
+    portal.handle('GET', '/waf/', {})
+    assert (portal.requests, portal.errors) == (1, 0)
+
+
+def test_http_server():
+    with FakePortal(datasets=3) as portal:
+        assert portal.port
+        response = urlopen(portal.url + '/api/action/package_search?rows=2', timeout=10)
+        assert len(json.loads(response.read().decode('utf-8'))['result']['results']) == 2
+        with pytest.raises(HTTPError) as e:
+            urlopen(portal.url + '/missing', timeout=10)
+        assert e.value.code == 404
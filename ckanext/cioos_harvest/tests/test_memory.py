@@ -0,0 +1,190 @@
+"""Tests for memory.py."""
+import os
+import tracemalloc
+
+import pytest
+
+pytest.importorskip('ckan')
+pytest.importorskip('ckanext.harvest')
+
+from ckanext.cioos_harvest import memory  # noqa: E402
+
+MB = memory.MB
+
+
+class FakeSource(object):
+
+    def __init__(self, config):
+        self.config = config
+
+
+class FakeHarvestObject(object):
+
+    def __init__(self, object_id, job_id='job-1', config='{"memory_monitor": true}'):
+        self.id = object_id
+        self.harvest_job_id = job_id
+        self.source = FakeSource(config)
+
+
+class FakeColumn(object):
+
+    def __eq__(self, other):
+        return None
+
+    def __ne__(self, other):
+        return None
+
+    def in_(self, values):
+        return None
+
+
+class FakeHarvestObjectModel(object):
+    id = FakeColumn()
+    harvest_job_id = FakeColumn()
+    state = FakeColumn()
+
+
+class FakeQuery(object):
+
+    def __init__(self, remaining):
+        self.remaining = remaining
+
+    def filter(self, condition):
+        return self
+
+    def count(self):
+        return self.remaining
+
+
+class FakeSession(object):
+    identity_map = {}
+
+    def __init__(self):
+        self.remaining = 0
+
+    def query(self, column):
+        return FakeQuery(self.remaining)
+
+
+class FakeModel(object):
+    Session = FakeSession()
+
+
+@pytest.fixture
+def rss(monkeypatch):
+    '''
+    Resident memory of the worker, in MB
+    '''
+    current = {'mb': 100}
+    monkeypatch.setattr(memory, '_recycle', {'start_rss': None, 'pending': False})
+    monkeypatch.setattr(memory, '_monitor', None)
+    monkeypatch.setattr(memory, 'rss_bytes', lambda: current['mb'] * MB)
+    monkeypatch.setitem(memory.toolkit.config, 'ckan.harvest_memory_recycle_mb', 50)
+    return current
+
+
+@pytest.fixture
+def monitor(monkeypatch, tmp_path):
+    monkeypatch.setattr(memory, 'model', FakeModel)
+    monkeypatch.setattr(memory, 'HarvestObject', FakeHarvestObjectModel)
+    monkeypatch.setattr(memory, 'get_storage_dir', lambda *parts: os.path.join(str(tmp_path), *parts))
+    monkeypatch.setattr(FakeModel.Session, 'remaining', 0)
+    tracing = tracemalloc.is_tracing()
+    yield memory.MemoryMonitor(threshold=MB)
+    if not tracing:
+        tracemalloc.stop()
+
+
+def test_worker_exits_after_growing_past_the_limit(rss):
+    memory.recycle_if_requested()
+
+    rss['mb'] = 140
+    memory.object_finished(FakeHarvestObject('object-1', config='{}'))
+    memory.recycle_if_requested()
+
+    rss['mb'] = 151
+    memory.object_finished(FakeHarvestObject('object-2', config='{}'))
+    assert memory._recycle['pending']
+    with pytest.raises(SystemExit) as e:
+        memory.recycle_if_requested()
+    assert e.value.code == 3
+
+
+def test_worker_is_not_recycled_without_a_limit(rss, monkeypatch):
+    monkeypatch.setitem(memory.toolkit.config, 'ckan.harvest_memory_recycle_mb', 0)
+    memory.recycle_if_requested()
+    rss['mb'] = 1000
+    memory.object_finished(FakeHarvestObject('object-1', config='{}'))
+    memory.recycle_if_requested()
+
+
+def test_growth_is_measured_from_the_first_object(rss):
+    # workers not started by fetch-consumer never record a start
+    rss['mb'] = 1000
+    memory.object_finished(FakeHarvestObject('object-1', config='{}'))
+    assert not memory._recycle['pending']
+
+
+def test_stage_over_the_threshold_is_flagged(monitor):
+    harvest_object = FakeHarvestObject('object-1')
+    with monitor.stage(harvest_object, 'import'):
+        retained = bytearray(2 * MB)
+    with monitor.stage(harvest_object, 'fetch'):
+        pass
+
+    stats = monitor.jobs['job-1']
+    assert stats['stages']['import']['calls'] == 1
+    assert stats['stages']['import']['allocated'] >= 2 * MB
+    assert [(object_id, stage) for object_id, stage, _, _, _ in stats['flagged']] == [('object-1', 'import')]
+    del retained
+
+
+def test_nested_stage_keeps_the_outer_peak(monitor):
+    harvest_object = FakeHarvestObject('object-1')
+    with monitor.stage(harvest_object, 'import'):
+        transient = bytearray(4 * MB)
+        del transient
+        with monitor.stage(harvest_object, 'get_package_dict'):
+            pass
+
+    stages = monitor.jobs['job-1']['stages']
+    assert stages['import']['peak'] >= 4 * MB
+    assert stages['get_package_dict']['peak'] < MB
+
+
+def test_job_is_reported_after_its_last_object(monitor, tmp_path):
+    with monitor.stage(FakeHarvestObject('object-1'), 'import'):
+        pass
+
+    FakeModel.Session.remaining = 1
+    monitor.object_finished(FakeHarvestObject('object-1'))
+    assert 'job-1' in monitor.jobs
+
+    FakeModel.Session.remaining = 0
+    monitor.object_finished(FakeHarvestObject('object-2'))
+    assert 'job-1' not in monitor.jobs
+    reports = os.listdir(str(tmp_path / 'memory'))
+    assert reports == ['job-1-%s.txt' % os.getpid()]
+    with open(str(tmp_path / 'memory' / reports[0])) as f:
+        report = f.read()
+    assert report.startswith('Memory report for harvest job job-1, 1 objects')
+    assert '  import: 1 calls' in report
+
+
+def test_oldest_job_is_reported_past_the_tracked_jobs(monitor, monkeypatch):
+    monkeypatch.setattr(memory, 'MAX_TRACKED_JOBS', 2)
+    for job_id in ('job-1', 'job-2', 'job-3'):
+        with monitor.stage(FakeHarvestObject('object-1', job_id), 'import'):
+            pass
+    assert list(monitor.jobs) == ['job-2', 'job-3']
+
+
+def test_monitored_is_disabled_by_default(monkeypatch):
+    def get_monitor():
+        raise AssertionError('the monitor is not used for this source')
+
+    monkeypatch.setattr(memory, 'get_monitor', get_monitor)
+    with memory.monitored(FakeHarvestObject('object-1', config='{}'), 'import'):
+        pass
+    with memory.monitored(None, 'import'):
+        pass
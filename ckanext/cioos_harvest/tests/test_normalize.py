@@ -0,0 +1,168 @@
+"""Tests for normalize.py."""
+import json
+import sys
+import types
+
+import pytest
+
+from ckanext.cioos_harvest import normalize
+
+
+def _load_json(value):
+    # the json.loads with fallback used by the hooks before normalize.py
+    try:
+        return json.loads(value)
+    except Exception:
+        return value
+
+
+def _trim_values(values):
+    # trim_values before the looks_like_json fast path
+    if isinstance(values, (int, float)):
+        return values
+    elif isinstance(values, list):
+        return [_trim_values(x) for x in values]
+    elif isinstance(values, dict):
+        return {k.strip(): _trim_values(v) for k, v in values.items()}
+    elif isinstance(values, str):
+        try:
+            json_object = json.loads(values)
+        except ValueError:
+            return values.strip()
+        else:
+            return json.dumps(_trim_values(json_object))
+    return values
+
+
+JSON_VALUES = [
+    '',
+    ' ',
+    'Ocean temperature',
+    '  padded title  ',
+    'true',
+    'false',
+    'null',
+    'NaN',
+    'Infinity',
+    '-Infinity',
+    '12',
+    '-3.5',
+    '1e5',
+    '0x10',
+    '"quoted"',
+    '{"en": "Title", "fr": "Titre"}',
+    ' {"en": "Title"} ',
+    '[["a", "b"], ["c"]]',
+    '[{"code": "10.1234/abc"}, [1, [2, 3]]]',
+    '{not json',
+    '[unterminated',
+    '-not a number',
+    'True',
+    None,
+    12,
+    ['a', 'b'],
+    {'en': 'Title'},
+    b'{"en": "Title"}',
+]
+
+
+@pytest.mark.parametrize('value', JSON_VALUES)
+def test_from_json_matches_json_loads_with_fallback(value):
+    expected = _load_json(value)
+    result = normalize.from_json(value)
+    if isinstance(expected, float) and expected != expected:
+        assert result != result
+    else:
+        assert result == expected
+        assert type(result) is type(expected)
+
+
+@pytest.mark.parametrize('value', [v for v in JSON_VALUES if isinstance(v, str)] + [
+    ['  a ', {' key ': ' value '}],
+    {' title ': ' {"en": " Title "} '},
+    [[' nested ', [' list ']]],
+    3,
+    None,
+])
+def test_trim_values_matches_previous_implementation(value):
+    expected = _trim_values(value)
+    result = normalize.trim_values(value)
+    if isinstance(expected, float) and expected != expected:
+        assert result != result
+    else:
+        assert result == expected
+
+
+def test_trim_values_strips_json_strings():
+    assert normalize.trim_values(' {" en ": " Title "} ') == '{"en": "Title"}'
+    assert normalize.trim_values({' a ': [' b ', 1]}) == {'a': ['b', 1]}
+
+
+def test_as_language_dict():
+    assert normalize.as_language_dict('Title', ['en', 'fr']) == {'en': 'Title', 'fr': 'Title'}
+    assert normalize.as_language_dict('{"en": "Title", "fr": "Titre"}', ['en', 'fr']) == {'en': 'Title', 'fr': 'Titre'}
+    assert normalize.as_language_dict({'en': 'Title'}, ['en', 'fr']) == {'en': 'Title'}
+    assert normalize.as_language_dict(None, ['en']) == {'en': None}
+    assert normalize.as_language_dict('["a", "b"]', ['en']) == {'en': ['a', 'b']}
+
+
+def test_unique():
+    assert normalize.unique(['b', 'a', 'b', 'c', 'a']) == ['b', 'a', 'c']
+    assert normalize.unique([]) == []
+    assert normalize.unique([1, 1.0, True]) == [1]
+
+
+def test_unique_unhashable_values():
+    values = [['a', 'b'], 'a', ['a', 'b'], {'en': 'x'}, 'a', {'en': 'x'}, ['b']]
+    assert normalize.unique(values) == [['a', 'b'], 'a', {'en': 'x'}, ['b']]
+
+
+@pytest.fixture
+def fake_munge(monkeypatch):
+    calls = []
+
+    def munge_tag(tag):
+        calls.append(tag)
+        return tag.lower().replace(' ', '-')
+
+    ckan = types.ModuleType('ckan')
+    lib = types.ModuleType('ckan.lib')
+    munge = types.ModuleType('ckan.lib.munge')
+    munge.munge_tag = munge_tag
+    ckan.lib = lib
+    lib.munge = munge
+    monkeypatch.setitem(sys.modules, 'ckan', ckan)
+    monkeypatch.setitem(sys.modules, 'ckan.lib', lib)
+    monkeypatch.setitem(sys.modules, 'ckan.lib.munge', munge)
+    monkeypatch.setattr(normalize, '_munged_tags', {})
+    return calls
+
+
+def test_munge_tag_is_cached(fake_munge):
+    assert normalize.munge_tag('Sea Ice') == 'sea-ice'
+    assert normalize.munge_tag('Sea Ice') == 'sea-ice'
+    assert normalize.munge_tag('Salinity') == 'salinity'
+    assert fake_munge == ['Sea Ice', 'Salinity']
+
+
+def test_munge_tag_unhashable_values_are_not_cached(fake_munge):
+    class Tag(str):
+        __hash__ = None
+
+    assert normalize.munge_tag(Tag('Sea Ice')) == 'sea-ice'
+    assert normalize.munge_tag(Tag('Sea Ice')) == 'sea-ice'
+    assert len(fake_munge) == 2
+    assert normalize._munged_tags == {}
+
+
+def test_munge_tag_cache_is_bounded(fake_munge, monkeypatch):
+    monkeypatch.setattr(normalize, 'MUNGED_TAG_CACHE_SIZE', 3)
+    for tag in ['a', 'b', 'c', 'd']:
+        normalize.munge_tag(tag)
+    assert list(normalize._munged_tags) == ['d']
+
+
+def test_munge_tag_matches_ckan():
+    munge = pytest.importorskip('ckan.lib.munge')
+    for tag in ['Sea Ice', 'température', 'a/b:c', 'x' * 200]:
+        assert normalize.munge_tag(tag) == munge.munge_tag(tag)
@@ -0,0 +1,180 @@
+"""Tests for package_diff.py."""
+import copy
+
+from ckanext.cioos_harvest import package_diff
+
+EXISTING = {
+    'id': 'local-id',
+    'name': 'sea-surface-temperature',
+    'metadata_modified': '2021-03-01T00:00:00',
+    'metadata_created': '2021-01-01T00:00:00',
+    'num_resources': 2,
+    'title_translated': {'en': 'Sea surface temperature', 'fr': 'Température de surface'},
+    'notes': 'Hourly means',
+    'version': None,
+    'keywords': {'en': ['temperature'], 'fr': ['température']},
+    'tags': [{'name': 'temperature'}, {'name': 'ocean'}],
+    'groups': [{'id': 'group-id', 'name': 'hakai'}],
+    'extras': [
+        {'key': 'harvest_object_id', 'value': 'object-1'},
+        {'key': 'spatial', 'value': '{"type": "Point", "coordinates": [-128, 51]}'},
+    ],
+    'resources': [
+        {'id': 'resource-1', 'package_id': 'local-id', 'position': 0,
+         'url': 'https://example.org/data.csv', 'name': 'Data', 'format': 'CSV',
+         'created': '2021-01-01T00:00:00', 'datastore_active': False},
+        {'id': 'resource-2', 'package_id': 'local-id', 'position': 1,
+         'url': 'https://example.org/erddap', 'name': 'ERDDAP', 'format': 'ERDDAP'},
+    ],
+}
+
+
+def _remote(**changes):
+    remote = {
+        'id': 'remote-id',
+        'name': 'sea-surface-temperature-1',
+        'metadata_modified': '2021-04-01T00:00:00',
+        'num_resources': 3,
+        'title_translated': '{"en": "Sea surface temperature", "fr": "Température de surface"}',
+        'notes': ' Hourly means ',
+        'version': '',
+        'keywords': {'en': ['temperature'], 'fr': ['température']},
+        'tags': [{'name': 'ocean'}, {'name': 'temperature'}],
+        'groups': [{'name': 'hakai'}],
+        'extras': [
+            {'key': 'harvest_object_id', 'value': 'remote-object'},
+            {'key': 'spatial', 'value': '{"type": "Point", "coordinates": [-128, 51]}'},
+        ],
+        'resources': [
+            {'id': 'remote-resource-1', 'url': 'https://example.org/data.csv', 'name': 'Data', 'format': 'CSV'},
+            {'id': 'remote-resource-2', 'url': 'https://example.org/erddap', 'name': 'ERDDAP', 'format': 'ERDDAP'},
+        ],
+    }
+    remote.update(changes)
+    return remote
+
+
+def test_unchanged_package():
+    assert package_diff.diff_package(EXISTING, _remote()) == {}
+
+
+def test_ignored_fields():
+    remote = _remote(id='other', name='other', metadata_created='2000-01-01',
+                     num_resources=9, revision_id='x', isopen=True)
+    assert package_diff.diff_package(EXISTING, remote) == {}
+
+
+def test_ignore_fields_argument():
+    remote = _remote(notes='Daily means')
+    assert package_diff.diff_package(EXISTING, remote) == {'notes': 'Daily means'}
+    assert package_diff.diff_package(EXISTING, remote, ['notes']) == {}
+
+
+def test_fields_missing_from_the_harvested_package_are_not_compared():
+    remote = _remote()
+    del remote['notes']
+    del remote['keywords']
+    assert package_diff.diff_package(EXISTING, remote) == {}
+
+
+def test_empty_values_and_none():
+    assert package_diff.diff_package({'version': None}, {'version': ''}) == {}
+    assert package_diff.diff_package({'version': ''}, {'version': None}) == {}
+    assert package_diff.diff_package({}, {'version': '  '}) == {}
+    assert package_diff.diff_package({'keywords': None}, {'keywords': []}) == {}
+    assert package_diff.diff_package({'keywords': {}}, {'keywords': '{}'}) == {}
+    assert package_diff.diff_package({'version': None}, {'version': '1.0'}) == {'version': '1.0'}
+    assert package_diff.diff_package({'version': '1.0'}, {'version': None}) == {'version': None}
+
+
+def test_json_encoded_values_are_decoded():
+    assert package_diff.diff_package({'level': '0'}, {'level': 0}) == {}
+    assert package_diff.diff_package({'bbox': [1, 2]}, {'bbox': '[1, 2]'}) == {}
+    assert package_diff.diff_package({'level': '1'}, {'level': 2}) == {'level': 2}
+
+
+def test_extras():
+    extras = [
+        {'key': 'spatial', 'value': '{"type": "Point", "coordinates": [-128, 51]}'},
+        {'key': 'harvest_source_title', 'value': 'Other source'},
+    ]
+    assert package_diff.diff_package(EXISTING, _remote(extras=extras)) == {}
+    extras = list(reversed(extras))
+    assert package_diff.diff_package(EXISTING, _remote(extras=extras)) == {}
+
+    extras = [{'key': 'spatial', 'value': '{"type": "Point", "coordinates": [-129, 51]}'}]
+    assert package_diff.diff_package(EXISTING, _remote(extras=extras)) == {'extras': extras}
+
+    extras = [
+        {'key': 'spatial', 'value': '{"type": "Point", "coordinates": [-128, 51]}'},
+        {'key': 'doi', 'value': '10.1234/abc'},
+    ]
+    assert package_diff.diff_package(EXISTING, _remote(extras=extras)) == {'extras': extras}
+
+
+def test_tags_and_groups():
+    tags = [{'name': 'temperature'}]
+    assert package_diff.diff_package(EXISTING, _remote(tags=tags)) == {'tags': tags}
+    assert package_diff.diff_package(EXISTING, _remote(tags=['ocean', 'temperature'])) == {}
+    assert package_diff.diff_package(EXISTING, _remote(groups=[{'id': 'group-id'}])) == {}
+    groups = [{'name': 'hakai'}, {'name': 'cioos'}]
+    assert package_diff.diff_package(EXISTING, _remote(groups=groups)) == {'groups': groups}
+
+
+def test_changed_resource_keeps_its_id():
+    remote = _remote()
+    remote['resources'][1]['name'] = 'ERDDAP dataset'
+    patch = package_diff.diff_package(EXISTING, remote)
+    assert list(patch) == ['resources']
+    assert [r['id'] for r in patch['resources']] == ['resource-1', 'resource-2']
+    # the unchanged resource is sent as it is stored
+    assert patch['resources'][0] == EXISTING['resources'][0]
+    assert patch['resources'][1]['name'] == 'ERDDAP dataset'
+
+
+def test_resources_are_matched_by_url():
+    remote = _remote()
+    remote['resources'].reverse()
+    remote['resources'][0]['format'] = 'HTML'
+    patch = package_diff.diff_package(EXISTING, remote)
+    assert [r['id'] for r in patch['resources']] == ['resource-2', 'resource-1']
+    assert patch['resources'][0]['format'] == 'HTML'
+    assert patch['resources'][1] == EXISTING['resources'][0]
+
+
+def test_resources_are_matched_by_id():
+    remote = _remote()
+    remote['resources'][0].update({'id': 'resource-1', 'url': 'https://example.org/moved.csv'})
+    patch = package_diff.diff_package(EXISTING, remote)
+    assert [r['id'] for r in patch['resources']] == ['resource-1', 'resource-2']
+    assert patch['resources'][0]['url'] == 'https://example.org/moved.csv'
+
+
+def test_added_and_removed_resources():
+    remote = _remote()
+    remote['resources'].append({'url': 'https://example.org/new', 'name': 'New'})
+    patch = package_diff.diff_package(EXISTING, remote)
+    assert [r.get('id') for r in patch['resources']] == ['resource-1', 'resource-2', None]
+
+    remote = _remote()
+    remote['resources'].pop(0)
+    patch = package_diff.diff_package(EXISTING, remote)
+    assert patch['resources'] == [EXISTING['resources'][1]]
+
+
+def test_diff_does_not_change_the_existing_package():
+    existing = copy.deepcopy(EXISTING)
+    remote = _remote()
+    remote['resources'][0]['name'] = 'Changed'
+    package_diff.diff_package(existing, remote)
+    assert existing == EXISTING
+
+
+def test_reuse_resource_ids():
+    resources = [
+        {'url': 'https://example.org/erddap'},
+        {'url': 'https://example.org/other'},
+        {'id': 'resource-1', 'url': 'https://example.org/moved.csv'},
+    ]
+    package_diff.reuse_resource_ids(EXISTING['resources'], resources)
+    assert [r.get('id') for r in resources] == ['resource-2', None, 'resource-1']
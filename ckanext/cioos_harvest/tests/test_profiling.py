@@ -0,0 +1,150 @@
+"""Tests for profiling.py."""
+import json
+import os
+import pstats
+from collections import Counter
+
+import pytest
+
+pytest.importorskip('ckan')
+
+from ckanext.cioos_harvest import profiling  # noqa: E402
+
+
+class FakeSource(object):
+
+    def __init__(self, config):
+        self.config = json.dumps(config)
+
+
+class FakeHarvestObject(object):
+
+    def __init__(self, id, config):
+        self.id = id
+        self.source = FakeSource(config)
+
+
+class FakeSampler(object):
+    '''
+    Returns the same samples for every watched call
+    '''
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.watched = []
+
+    def watch(self, thread_id):
+        self.watched.append(thread_id)
+        return Counter(self.samples)
+
+    def unwatch(self, thread_id):
+        self.watched.remove(thread_id)
+
+
+class FakeClock(object):
+
+    def __init__(self, seconds_per_call):
+        self.seconds_per_call = seconds_per_call
+        self.now = 0.0
+
+    def time(self):
+        self.now += self.seconds_per_call
+        return self.now
+
+
+@pytest.fixture
+def profile_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, 'get_profile_dir', lambda: str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def sampler(monkeypatch):
+    sampler = FakeSampler({'harvesters.py:1(get_package_dict);fetch.py:1(get)': 3,
+                           'harvesters.py:1(get_package_dict)': 1})
+    monkeypatch.setattr(profiling, 'get_sampler', lambda: sampler)
+    return sampler
+
+
+def test_is_sampled():
+    ids = ['object-%s' % i for i in range(1000)]
+    assert not any(profiling.is_sampled(object_id, 0) for object_id in ids)
+    assert all(profiling.is_sampled(object_id, 1) for object_id in ids)
+    sampled = [object_id for object_id in ids if profiling.is_sampled(object_id, 10)]
+    assert 50 < len(sampled) < 150
+    # every hook of a sampled object is profiled
+    assert sampled == [object_id for object_id in ids if profiling.is_sampled(object_id, 10)]
+
+
+def test_stacks_are_merged(tmp_path):
+    first = str(tmp_path / 'first.stacks')
+    second = str(tmp_path / 'second.stacks')
+    profiling._write_stacks(first, Counter({'a;b;c': 2, 'a;b': 1}))
+    profiling._write_stacks(second, Counter({'a;c;c': 1}))
+    with open(first) as f:
+        assert f.read() == 'a;b;c 2\na;b 1\n'
+
+    own, total = profiling.merge_stacks([first, second])
+    assert own == Counter({'c': 3, 'b': 1})
+    # a function is counted once per sample however deep it recurses
+    assert total == Counter({'a': 4, 'b': 3, 'c': 3})
+
+
+def test_profiling_is_disabled_by_default(profile_dir, monkeypatch):
+    def get_sampler():
+        raise AssertionError('no stacks are sampled without a threshold')
+
+    monkeypatch.setattr(profiling, 'get_sampler', get_sampler)
+    with profiling.profiled(FakeHarvestObject('object-1', {}), 'get_package_dict'):
+        pass
+    with profiling.profiled(None, 'get_package_dict'):
+        pass
+    assert os.listdir(str(profile_dir)) == []
+
+
+def test_sampled_object_is_profiled(profile_dir):
+    harvest_object = FakeHarvestObject('object-1', {'profile_sample_rate': 1})
+    with profiling.profiled(harvest_object, 'get_package_dict'):
+        sorted(range(1000))
+
+    assert os.listdir(str(profile_dir)) == ['object-1.get_package_dict.prof']
+    stats = pstats.Stats(str(profile_dir / 'object-1.get_package_dict.prof'))
+    assert any(name == '<built-in method builtins.sorted>' for _, _, name in stats.stats)
+
+
+def test_nested_hooks_are_part_of_the_outer_profile(profile_dir):
+    harvest_object = FakeHarvestObject('object-1', {'profile_sample_rate': 1})
+    with profiling.profiled(harvest_object, 'get_package_dict'):
+        with profiling.profiled(harvest_object, 'modify_package_dict'):
+            pass
+    assert os.listdir(str(profile_dir)) == ['object-1.get_package_dict.prof']
+
+    # the next call is profiled again
+    with profiling.profiled(harvest_object, 'modify_package_dict'):
+        pass
+    assert sorted(os.listdir(str(profile_dir))) == [
+        'object-1.get_package_dict.prof', 'object-1.modify_package_dict.prof']
+
+
+def test_stacks_of_slow_calls_are_kept(profile_dir, sampler, monkeypatch):
+    config = {'profile_threshold': 1}
+    monkeypatch.setattr(profiling, 'time', FakeClock(0.1))
+    with profiling.profiled(FakeHarvestObject('fast', config), 'get_package_dict'):
+        pass
+    monkeypatch.setattr(profiling, 'time', FakeClock(2))
+    with profiling.profiled(FakeHarvestObject('slow', config), 'get_package_dict'):
+        pass
+
+    assert sampler.watched == []
+    assert os.listdir(str(profile_dir)) == ['slow.get_package_dict.stacks']
+    own, total = profiling.merge_stacks([str(profile_dir / 'slow.get_package_dict.stacks')])
+    assert own == Counter({'fetch.py:1(get)': 3, 'harvesters.py:1(get_package_dict)': 1})
+
+
+def test_profiles_are_kept_when_the_hook_fails(profile_dir):
+    harvest_object = FakeHarvestObject('object-1', {'profile_sample_rate': 1})
+    with pytest.raises(ValueError):
+        with profiling.profiled(harvest_object, 'get_package_dict'):
+            raise ValueError()
+    assert os.listdir(str(profile_dir)) == ['object-1.get_package_dict.prof']
+    assert not profiling._local.active
@@ -0,0 +1,119 @@
+"""Tests for replay.py."""
+import json
+
+import pytest
+
+pytest.importorskip('ckan')
+
+import ckan.plugins.toolkit as toolkit  # noqa: E402
+
+from ckanext.cioos_harvest import replay  # noqa: E402
+
+
+class _Source(object):
+    id = 'source-id'
+    url = 'https://catalogue.example.org'
+    title = 'Example'
+    config = json.dumps({'capture': True})
+
+
+class _HarvestObject(object):
+    id = 'object-id'
+    guid = 'guid'
+    package_id = None
+    harvest_job_id = 'job-id'
+    content = '<MD_Metadata/>'
+    extras = []
+    source = _Source()
+
+
+class _Calls(object):
+
+    def get_action(self, name):
+        def action(context=None, data_dict=None):
+            if name == 'group_show':
+                raise toolkit.ObjectNotFound()
+            return {'id': data_dict['id'], 'action': name}
+        return action
+
+    def get_xml_url_content(self, xml_url, *args, **kwargs):
+        return '<doc/>'
+
+    def post_content(self, url, params={}):
+        return '{"results": []}'
+
+
+class _Harvester(object):
+    config = {'capture': True}
+
+    @replay.capture('modify_package_dict')
+    def modify_package_dict(self, package_dict, harvest_object, calls=None):
+        package_dict['source'] = calls.get_action('harvest_source_show')({}, {'id': harvest_object.source.id})
+        package_dict['document'] = calls.get_xml_url_content('https://example.org/doc.xml', 1.0, harvest_object)
+        try:
+            calls.get_action('group_show')({}, {'id': 'missing'})
+        except toolkit.ObjectNotFound:
+            pass
+        return package_dict
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    monkeypatch.setattr(replay, 'get_capture_dir', lambda: str(tmp_path))
+    return replay.Corpus(str(tmp_path))
+
+
+def test_capture_records_calls_without_patching_globals(corpus):
+    get_action = toolkit.get_action
+    output = _Harvester().modify_package_dict({'name': 'dataset'}, _HarvestObject(), calls=_Calls())
+    assert toolkit.get_action is get_action
+    assert output['document'] == '<doc/>'
+
+    record, = corpus.records()
+    assert record['inputs'] == {'package_dict': {'name': 'dataset'}}
+    assert [(a['name'], a.get('error')) for a in record['actions']] == [
+        ('harvest_source_show', None), ('group_show', 'ObjectNotFound')]
+    assert [(h['method'], h['url']) for h in record['http']] == [('GET', 'https://example.org/doc.xml')]
+    assert corpus.get(record['http'][0]['body']) == '<doc/>'
+
+
+def test_recorded_calls_are_replayed(corpus):
+    _Harvester().modify_package_dict({'name': 'dataset'}, _HarvestObject(), calls=_Calls())
+    record, = corpus.records()
+    actions = replay.ActionStubs(record['actions'])
+    http = replay.HttpStubs(corpus)
+    assert actions.get_action('harvest_source_show')({}, {'id': 'source-id'}) == {
+        'id': 'source-id', 'action': 'harvest_source_show'}
+    with pytest.raises(toolkit.ObjectNotFound):
+        actions.get_action('group_show')({}, {'id': 'missing'})
+    assert http.get_xml_url_content('https://example.org/doc.xml') == '<doc/>'
+
+
+def test_replay_runs_the_recorded_harvester(corpus):
+    output = _Harvester().modify_package_dict({'name': 'dataset'}, _HarvestObject(), calls=_Calls())
+    record, = corpus.records()
+    assert record['harvester'] == '%s._Harvester' % __name__
+
+    (replayed_record, result), = replay.replay(corpus)
+    assert 'error' not in result
+    assert result['output'] == record['output'] == replay._to_json(output)
+
+
+def test_replay_reports_unknown_harvesters(corpus):
+    _Harvester().modify_package_dict({'name': 'dataset'}, _HarvestObject(), calls=_Calls())
+    _Harvester().modify_package_dict({'name': 'other'}, _HarvestObject(), calls=_Calls())
+    records = list(corpus.records())
+    # the plugin class named by records captured while the hooks were
+    # methods of the plugin
+    records[0]['harvester'] = 'Cioos_HarvestPlugin'
+
+    class _Corpus(object):
+        def records(self, hook=None):
+            return iter(records)
+
+        def get(self, key):
+            return corpus.get(key)
+
+    results = [result for record, result in replay.replay(_Corpus())]
+    assert results[0]['error'].startswith('Harvester Cioos_HarvestPlugin not available')
+    assert 'error' not in results[1]
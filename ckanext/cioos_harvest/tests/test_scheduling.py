@@ -0,0 +1,76 @@
+"""Tests for scheduling.py."""
+import json
+
+from ckanext.cioos_harvest import scheduling
+from ckanext.cioos_harvest.scheduling import Scheduler, estimate_units, fair_order, group_key
+
+
+def test_estimate_units():
+    assert estimate_units({}) == scheduling.BASE_UNITS
+    pkg_dict = {
+        'xml_location_url': json.dumps(['https://example.org/a.xml', 'https://example.org/b.xml']),
+        'cited-responsible-party': [{'organisation-name': 'A'}, {'organisation-name': 'B'}],
+        'metadata-point-of-contact': json.dumps({'organisation-name': 'C'}),
+        'resources': [{}, {}, {}, {}],
+    }
+    assert estimate_units(pkg_dict) == (
+        scheduling.BASE_UNITS + 2 * scheduling.XML_URL_UNITS +
+        3 * scheduling.CONTACT_UNITS + 4 * scheduling.RESOURCE_UNITS)
+
+
+def test_estimate_units_single_xml_url():
+    assert estimate_units({'xml_location_url': 'https://example.org/a.xml'}) == (
+        scheduling.BASE_UNITS + scheduling.XML_URL_UNITS)
+
+
+def test_estimate_units_included_document_is_not_fetched():
+    pkg_dict = {'xml_location_url': 'https://example.org/a.xml', 'harvest_document_content': '<MD_Metadata/>'}
+    assert estimate_units(pkg_dict) == scheduling.BASE_UNITS
+
+
+def test_group_key():
+    pkg_dict = {'organization': {'name': 'hakai'}, 'owner_org': 'org-id'}
+    assert group_key(pkg_dict, 'organization') == 'hakai'
+    assert group_key({'organization': None, 'owner_org': 'org-id'}, 'organization') == 'org-id'
+    assert group_key({}, 'organization') == ''
+    assert group_key(pkg_dict, 'none') == ''
+
+
+def test_fair_order_cheapest_first_within_a_group():
+    assert fair_order([('a', 'g', 3.0), ('b', 'g', 1.0), ('c', 'g', 2.0)]) == ['b', 'c', 'a']
+
+
+def test_fair_order_interleaves_groups_by_cost_served():
+    items = [
+        ('big-1', 'big', 10.0), ('big-2', 'big', 10.0),
+        ('small-1', 'small', 1.0), ('small-2', 'small', 1.0), ('small-3', 'small', 1.0),
+    ]
+    assert fair_order(items) == ['big-1', 'small-1', 'small-2', 'small-3', 'big-2']
+
+
+def test_fair_order_keeps_group_order_on_ties():
+    items = [('a1', 'a', 1.0), ('b1', 'b', 1.0), ('a2', 'a', 1.0), ('b2', 'b', 1.0)]
+    assert fair_order(items) == ['a1', 'b1', 'a2', 'b2']
+
+
+def test_fair_order_empty():
+    assert fair_order([]) == []
+
+
+def test_scheduler_order(monkeypatch):
+    # the known record took 20 seconds for 1 unit, new records are estimated
+    # at that rate
+    monkeypatch.setattr(scheduling, 'previous_durations', lambda source_id: {'remote-slow': 20.0})
+    scheduler = Scheduler('source-id', {})
+    scheduler.add_page([
+        {'id': 'remote-slow', 'organization': {'name': 'a'}},
+        {'id': 'remote-new', 'organization': {'name': 'a'}, 'resources': [{}, {}]},
+        {'id': 'remote-other', 'organization': {'name': 'b'}},
+    ], ['obj-slow', 'obj-new', 'obj-other'])
+    assert scheduler.estimates() == {'obj-slow': 20.0, 'obj-new': 40.0, 'obj-other': 20.0}
+    assert scheduler.order(['obj-slow', 'obj-new', 'obj-other', 'obj-unknown']) == [
+        'obj-slow', 'obj-other', 'obj-new', 'obj-unknown']
+
+
+def test_scheduler_without_objects():
+    assert Scheduler('source-id', {}).order(['a', 'b']) == ['a', 'b']
@@ -0,0 +1,89 @@
+"""Tests for search_text.py."""
+import io
+
+import pytest
+
+from ckanext.cioos_harvest.search_text import SearchTextExtractor, extract_search_text
+
+ISO_DOCUMENT = '''<?xml version="1.0" encoding="utf-8"?>
+<mdb:MD_Metadata xmlns:mdb="http://standards.iso.org/iso/19115/-3/mdb/2.0"
+    xmlns:mri="http://standards.iso.org/iso/19115/-3/mri/1.0"
+    xmlns:cit="http://standards.iso.org/iso/19115/-3/cit/2.0"
+    xmlns:gco="http://standards.iso.org/iso/19115/-3/gco/1.0">
+  <mdb:identificationInfo>
+    <mri:MD_DataIdentification>
+      <mri:citation>
+        <cit:CI_Citation>
+          <cit:title><gco:CharacterString>Sea surface temperature</gco:CharacterString></cit:title>
+        </cit:CI_Citation>
+      </mri:citation>
+      <mri:abstract><gco:CharacterString>Daily means</gco:CharacterString></mri:abstract>
+      <mri:status>
+        <mri:MD_ProgressCode codeList="codeListLocation#MD_ProgressCode" codeListValue="onGoing"/>
+      </mri:status>
+    </mri:MD_DataIdentification>
+  </mdb:identificationInfo>
+</mdb:MD_Metadata>
+'''
+
+
+def _iter_text(document, xpaths=None):
+    return list(SearchTextExtractor(xpaths).iter_text(io.BytesIO(document.encode('utf-8'))))
+
+
+def test_mixed_content_in_document_order():
+    assert _iter_text('<a>x<b>y</b>tail text</a>') == ['x', 'y', 'tail text']
+    assert extract_search_text('<a>x<b>y</b>tail text</a>') == 'x y tail text'
+
+
+def test_mixed_content_tails_of_nested_children():
+    document = '<p>one <em>two <b>three</b> four</em> five <i>six</i> seven</p>'
+    assert _iter_text(document) == ['one', 'two', 'three', 'four', 'five', 'six', 'seven']
+
+
+def test_tails_belong_to_the_parent_selection():
+    document = '<r>outside<t>inside<i>child</i>child tail</t>tail of t</r>'
+    assert _iter_text(document, ['//t']) == ['inside', 'child', 'child tail']
+
+
+def test_xpath_allow_list():
+    xpaths = ['//title', '//*/@codeListValue']
+    assert extract_search_text(ISO_DOCUMENT, xpaths) == 'Sea surface temperature onGoing'
+
+
+def test_xpath_steps_and_wildcards():
+    assert extract_search_text(ISO_DOCUMENT, ['//citation/*/title']) == 'Sea surface temperature'
+    assert extract_search_text(ISO_DOCUMENT, ['//MD_DataIdentification/*/CharacterString']) == 'Daily means'
+    assert extract_search_text(ISO_DOCUMENT, ['//abstract/*/title']) == ''
+
+
+def test_anchored_xpath():
+    assert extract_search_text(ISO_DOCUMENT, ['/MD_Metadata/identificationInfo']) == 'Sea surface temperature Daily means'
+    assert extract_search_text(ISO_DOCUMENT, ['/identificationInfo']) == ''
+
+
+def test_namespace_prefixes_are_ignored():
+    assert extract_search_text(ISO_DOCUMENT, ['//cit:title']) == 'Sea surface temperature'
+    assert extract_search_text(ISO_DOCUMENT, ['//mri:status/*/@gco:codeListValue']) == 'onGoing'
+
+
+def test_default_xpaths_remove_duplicates():
+    document = '<r><a>same</a><b>same</b><c code="x" codeListValue="same"/></r>'
+    assert extract_search_text(document) == 'same'
+
+
+def test_text_split_across_parser_reads():
+    # iterparse reads the source in chunks, text is only complete at the
+    # event that follows it
+    long_text = 'word ' * 20000
+    document = '<a>%s<b>y</b>%s</a>' % (long_text, long_text)
+    assert _iter_text(document) == [long_text.strip(), 'y', long_text.strip()]
+
+
+def test_invalid_xpath():
+    with pytest.raises(ValueError):
+        SearchTextExtractor(['//'])
+
+
+def test_invalid_document():
+    assert extract_search_text('<a><b></a>') == ''
@@ -0,0 +1,90 @@
+"""Tests for spatial_filter.py."""
+import json
+
+import pytest
+
+pytest.importorskip('shapely')
+
+from ckanext.cioos_harvest import spatial_filter  # noqa: E402
+from ckanext.cioos_harvest.spatial_filter import SpatialFilter, package_geometry, parse_filter  # noqa: E402
+
+
+def _polygon(minx, miny, maxx, maxy):
+    return {'type': 'Polygon', 'coordinates': [[
+        [minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]]}
+
+
+PACKAGES = [
+    # inside the filter, scheming field
+    {'id': 'a', 'spatial': json.dumps(_polygon(-128, 50, -127, 51))},
+    # bounding box overlaps a triangular filter but the polygon does not
+    {'id': 'b', 'spatial': json.dumps(_polygon(-121, 55.5, -120.5, 56))},
+    # far away
+    {'id': 'c', 'spatial': json.dumps({'type': 'Point', 'coordinates': [10, 45]})},
+    # crosses the edge of the filter, spatial extra
+    {'id': 'd', 'extras': [{'key': 'spatial', 'value': json.dumps(_polygon(-131, 49, -129, 52))}]},
+    # no spatial extent
+    {'id': 'e'},
+    {'id': 'f', 'spatial': ''},
+    {'id': 'g', 'spatial': 'not geojson'},
+    {'id': 'h', 'spatial': json.dumps({'type': 'Polygon', 'coordinates': []})},
+]
+
+TRIANGLE = 'POLYGON((-130 48, -120 48, -130 58, -130 48))'
+
+
+@pytest.fixture(params=['vectorized', 'prepared'])
+def shapely_api(request, monkeypatch):
+    # both the shapely 2 and the shapely < 2 code paths
+    if request.param == 'prepared':
+        from shapely.prepared import prep
+        monkeypatch.setattr(spatial_filter, 'numpy', None)
+        monkeypatch.setattr(spatial_filter, 'prep', prep, raising=False)
+    elif spatial_filter.numpy is None:
+        pytest.skip('shapely < 2')
+    return request.param
+
+
+def _ids(pkg_dicts):
+    return [pkg_dict['id'] for pkg_dict in pkg_dicts]
+
+
+@pytest.mark.parametrize('wkt', [
+    'BOX(-130,48,-126,52)',
+    'box( -130 48 -126 52 )',
+    'SRID=4326;BOX(-130, 48, -126, 52)',
+])
+def test_box_filter(shapely_api, wkt):
+    assert _ids(SpatialFilter.from_wkt(wkt).filter(PACKAGES)) == ['a', 'd']
+
+
+def test_polygon_filter(shapely_api):
+    assert _ids(SpatialFilter.from_wkt(TRIANGLE).filter(PACKAGES)) == ['a', 'd']
+    # b is inside the bounding box of the triangle
+    assert _ids(SpatialFilter.from_wkt('BOX(-130,48,-120,58)').filter(PACKAGES)) == ['a', 'b', 'd']
+
+
+@pytest.mark.parametrize('wkt', [
+    None,
+    '',
+    'POLYGON((-130 48, -120 48',
+    'not wkt',
+    'POLYGON EMPTY',
+    'SRID=3857;POINT(0 0)',
+])
+def test_invalid_filter(wkt):
+    with pytest.raises(ValueError):
+        parse_filter(wkt)
+
+
+def test_packages_without_spatial_extent(shapely_api):
+    no_extent = [pkg_dict for pkg_dict in PACKAGES if pkg_dict['id'] in ('e', 'f', 'g', 'h')]
+    assert [package_geometry(pkg_dict) for pkg_dict in no_extent] == [None] * 4
+    assert SpatialFilter.from_wkt(TRIANGLE).filter(no_extent) == []
+    assert SpatialFilter.from_wkt(TRIANGLE).matches([None, None]) == [False, False]
+    assert SpatialFilter.from_wkt(TRIANGLE).filter([]) == []
+
+
+def test_package_geometry_as_dict():
+    geometry = package_geometry({'spatial': {'type': 'Point', 'coordinates': [-128, 51]}})
+    assert (geometry.x, geometry.y) == (-128, 51)
@@ -43,8 +43,11 @@ setup(
 
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
     ],
+    python_requires='>=3.7',
 
 
     # What does your project relate to?
@@ -81,8 +84,10 @@ setup(
     entry_points='''
         [ckan.plugins]
         cioos_harvest=ckanext.cioos_harvest.plugin:Cioos_HarvestPlugin
-        ckan_cioos_harvester=ckanext.cioos_harvest.plugin:CIOOSCKANHarvester
-        ckan_spatial_harvester=ckanext.cioos_harvest.plugin:CKANSpatialHarvester
+        ckan_cioos_harvester=ckanext.cioos_harvest.harvesters:CIOOSCKANHarvester
+        ckan_spatial_harvester=ckanext.cioos_harvest.harvesters:CKANSpatialHarvester
+        waf_cioos_harvester=ckanext.cioos_harvest.harvesters:CIOOSWAFHarvester
+        csw_cioos_harvester=ckanext.cioos_harvest.harvesters:CIOOSCSWHarvester
 
         [babel.extractors]
         ckan = ckan.lib.extract:extract_ckan